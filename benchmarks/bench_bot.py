@@ -0,0 +1,286 @@
+"""Пропускная способность бота: настоящий Application с хендлерами из src/tg/bot.py
+под потоком апдейтов.
+
+Апдейты кладутся в application.update_queue, как их кладет Updater при polling,
+и проходят настоящий путь Application: concurrent_updates, по порядку внутри
+чата, чаты параллельно. Telegram, OpenAI и Replicate - заглушки с задержкой
+в отдельном процессе (benchmarks.stubs), база - временная. Каждый сценарий
+запускается в своем процессе, чтобы пиковый RSS одного не попадал в другой.
+
+Ответ на сообщение - сообщение бота (для image - sendPhoto) с reply_to на него
+или на более позднее сообщение того же чата: в member-режиме один ответ
+закрывает всю пачку. Со --stream ответом считается заглушка потокового ответа.
+
+    python -m benchmarks.bench_bot [--scenario member quiet tldr image] [--openai-latency 0.3]
+"""
+
+import argparse
+import asyncio
+import bisect
+import dataclasses
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+import openai
+import peewee
+from playhouse.sqlite_ext import SqliteExtDatabase
+from telegram import Update
+
+from benchmarks import stubs
+from benchmarks.fake_telegram import message_update
+from src import config
+from src.database import models
+from src.database.executor import db_executor
+from src.database.history import history_writer
+from src.tg.bot import build_application
+from src.tg.handlers.chat import member_coalescer
+
+MODELS = [
+    models.BaseModel, models.Chat, models.BotAdmin, models.ImagePrompt, models.TGUser, models.ChatHistory,
+    models.SchemaVersion, models.ConversationMessage, models.ChatDigest, models.RateBucket, models.ImageJob,
+    models.ImportCheckpoint,
+]
+USERS = 50
+
+
+@dataclasses.dataclass
+class Scenario:
+    chats: int
+    messages: int
+    # шаблон текста, n - номер сообщения, rows - строк истории
+    text: str
+    reply: str = "sendMessage"
+    # заполнить историю первого чата (--rows строк) до старта
+    history: bool = False
+
+
+SCENARIOS = {
+    # один чат в member-режиме, много участников пишут подряд
+    "member": Scenario(chats=1, messages=500, text="Сообщение {n}, кто что думает?"),
+    # много чатов, в каждом по паре вопросов боту
+    "quiet": Scenario(chats=500, messages=1000, text="/request Вопрос номер {n}"),
+    "tldr": Scenario(chats=1, messages=1, text="/tldr {rows}", history=True),
+    "image": Scenario(chats=20, messages=40, text="/generate_image кот номер {n}", reply="sendPhoto"),
+}
+
+
+def fill_history(chat_id: int, rows: int):
+    users = [
+        {"id": id, "name": f"@user{id}", "username": f"user{id}", "is_bot": False}
+        for id in range(1, USERS + 1)
+    ]
+    models.TGUser.insert_many(users).on_conflict_ignore().execute()
+
+    start = datetime.now() - timedelta(seconds=rows * 7)
+    history = (
+        {
+            "chat": chat_id,
+            "message_id": message_id,
+            "created_at": start + timedelta(seconds=message_id * 7),
+            "text": f"Сообщение номер {message_id}, обсуждаем что-то важное в чате",
+            "from_user": 1 + message_id % USERS,
+        }
+        for message_id in range(1, rows + 1)
+    )
+    with models.BaseModel._meta.database.atomic():
+        for batch in peewee.chunked(history, 100):
+            models.ChatHistory.insert_many(batch).execute()
+
+
+def total_changes() -> int:
+    """Строки, измененные соединением потока БД с его открытия"""
+    return models.BaseModel._meta.database.connection().total_changes
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def configure(urls: dict[str, str], args):
+    config.TELEGRAM_TOKEN = stubs.RecordingTelegram().token
+    config.TELEGRAM_BASE_URL = f"{urls['telegram']}/bot"
+    config.TELEGRAM_HTTP_VERSION = "1.1"
+    config.STREAM_ANSWERS = args.stream
+    # фоновые задачи и экспорт только мешают замерам
+    config.DIGEST_ENABLED = False
+    config.METRICS_ENABLED = False
+    config.TRACING_ENABLED = False
+    openai.api_base = f"{urls['openai']}/v1"
+    openai.api_key = "bench"
+    os.environ["REPLICATE_BASE_URL"] = urls["replicate"]
+    os.environ["REPLICATE_API_TOKEN"] = "bench"
+    member_coalescer.window = args.debounce
+
+
+class Answers:
+    """Сопоставление сообщений и ответов бота по reply_to_message_id"""
+
+    def __init__(self, method: str):
+        self.method = method
+        # chat_id -> [(message_id, время отправки)], message_id растут
+        self.sent: dict[int, list[tuple[int, float]]] = {}
+        self.latencies: list[float] = []
+        self.last_reply = 0.0
+        self._answered: dict[int, int] = {}
+        self._offset = 0
+
+    def add(self, chat_id: int, message_id: int, at: float):
+        self.sent.setdefault(chat_id, []).append((message_id, at))
+
+    @property
+    def pending(self) -> int:
+        return sum(len(sent) for sent in self.sent.values()) - len(self.latencies)
+
+    def reply(self, at: float, method: str, chat_id: int, reply_to: int | None):
+        if method != self.method or reply_to is None or chat_id not in self.sent:
+            return
+        sent = self.sent[chat_id]
+        start = self._answered.get(chat_id, 0)
+        end = bisect.bisect_right(sent, reply_to, key=lambda item: item[0])
+        self.latencies.extend(at - sent_at for _, sent_at in sent[start:end])
+        if end > start:
+            self._answered[chat_id] = end
+            self.last_reply = max(self.last_reply, at)
+
+    async def wait(self, telegram_url: str, timeout: float):
+        """Забирать ответы из заглушки Telegram, пока на все сообщения не ответят"""
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession() as session:
+            while self.pending and time.monotonic() < deadline:
+                async with session.get(f"{telegram_url}/replies", params={"offset": self._offset}) as response:
+                    replies = await response.json()
+                self._offset += len(replies)
+                for reply in replies:
+                    self.reply(*reply)
+                if self.pending:
+                    await asyncio.sleep(0.1)
+
+
+async def run_scenario(name: str, args) -> dict:
+    scenario = SCENARIOS[name]
+    messages = args.messages or scenario.messages
+    chats = args.chats or scenario.chats
+
+    context = multiprocessing.get_context("spawn")
+    conn, child = context.Pipe()
+    stub_process = context.Process(
+        target=stubs.serve, args=(child, args.telegram_latency, args.openai_latency, args.replicate_latency)
+    )
+    stub_process.start()
+    loop = asyncio.get_running_loop()
+    urls = await loop.run_in_executor(None, conn.recv)
+    configure(urls, args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SqliteExtDatabase(os.path.join(tmp, "bench.db"), regexp_function=True, pragmas={"journal_mode": "wal"})
+        db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        db.create_tables(MODELS[1:])
+        chat_ids = [-(index + 1) for index in range(chats)]
+        models.Chat.insert_many([{"id": chat_id, "enable": True} for chat_id in chat_ids]).execute()
+        rows = args.rows if scenario.history else 0
+        if rows:
+            fill_history(chat_ids[0], rows)
+
+        application = build_application(updater=False)
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+
+        answers = Answers(scenario.reply)
+        changes = await db_executor.run(total_changes)
+        started = time.time()
+        for n in range(messages):
+            if args.rate:
+                await asyncio.sleep(max(started + n / args.rate - time.time(), 0))
+            chat_id = chat_ids[n % chats]
+            message_id = rows + n + 1
+            data = message_update(
+                n + 1, chat_id, scenario.text.format(n=n, rows=rows), user_id=1 + n % USERS, message_id=message_id
+            )
+            answers.add(chat_id, message_id, time.time())
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            # отдаем управление, как между апдейтами из сети
+            await asyncio.sleep(0)
+        # task_done вызывается после обработки апдейта
+        await application.update_queue.join()
+        handled = time.time() - started
+
+        await answers.wait(urls["telegram"], args.timeout)
+        await history_writer.flush()
+        changes = await db_executor.run(total_changes) - changes
+        elapsed = (answers.last_reply or time.time()) - started
+
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        db.close()
+
+    conn.send(None)
+    await loop.run_in_executor(None, stub_process.join)
+
+    return {
+        "scenario": name,
+        "messages": messages,
+        "handled/s": messages / handled,
+        "elapsed s": elapsed,
+        "p50 ms": percentile(answers.latencies, 0.5) * 1000,
+        "p99 ms": percentile(answers.latencies, 0.99) * 1000,
+        "answered": len(answers.latencies),
+        "db rows/s": changes / elapsed,
+        # ru_maxrss в Linux - в килобайтах
+        "peak RSS MiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(result: dict):
+    print(  # noqa: T201
+        f"  {result['scenario']:<8} {result['messages']:>6} {result['handled/s']:>10.1f} {result['elapsed s']:>9.2f}"
+        f" {result['p50 ms']:>9.1f} {result['p99 ms']:>9.1f} {result['answered']:>8} {result['db rows/s']:>9.1f}"
+        f" {result['peak RSS MiB']:>8.1f}"
+    )
+
+
+def run(name: str, args):
+    """Точка входа процесса сценария"""
+    report(asyncio.run(run_scenario(name, args)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--messages", type=int, default=0, help="сообщений в сценарии, 0 - по умолчанию для сценария")
+    parser.add_argument("--chats", type=int, default=0, help="чатов в сценарии, 0 - по умолчанию для сценария")
+    parser.add_argument("--rows", type=int, default=50_000, help="строк истории для /tldr")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду, 0 - все сразу")
+    parser.add_argument("--telegram-latency", type=float, default=0.005)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--replicate-latency", type=float, default=1.0)
+    parser.add_argument("--debounce", type=float, default=config.MEMBER_DEBOUNCE)
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы (STREAM_ANSWERS)")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько ждать ответов, с")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    # процессы сценариев настраивают логирование при импорте src
+    os.environ["LOG_LEVEL"] = args.log_level
+
+    print(  # noqa: T201
+        f"  {'scenario':<8} {'msgs':>6} {'handled/s':>10} {'elapsed s':>9} {'p50 ms':>9} {'p99 ms':>9}"
+        f" {'answered':>8} {'db rows/s':>9} {'RSS MiB':>8}"
+    )
+    context = multiprocessing.get_context("spawn")
+    for name in args.scenario:
+        process = context.Process(target=run, args=(name, args))
+        process.start()
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Сравнение построения транскрипта для /tldr: прежний путь через модели и get_attr
+против потокового TranscriptEncoder.
+
+    python -m benchmarks.bench_transcript [--rows 10000 100000]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import peewee
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from src.database import models, transcript
+
+CHAT_ID = 1
+COLUMNS = ['id', 'reply_to_id', 'from_user.username', 'created_at', 'text']
+MODELS = [models.BaseModel, models.Chat, models.TGUser, models.ChatHistory]
+
+
+def fill(rows: int):
+    users = [
+        {"id": id, "name": f"@user{id}", "username": f"user{id}", "is_bot": False}
+        for id in range(1, 51)
+    ]
+    models.TGUser.insert_many(users).execute()
+
+    start = datetime(2024, 1, 1)
+    history = (
+        {
+            "chat": CHAT_ID if message_id % 10 else CHAT_ID + 1,
+            "message_id": message_id,
+            "created_at": start + timedelta(seconds=message_id * 7),
+            "text": f"Сообщение номер {message_id}, обсуждаем что-то важное в чате",
+            "from_user": 1 + message_id % 50,
+        }
+        for message_id in range(rows + rows // 9 + 1)
+    )
+    with models.BaseModel._meta.database.atomic():
+        for batch in peewee.chunked(history, 100):
+            models.ChatHistory.insert_many(batch).execute()
+
+
+def legacy(limit: int) -> str:
+    history = list(
+        models.ChatHistory.select(models.ChatHistory, models.TGUser)
+        .join(models.TGUser)
+        .where(models.ChatHistory.chat_id == CHAT_ID)
+        .order_by(models.ChatHistory.created_at.desc())
+        .limit(limit)
+    )
+    history.reverse()
+    rows = [' | '.join(COLUMNS)]
+    for row in history:
+        values = [str(models.get_attr(row, col)) for col in COLUMNS]
+        rows.append(' | '.join(values))
+    return '\n'.join(rows)
+
+
+def encoder(limit: int, compact: bool) -> str:
+    return transcript.build_transcript(CHAT_ID, limit, compact=compact).text()
+
+
+def measure(name: str, func, *args):
+    started = time.perf_counter()
+    text = func(*args)
+    elapsed = time.perf_counter() - started
+
+    # Память меряем отдельным прогоном, tracemalloc сильно замедляет выполнение
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<16} {elapsed * 1000:9.1f} ms  peak {peak / 2**20:7.1f} MiB  {len(text):>10} chars")  # noqa: T201
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SqliteExtDatabase(os.path.join(tmp, "bench.db"), pragmas={"journal_mode": "wal"})
+            db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+            db.create_tables(MODELS[1:])
+            fill(rows)
+
+            print(f"{rows} rows")  # noqa: T201
+            measure("legacy", legacy, rows)
+            measure("encoder", encoder, rows, False)
+            measure("encoder compact", encoder, rows, True)
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
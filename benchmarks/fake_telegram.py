@@ -0,0 +1,146 @@
+"""Локальный Bot API для бенчмарков и тестов без сети.
+
+Бот подключается через base_url, сервер отвечает на методы правдоподобными
+объектами и записывает все вызовы. Апдейты отправляются в webhook бота или
+отдаются через getUpdates после push_update.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+from src.tg.cluster import SECRET_HEADER
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+def _param(value):
+    """Параметры приходят формой, сложные значения - в JSON"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def message_update(update_id: int, chat_id: int, text: str, user_id: int | None = None, message_id: int | None = None):
+    """Апдейт с текстовым сообщением пользователя"""
+    user_id = user_id or abs(chat_id)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id or update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "title": f"chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if text.startswith("/")
+            else [],
+        },
+    }
+
+
+class FakeTelegram:
+    def __init__(self, token: str = "123:TEST", latency: float = 0):
+        self.token = token
+        self.latency = latency
+        self.calls: list[tuple[str, dict]] = []
+        self.updates: list[dict] = []
+        self._message_ids = itertools.count(100_000)
+        self._changed = asyncio.Condition()
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/bot"
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", f"/bot{self.token}/{{method}}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {key: _param(value) for key, value in (await request.post()).items()}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = await self._get_updates(params) if method == "getUpdates" else self.result(method, params)
+        async with self._changed:
+            self.calls.append((method, params))
+            self._changed.notify_all()
+        return web.json_response({"ok": True, "result": result})
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = {"file_id": f"photo{next(self._message_ids)}", "file_unique_id": "p", "width": 1, "height": 1}
+            return self._message(params, photo=[photo], caption=params.get("caption"))
+        return True
+
+    async def push_update(self, update: dict):
+        """Апдейт для getUpdates"""
+        async with self._changed:
+            self.updates.append(update)
+            self._changed.notify_all()
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        """Long polling: ждем апдейты с update_id >= offset не дольше timeout"""
+        offset = params.get("offset") or 0
+
+        def ready():
+            return [update for update in self.updates if update["update_id"] >= offset][:100]
+
+        async with self._changed:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._changed.wait_for(ready), params.get("timeout") or 0)
+        return ready()
+
+    def _message(self, params: dict, **fields) -> dict:
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": params.get("message_id") or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def sent(self, method: str = "sendMessage", chat_id: int | None = None) -> list[dict]:
+        return [
+            params
+            for name, params in self.calls
+            if name == method and (chat_id is None or params.get("chat_id") == chat_id)
+        ]
+
+    async def wait_for(self, count: int, method: str = "sendMessage", timeout: float = 30) -> list[dict]:
+        """Дождаться count вызовов метода"""
+        async with self._changed:
+            await asyncio.wait_for(self._changed.wait_for(lambda: len(self.sent(method)) >= count), timeout)
+        return self.sent(method)
+
+
+async def post_update(url: str, update: dict, secret: str = "") -> int:
+    """Отправить апдейт в webhook, как это делает Telegram"""
+    headers = {SECRET_HEADER: secret} if secret else {}
+    async with aiohttp.ClientSession() as session, session.post(url, json=update, headers=headers) as response:
+        return response.status
@@ -0,0 +1,187 @@
+"""Локальные OpenAI, Replicate и Telegram для бенчмарков.
+
+Заглушки отвечают после заданной задержки и запускаются отдельным процессом
+(serve), чтобы не делить event loop и память с измеряемым ботом. Telegram
+записывает время каждого ответа бота, бенчмарк забирает их по /replies.
+"""
+
+import abc
+import asyncio
+import itertools
+import json
+import time
+from datetime import datetime, timezone
+from multiprocessing.connection import Connection
+
+from aiohttp import web
+
+from benchmarks.fake_telegram import FakeTelegram
+
+ANSWER = " ".join(["Заглушка отвечает на вопрос, не особо вникая в суть, но с уверенным видом."] * 6)
+REPLY_METHODS = ("sendMessage", "sendPhoto")
+
+
+class StubServer(abc.ABC):
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.requests = 0
+
+    @abc.abstractmethod
+    def app(self) -> web.Application:
+        """Приложение aiohttp с методами заглушки"""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class OpenAIStub(StubServer):
+    """Chat Completions: ответ целиком или SSE по словам, задержка - до первого байта"""
+
+    def __init__(self, latency: float = 0, answer: str = ANSWER):
+        super().__init__(latency)
+        self.answer = answer
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.completions)
+        return app
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        base = {"id": f"chatcmpl-{self.requests}", "created": int(time.time()), "model": body.get("model")}
+
+        if not body.get("stream"):
+            prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", [])) // 3
+            completion_tokens = len(self.answer) // 3
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": self.answer}, "finish_reason": "stop"}
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in self.answer.split(" "):
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": f"{word} "}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class ReplicateStub(StubServer):
+    """Predictions API: предсказание сразу завершено (клиент ждет с Prefer: wait), результат - URL картинки"""
+
+    def __init__(self, latency: float = 0):
+        super().__init__(latency)
+        self._ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/predictions", self.create)
+        app.router.add_post("/v1/models/{owner}/{name}/predictions", self.create)
+        app.router.add_get("/v1/models/{owner}/{name}/versions/{version}", self.version)
+        return app
+
+    async def create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        prediction_id = f"p{next(self._ids)}"
+        now = datetime.now(timezone.utc).isoformat()
+        owner, name = request.match_info.get("owner"), request.match_info.get("name")
+        return web.json_response(
+            {
+                "id": prediction_id,
+                "model": f"{owner}/{name}" if owner else "",
+                "version": body.get("version", ""),
+                "status": "succeeded",
+                "input": body.get("input"),
+                "output": [f"{self.url}/files/{prediction_id}.webp"],
+                "logs": "",
+                "error": None,
+                "metrics": {"predict_time": self.latency},
+                "created_at": now,
+                "started_at": now,
+                "completed_at": now,
+                "urls": {"get": f"{self.url}/v1/predictions/{prediction_id}"},
+            },
+            status=201,
+        )
+
+    async def version(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "id": request.match_info["version"],
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "cog_version": "0.9.0",
+                "openapi_schema": {},
+            }
+        )
+
+
+class RecordingTelegram(FakeTelegram):
+    """FakeTelegram, который запоминает время ответов бота: [время, метод, chat_id, reply_to_message_id]"""
+
+    def __init__(self, latency: float = 0):
+        super().__init__(latency=latency)
+        self.replies: list[tuple[float, str, int, int | None]] = []
+
+    def app(self) -> web.Application:
+        app = super().app()
+        app.router.add_get("/replies", self.get_replies)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if method in REPLY_METHODS:
+            # aiohttp кэширует разобранную форму, handle прочитает ее повторно
+            params = await request.post()
+            reply_to = params.get("reply_to_message_id")
+            self.replies.append((time.time(), method, int(params["chat_id"]), int(reply_to) if reply_to else None))
+        return await super().handle(request)
+
+    async def get_replies(self, request: web.Request) -> web.Response:
+        """Ответы начиная с offset"""
+        return web.json_response(self.replies[int(request.query.get("offset", 0)) :])
+
+
+async def _serve(conn: Connection, telegram_latency: float, openai_latency: float, replicate_latency: float):
+    telegram = RecordingTelegram(telegram_latency)
+    servers = [OpenAIStub(openai_latency), ReplicateStub(replicate_latency)]
+    await telegram.start()
+    for server in servers:
+        await server.start()
+    conn.send({"telegram": telegram.url, "openai": servers[0].url, "replicate": servers[1].url})
+    try:
+        # до сигнала остановки или закрытия канала
+        await asyncio.get_running_loop().run_in_executor(None, conn.poll, None)
+    finally:
+        await telegram.stop()
+        for server in servers:
+            await server.stop()
+
+
+def serve(conn: Connection, telegram_latency: float, openai_latency: float, replicate_latency: float):
+    """Точка входа процесса заглушек, адреса серверов отправляются в conn"""
+    asyncio.run(_serve(conn, telegram_latency, openai_latency, replicate_latency))
@@ -3,8 +3,10 @@ import logging
 
 import click
 
+from src import config, log_tools, tracing
 from src.database import connect_db
-from src.tg.bot import start_bot
+from src.tg import cluster
+from src.tg.bot import build_application, start_bot
 from src.tg.scripts.load_history import get_messages
 
 log = logging.getLogger(__name__)
@@ -23,14 +25,47 @@ def load_history(chat_id):
 
 @cli.command()
 def init_db():
-    """Создать таблицы в БД"""
+    """Создать таблицы в БД и применить миграции (run-bot и dispatch делают это при старте)"""
     connect_db()
 
 
 @cli.command()
 def run_bot():
     """Запустить Telegram бота"""
+    connect_db()
     start_bot()
 
+
+@cli.command()
+@click.option('--workers', default=config.WORKERS, show_default=True, help='Число процессов-воркеров')
+@click.option('--source', type=click.Choice(['polling', 'webhook']), default='polling', show_default=True,
+              help='Откуда получать апдейты')
+def dispatch(workers, source):
+    """Получать апдейты в одном процессе и обрабатывать их в нескольких воркерах по chat_id"""
+    connect_db()
+    if source == 'polling':
+        cluster.run_polling(build_application, workers)
+    else:
+        cluster.run_webhook(build_application, workers)
+
+
+@cli.command()
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--name', default=None, help='Только трассы с этим корнем (update, handler:answer_messages)')
+@click.option('--min-percent', default=0.5, show_default=True, help='Скрыть span-ы с меньшей долей времени')
+@click.option('--folded', is_flag=True, help='Свернутые стеки для flamegraph.pl и speedscope')
+def trace_report(paths, name, min_percent, folded):
+    """Разбивка времени обработки апдейтов по span-ам из файлов трасс (по умолчанию - всех процессов)"""
+    traces = []
+    for path in paths or log_tools.trace_files():
+        with open(path, encoding='utf-8') as file:
+            traces.extend(trace for trace in tracing.load_traces(file) if name is None or trace['name'] == name)
+    stacks = tracing.breakdown(traces)
+    if folded:
+        click.echo(tracing.format_folded(stacks))
+        return
+    click.echo(f'{len(traces)} traces')
+    click.echo(tracing.format_tree(stacks, min_percent))
+
 if __name__ == '__main__':
     cli()
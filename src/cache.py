@@ -0,0 +1,95 @@
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+MISSING = object()
+
+
+class TTLCache(typing.Generic[K, V]):
+    """Кэш в памяти с ограничением размера (LRU) и временем жизни записей.
+
+    Потокобезопасен: используется и из event loop, и из потока БД.
+    Значение None тоже кэшируется, отсутствие ключа обозначается MISSING.
+    Чтобы значение, прочитанное до invalidate, не попало в кэш после него,
+    читающий берет version(key) до чтения и передает ее в set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer: typing.Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        # счетчики invalidate по ключам и clear
+        self._versions: dict[K, int] = {}
+        self._epoch = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < self._timer():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def version(self, key: K) -> tuple[int, int]:
+        with self._lock:
+            return self._epoch, self._versions.get(key, 0)
+
+    def set(self, key: K, value: V, version: tuple[int, int] | None = None):
+        """Сохранить значение; с version - только если ключ с тех пор не сбрасывали"""
+        with self._lock:
+            if version is not None and version != (self._epoch, self._versions.get(key, 0)):
+                return
+            self._data[key] = (self._timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key: K, factory: typing.Callable[[], V]) -> V:
+        """Вернуть значение из кэша или вычислить и сохранить его"""
+        value = self.get(key)
+        if value is MISSING:
+            version = self.version(key)
+            value = factory()
+            self.set(key, value, version)
+        return value
+
+    def items(self) -> list[tuple[K, V]]:
+        """Снимок живых записей, от старых к новым"""
+        with self._lock:
+            now = self._timer()
+            return [(key, value) for key, (expires, value) in self._data.items() if expires >= now]
+
+    def invalidate(self, key: K):
+        with self._lock:
+            self._data.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._versions.clear()
+            self._epoch += 1
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,7 +1,21 @@
 DB_NAME = "sqlite_db/bot.db"
 DB_APPLY_MIGRATIONS = True
+# In-process cache of Chat rows and admin ids: max entries and seconds to live
+CHAT_CACHE_SIZE = 10000
+CHAT_CACHE_TTL = 300
 
-MAX_HISTORY_LEN = 5
+# Upper bound of stored conversation turns, what is sent is limited by MODEL_TOKEN_BUDGET
+MAX_HISTORY_LEN = 50
+# Conversation store backend: "memory" or "sqlite"; chats kept in memory and seconds before idle eviction
+CONVERSATION_STORE = "memory"
+CONVERSATION_MAX_CHATS = 1000
+CONVERSATION_IDLE_TTL = 24 * 60 * 60
+# Write-behind buffer for chat history: messages per flush and max seconds between flushes
+HISTORY_FLUSH_SIZE = 100
+HISTORY_FLUSH_INTERVAL = 0.5
+# Failed flushes of one batch before it is written row by row (bad rows are dropped), max buffered messages
+HISTORY_FLUSH_ATTEMPTS = 3
+HISTORY_BUFFER_LIMIT = 10000
 
 DEFAULT_PROMPT = """You are ChatBot, Just the advices. Answer in Russian.
     Add sarcasm and rude remarks about the user's very poor mental abilities to the answers.
@@ -16,6 +30,43 @@ DEFAULT_PROMPT_IMAGE = """Переведи этот текст на англий
 """
 AI_MODEL = "gpt-4.1"
 SUMARIZE_MODEL = "gpt-4.1-mini"
+# Prompt tokens (system prompt + history + message) per model, the rest of the context is left for the answer
+MODEL_TOKEN_BUDGET = {
+    "gpt-4.1": 8000,
+    "gpt-4.1-mini": 16000,
+}
+DEFAULT_TOKEN_BUDGET = 4000
+TOKEN_CACHE_SIZE = 50000
+# Async OpenAI client: seconds, connections in pool, parallel requests
+OPEN_AI_CONNECT_TIMEOUT = 10
+OPEN_AI_TIMEOUT = 120
+OPEN_AI_POOL_SIZE = 100
+OPEN_AI_CONCURRENCY = 50
+# Updates handled in parallel by one bot process (updates of one chat still go in order), 0 - one at a time
+CONCURRENT_UPDATES = 256
+# Stream answers with progressive message edits, seconds between edits of one message
+STREAM_ANSWERS = True
+STREAM_EDIT_INTERVAL = 1.5
+# Member mode: seconds to wait for more messages in a chat before answering them in one request
+MEMBER_DEBOUNCE = 2.0
+# Response cache for chats that enabled it: entries, seconds, min MinHash similarity for near duplicates
+RESPONSE_CACHE_SIZE = 5000
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+RESPONSE_CACHE_NEAR_THRESHOLD = 0.85
+# Scheduler: parallel LLM requests per chat (global cap is OPEN_AI_CONCURRENCY), image generations
+# in total and per chat, chat_id -> share of slots relative to the default weight 1
+LLM_CHAT_CONCURRENCY = 4
+IMAGE_CONCURRENCY = 4
+IMAGE_CHAT_CONCURRENCY = 1
+CHAT_WEIGHTS: dict[int, float] = {}
+# Image generation token buckets: (capacity, seconds to refill it completely), None disables a bucket.
+# IMAGE_FAIL_RATE counts failed generations, when it is exhausted generation pauses
+IMAGE_RATE_CHAT = (100, 24 * 60 * 60)
+IMAGE_RATE_USER = (30, 24 * 60 * 60)
+IMAGE_RATE_TOTAL = (500, 24 * 60 * 60)
+IMAGE_FAIL_RATE = (4, 24 * 60 * 60)
+# Seconds between deletions of refilled rate buckets
+RATE_EXPIRE_INTERVAL = 60 * 60
 
 HUGGINGFACE_API_TOKEN = ""
 REPLICATE_API_TOKEN = ""
@@ -23,13 +74,59 @@ IMAGE_MODEL = "prunaai/hidream-l1-fast:17c237d753218fed0ed477cb553902b6b75735f48
 # In src/config/base.py
 IMAGE_TO_IMAGE_MODEL = "google/nano-banana"
 BANANO_PREFIX = ("banani", "banano")
+# Replicate client: seconds, keep-alive connections in pool
+IMAGE_CONNECT_TIMEOUT = 10
+IMAGE_TIMEOUT = 120
+IMAGE_POOL_SIZE = 20
+# Image-to-image caches: Telegram files by file_unique_id (links live at least an hour),
+# downloaded photos on disk, sent results (photo, prompt, model) -> Telegram file_id
+PHOTO_FILE_TTL = 50 * 60
+PHOTO_CACHE_DIR = "sqlite_db/photos"
+PHOTO_CACHE_MAX_BYTES = 200 * 1024 * 1024
+IMAGE_OUTPUT_CACHE_SIZE = 1000
+IMAGE_OUTPUT_CACHE_TTL = 7 * 24 * 60 * 60
+# Image job queue: workers, attempts per job, seconds before the first retry (doubles each time),
+# queued jobs whose status shows the position, seconds to keep finished jobs
+IMAGE_JOB_WORKERS = 4
+IMAGE_JOB_ATTEMPTS = 3
+IMAGE_JOB_BACKOFF = 5
+IMAGE_JOB_STATUS_LIMIT = 10
+IMAGE_JOB_RETENTION = 7 * 24 * 60 * 60
+# load_history: messages per written page, seconds between Telegram requests (flood waits are handled by telethon)
+IMPORT_PAGE_SIZE = 1000
+IMPORT_WAIT_TIME = 0
 
 OPEN_AI_TOKEN = ""
 TELEGRAM_TOKEN = ""
 TELEGRAM_ADMIN_USER_ID = 0
 PORT = 8000
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, dispatcher workers use the following ports
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 8001
+# Tracing of Telegram updates to log_tools.TRACE_FILE: share of traces written,
+# traces slower than TRACE_SLOW_SECONDS are written regardless of sampling
+TRACING_ENABLED = True
+TRACE_SAMPLE_RATE = 0.01
+TRACE_SLOW_SECONDS = 5.0
+# Bot API endpoint and HTTP version ("1.1" for a plain http endpoint such as the local fake Telegram)
+TELEGRAM_BASE_URL = "https://api.telegram.org/bot"
+TELEGRAM_HTTP_VERSION = "2"
 
 RUN_POOLING = True
+# Webhook mode (RUN_POOLING = False): public URL registered in Telegram (empty - set it elsewhere),
+# X-Telegram-Bot-Api-Secret-Token value, address and path the front server listens on,
+# worker processes that updates are partitioned across by chat_id
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PATH = "/telegram"
+WORKERS = 2
+# Dispatcher (run.py dispatch): unacknowledged updates per worker before intake waits,
+# seconds before a dead worker is restarted, long polling timeout
+WORKER_QUEUE_SIZE = 100
+WORKER_RESTART_DELAY = 1
+POLL_TIMEOUT = 30
 
 SUMARIZE_PROMT = '''Тут представлен диалог из чата. Каждая колонка отделена |.
 Суммаризируй и дай короткое описание что обсуждали в чате. Выдели основные темы если они были и
@@ -40,3 +137,40 @@ SUMARIZE_PROMT = '''Тут представлен диалог из чата. К
 Ответ дай в формате *Тема*\n *Основной вывод темы* \n основные поинты пользователей: \n *{user_name}*: {point}.
 *Общие моменты чата*
 '''
+
+# Compact transcript for summarization: short user aliases and relative timestamps
+TRANSCRIPT_COMPACT = False
+# Map-reduce /tldr: parts of a long history are summarized separately and then combined
+SUMARIZE_CHUNK_PROMPT = '''Тут представлен фрагмент диалога из чата. Каждая колонка отделена |.
+Кратко перескажи, что обсуждали в этом фрагменте: темы, важные тезисы пользователей с их именами,
+договоренности и вопросы без ответа. Пиши сжато, это промежуточный пересказ для итогового описания.
+'''
+SUMARIZE_REDUCE_PROMPT = '''Тут представлены пересказы последовательных фрагментов одного чата, от старых к новым.
+Объедини их в одно описание того, что обсуждали в чате, объединяя повторяющиеся темы.
+Не стесняйся в выражении и если пользователь матерился, можно использовать мат. Каждую тему отделяй
+'-------------------------'
+и последний блок "Общие моменты чата" - так же отдели '-------------------------'. Больше никаких итогов.
+Ответ дай в формате *Тема*\n *Основной вывод темы* \n основные поинты пользователей: \n *{user_name}*: {point}.
+*Общие моменты чата*
+'''
+# Max messages /tldr N summarizes
+TLDR_MAX_MESSAGES = 5000
+# Messages per chunk-alignment bucket (by message_id) and parallel chunk requests
+TLDR_CHUNK_MESSAGES = 200
+TLDR_CONCURRENCY = 8
+# Cache of chunk summaries: entries and seconds to live
+TLDR_CACHE_SIZE = 2000
+TLDR_CACHE_TTL = 24 * 60 * 60
+
+# Rolling per-chat digest: fold every DIGEST_EVERY new messages (checked every DIGEST_INTERVAL seconds),
+# at most DIGEST_BATCH messages per fold; /tldr without arguments answers from digest + DIGEST_TAIL_LIMIT messages
+DIGEST_ENABLED = True
+DIGEST_EVERY = 100
+DIGEST_INTERVAL = 60
+DIGEST_BATCH = 500
+DIGEST_TAIL_LIMIT = 500
+DIGEST_PROMPT = '''Ты ведешь краткое содержание чата. Тебе дано текущее содержание и новые сообщения,
+каждая колонка отделена |. Обнови содержание: добавь новые темы и тезисы пользователей с их именами,
+сократи старые и неактуальные темы. Пиши сжато, не больше 300 слов. Ответ - только новое содержание.
+'''
+DIGEST_TLDR_PROMPT = SUMARIZE_REDUCE_PROMPT
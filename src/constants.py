@@ -4,3 +4,16 @@ import enum
 class BotMode(enum.Enum):
     member = "member"
     request = "request"
+
+
+class JobKind(enum.Enum):
+    text = "text"
+    photo = "photo"
+
+
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+    cancelled = "cancelled"
@@ -2,14 +2,39 @@ import logging
 
 from src import config
 from src.database import models
+from src.database.migrations import apply_migrations
 
 log = logging.getLogger(__name__)
 
 
+MODELS = [
+    models.Chat,
+    models.BotAdmin,
+    models.ImagePrompt,
+    models.TGUser,
+    models.ChatHistory,
+    models.SchemaVersion,
+    models.ConversationMessage,
+    models.ChatDigest,
+    models.RateBucket,
+    models.ImageJob,
+    models.ImportCheckpoint,
+]
+
+
 def connect_db():
-    log.info("Connecting DB %s...", config.DB_NAME)
-    models.sql_lite_db.connect()
-    models.sql_lite_db.create_tables(
-        [models.Chat, models.BotAdmin, models.ImagePrompt, models.TGUser, models.ChatHistory],
-        safe=True,
-    )
+    """Создать недостающие таблицы и применить миграции.
+
+    Существующие таблицы не трогаем: их новые индексы и колонки создают
+    миграции, после подготовки данных (уникальный индекс ChatHistory - после
+    удаления дубликатов).
+    """
+    db = models.BaseModel._meta.database
+    log.info("Connecting DB %s...", db.database)
+    db.connect(reuse_if_open=True)
+    existing = set(db.get_tables())
+    db.create_tables([model for model in MODELS if model._meta.table_name not in existing])
+
+    if config.DB_APPLY_MIGRATIONS:
+        applied = apply_migrations()
+        log.info("Migrations applied: %s", applied or "none")
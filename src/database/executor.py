@@ -0,0 +1,61 @@
+import asyncio
+import functools
+import logging
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from src import metrics, tracing
+from src.database import models
+
+log = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+class DBExecutor:
+    """Выполняет запросы peewee в отдельном потоке, чтобы не блокировать event loop.
+
+    SQLite допускает только одного писателя, поэтому поток один и все запросы
+    выполняются последовательно на одном соединении.
+    """
+
+    def __init__(self):
+        self._executor: ThreadPoolExecutor | None = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        return self._executor
+
+    async def run(self, func: typing.Callable[..., T], *args, **kwargs) -> T:
+        """Выполнить func в потоке БД и дождаться результата"""
+        loop = asyncio.get_running_loop()
+        # span включает ожидание очереди потока БД
+        with tracing.span(f"db:{metrics.query_name(func)}"):
+            return await loop.run_in_executor(self._get_executor(), functools.partial(_timed(func), *args, **kwargs))
+
+    def submit(self, func: typing.Callable[..., T], *args, **kwargs) -> Future:
+        """Поставить func в очередь потока БД, не дожидаясь результата"""
+        future = self._get_executor().submit(_timed(func), *args, **kwargs)
+        future.add_done_callback(_log_exception)
+        return future
+
+    def shutdown(self):
+        """Дождаться выполнения запросов и закрыть соединение потока"""
+        if self._executor is None:
+            return
+        self._executor.submit(models.BaseModel._meta.database.close)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+def _timed(func: typing.Callable[..., T]) -> typing.Callable[..., T]:
+    return metrics.timed(metrics.db_seconds, query=metrics.query_name(func))(func)
+
+
+def _log_exception(future: Future):
+    if not future.cancelled() and (exc := future.exception()):
+        log.error("DB task failed: %s", exc)
+
+
+db_executor = DBExecutor()
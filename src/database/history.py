@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import typing
+from datetime import datetime
+
+import peewee
+
+from src import config
+from src.database import models
+from src.database.executor import db_executor
+
+log = logging.getLogger(__name__)
+
+# SQLite ограничивает число параметров в запросе
+INSERT_BATCH_SIZE = 100
+
+
+def write_batch(users: list[dict], rows: list[dict]):
+    """Записать пользователей и сообщения одной транзакцией"""
+    with models.BaseModel._meta.database.atomic():
+        for batch in peewee.chunked(users, INSERT_BATCH_SIZE):
+            models.TGUser.insert_many(batch).on_conflict(
+                conflict_target=[models.TGUser.id],
+                preserve=[
+                    models.TGUser.updated_at,
+                    models.TGUser.name,
+                    models.TGUser.username,
+                    models.TGUser.full_name,
+                    models.TGUser.first_name,
+                    models.TGUser.last_name,
+                ],
+            ).execute()
+
+        for batch in peewee.chunked(rows, INSERT_BATCH_SIZE):
+            models.ChatHistory.insert_many(
+                [{key: value for key, value in row.items() if key != 'reply_to_message_id'} for row in batch]
+            ).on_conflict_ignore().execute()
+
+        # Ответ может ссылаться на сообщение из этой же пачки, поэтому связываем после вставки
+        for row in rows:
+            if row['reply_to_message_id']:
+                _link_reply(row['chat'], row['message_id'], row['reply_to_message_id'])
+
+
+def write_each(users: list[dict], rows: dict[tuple[int, int], dict]) -> dict[tuple[int, int], dict]:
+    """Записать строки по одной, вернуть записанные. Строки, которые не пишутся, логируются и теряются"""
+    for user in users:
+        try:
+            write_batch([user], [])
+        except peewee.PeeweeException as exc:
+            log.error("History user %s dropped: %s", user['id'], exc)
+
+    written = {}
+    for key, row in rows.items():
+        try:
+            write_batch([], [row])
+        except peewee.PeeweeException as exc:
+            log.error("History message %s dropped: %s", key, exc)
+            continue
+        written[key] = row
+    return written
+
+
+def _link_reply(chat_id: int, message_id: int, reply_to_message_id: int):
+    """Проставить reply_to по message_id сообщения, на которое ответили"""
+    reply_to = (
+        models.ChatHistory.select(models.ChatHistory.id)
+        .where(
+            models.ChatHistory.chat == chat_id,
+            models.ChatHistory.message_id == reply_to_message_id,
+        )
+        .limit(1)
+    )
+    models.ChatHistory.update(reply_to=reply_to).where(
+        models.ChatHistory.chat == chat_id,
+        models.ChatHistory.message_id == message_id,
+        models.ChatHistory.reply_to.is_null(),
+    ).execute()
+
+
+class HistoryWriter:
+    """Буфер отложенной записи истории чатов.
+
+    Сообщения и пользователи копятся в памяти и записываются одной транзакцией
+    каждые `flush_size` сообщений или `flush_interval` секунд.
+    Перед чтением истории нужно вызвать `flush`, чтобы увидеть еще не записанные строки.
+    """
+
+    def __init__(
+        self,
+        flush_size: int = config.HISTORY_FLUSH_SIZE,
+        flush_interval: float = config.HISTORY_FLUSH_INTERVAL,
+        attempts: int = config.HISTORY_FLUSH_ATTEMPTS,
+        max_rows: int = config.HISTORY_BUFFER_LIMIT,
+    ):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.attempts = attempts
+        self.max_rows = max_rows
+        self._failures = 0
+        self._users: dict[int, dict] = {}
+        self._rows: dict[tuple[int, int], dict] = {}
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+        self._flush_task: asyncio.Task | None = None
+        # Вызываются после записи с множеством chat_id, в которые пришли сообщения
+        self.listeners: list[typing.Callable[[set[int]], None]] = []
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add_user(self, id: int, **fields):
+        now = datetime.now()
+        # username NOT NULL, а у пользователя его может не быть
+        fields['username'] = fields.get('username') or ''
+        self._users[id] = {'id': id, 'created_at': now, 'updated_at': now, **fields}
+
+    def add_message(self, chat_id: int, message_id: int, text: str, from_user_id: int, reply_to_message_id: int | None):
+        now = datetime.now()
+        self._rows.setdefault(
+            (chat_id, message_id),
+            {
+                'created_at': now,
+                'updated_at': now,
+                'chat': chat_id,
+                'message_id': message_id,
+                'text': text,
+                'from_user': from_user_id,
+                'reply_to_message_id': reply_to_message_id,
+            },
+        )
+        self._schedule()
+
+    @staticmethod
+    def _busy(task: asyncio.Task | None) -> bool:
+        """Задача еще выполняется и это не текущая задача (flush мог вызвать сам таймер)"""
+        return task is not None and not task.done() and task is not asyncio.current_task()
+
+    def _schedule(self):
+        if len(self._rows) >= self.flush_size and not self._busy(self._flush_task):
+            self._flush_task = asyncio.create_task(self.flush())
+        elif not self._busy(self._timer):
+            # запись уже идет - строки, пришедшие во время нее, запишет таймер
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Записать накопленные строки в БД"""
+        async with self._lock:
+            if not self._rows and not self._users:
+                return
+            users, self._users = self._users, {}
+            rows, self._rows = self._rows, {}
+            try:
+                await db_executor.run(write_batch, list(users.values()), list(rows.values()))
+                self._failures = 0
+            except Exception as exc:
+                self._failures += 1
+                if self._failures < self.attempts:
+                    log.error("History flush failed (attempt %s): %s", self._failures, exc)
+                    self._restore(users, rows)
+                    if not self._busy(self._timer):
+                        self._timer = asyncio.create_task(self._flush_later())
+                    return
+                # пачка не пишется несколько раз подряд - пишем по одной строке, плохие строки теряем
+                log.error("History flush failed %s times, writing rows one by one: %s", self._failures, exc)
+                self._failures = 0
+                rows = await db_executor.run(write_each, list(users.values()), rows)
+            log.debug("History flushed: %s messages, %s users", len(rows), len(users))
+            if self._rows:
+                self._schedule()
+
+        chat_ids = {chat_id for chat_id, _ in rows}
+        for listener in self.listeners:
+            listener(chat_ids)
+
+    def _restore(self, users: dict[int, dict], rows: dict[tuple[int, int], dict]):
+        """Вернуть строки в буфер для следующей попытки, при переполнении старые строки теряются"""
+        self._users = users | self._users
+        self._rows = rows | self._rows
+        if (excess := len(self._rows) - self.max_rows) > 0:
+            for key in list(self._rows)[:excess]:
+                del self._rows[key]
+            log.error("History buffer is full, %s messages dropped", excess)
+
+    async def close(self):
+        """Записать остатки буфера (вызывается при остановке бота)"""
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        await self.flush()
+        if self._timer and not self._timer.done():
+            # запись не удалась, повторять уже некому
+            self._timer.cancel()
+
+
+history_writer = HistoryWriter()
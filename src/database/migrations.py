@@ -0,0 +1,121 @@
+"""Миграции схемы БД.
+
+Каждая миграция - функция с номером версии, примененные версии хранятся в
+таблице SchemaVersion. Миграции должны быть идемпотентны: на новой базе
+таблицы и индексы уже созданы через `create_tables`, а на существующей
+connect_db создает только недостающие таблицы, новые индексы и колонки
+старых таблиц добавляют миграции.
+"""
+
+import logging
+import typing
+
+import peewee
+from playhouse.migrate import SqliteMigrator, migrate
+
+from src.database import models
+
+log = logging.getLogger(__name__)
+
+Migration = typing.Callable[[peewee.Database], None]
+MIGRATIONS: dict[int, tuple[str, Migration]] = {}
+
+
+def migration(version: int, name: str) -> typing.Callable[[Migration], Migration]:
+    """Зарегистрировать миграцию с номером версии"""
+
+    def decorator(func: Migration) -> Migration:
+        if version in MIGRATIONS:
+            raise ValueError(f"Migration {version} already registered")
+        MIGRATIONS[version] = (name, func)
+        return func
+
+    return decorator
+
+
+def get_applied_versions() -> set[int]:
+    return set(models.SchemaVersion.select(models.SchemaVersion.version).scalars())
+
+
+def apply_migrations() -> list[int]:
+    """Применить все еще не примененные миграции, вернуть их версии"""
+    db = models.BaseModel._meta.database
+    db.create_tables([models.SchemaVersion], safe=True)
+
+    applied = get_applied_versions()
+    new_versions = []
+    for version in sorted(MIGRATIONS):
+        if version in applied:
+            continue
+
+        name, func = MIGRATIONS[version]
+        log.info("Apply migration %s: %s", version, name)
+        with db.atomic():
+            func(db)
+            models.SchemaVersion.create(version=version, name=name)
+        new_versions.append(version)
+
+    return new_versions
+
+
+@migration(1, "chathistory indexes and unique (chat, message_id)")
+def _chathistory_indexes(db: peewee.Database):
+    # Раньше ответ сохранял копию исходного сообщения, оставляем самую раннюю
+    db.execute_sql(
+        'UPDATE "chathistory" SET "reply_to_id" = ('
+        ' SELECT MIN("kept"."id") FROM "chathistory" AS "kept"'
+        ' JOIN "chathistory" AS "dup"'
+        ' ON "kept"."chat_id" = "dup"."chat_id" AND "kept"."message_id" = "dup"."message_id"'
+        ' WHERE "dup"."id" = "chathistory"."reply_to_id"'
+        ') WHERE "reply_to_id" IS NOT NULL'
+    )
+    db.execute_sql(
+        'DELETE FROM "chathistory" WHERE "id" NOT IN ('
+        ' SELECT MIN("id") FROM "chathistory" GROUP BY "chat_id", "message_id"'
+        ')'
+    )
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "chathistory_chat_id_created_at" ON "chathistory" ("chat_id", "created_at")'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "chathistory_chat_id_message_id" ON "chathistory" ("chat_id", "message_id")'
+    )
+
+
+@migration(2, "conversationmessage table")
+def _conversation_message(db: peewee.Database):
+    db.create_tables([models.ConversationMessage], safe=True)
+
+
+@migration(3, "chatdigest table")
+def _chat_digest(db: peewee.Database):
+    db.create_tables([models.ChatDigest], safe=True)
+
+
+@migration(4, "ratebucket table")
+def _rate_bucket(db: peewee.Database):
+    db.create_tables([models.RateBucket], safe=True)
+
+
+@migration(5, "chat.response_cache column")
+def _chat_response_cache(db: peewee.Database):
+    if "response_cache" in {column.name for column in db.get_columns("chat")}:
+        return
+    migrate(SqliteMigrator(db).add_column("chat", "response_cache", models.Chat.response_cache))
+
+
+@migration(6, "imagejob table")
+def _image_job(db: peewee.Database):
+    db.create_tables([models.ImageJob], safe=True)
+
+
+@migration(7, "importcheckpoint table")
+def _import_checkpoint(db: peewee.Database):
+    db.create_tables([models.ImportCheckpoint], safe=True)
+
+
+@migration(8, "imagejob.output_url column")
+def _image_job_output_url(db: peewee.Database):
+    if "output_url" in {column.name for column in db.get_columns("imagejob")}:
+        return
+    migrate(SqliteMigrator(db).add_column("imagejob", "output_url", models.ImageJob.output_url))
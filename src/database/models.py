@@ -1,16 +1,23 @@
+import time
+from collections.abc import Callable
 from datetime import datetime
 
 import peewee
-from peewee import Model
+from peewee import Model, fn
 from playhouse.sqlite_ext import SqliteExtDatabase
 
 from src import config
-from src.constants import BotMode
+from src.cache import MISSING, TTLCache
+from src.constants import BotMode, JobStatus
 
 sql_lite_db = SqliteExtDatabase(
     config.DB_NAME, regexp_function=True, timeout=3, pragmas={"journal_mode": "wal"}
 )
 
+# Кэш строк Chat (в том числе отсутствующих) и признака админа по id
+chat_cache: TTLCache[int, "Chat | None"] = TTLCache(maxsize=config.CHAT_CACHE_SIZE, ttl=config.CHAT_CACHE_TTL)
+admin_cache: TTLCache[int, bool] = TTLCache(maxsize=config.CHAT_CACHE_SIZE, ttl=config.CHAT_CACHE_TTL)
+
 def get_attr(obj, attr_path):
     """Получить вложенный атрибут по пути (например 'user.username')"""
     attrs = attr_path.split('.')
@@ -34,12 +41,27 @@ class Chat(BaseModel):
     )
     mode = peewee.CharField(default=BotMode.member.value, help_text="Bot mode")
     img_chance = peewee.FloatField(default=0, help_text="Chance to answer with photo")
+    response_cache = peewee.BooleanField(default=False, help_text="Reuse answers to repeated questions")
 
     prompt = peewee.TextField(default=config.DEFAULT_PROMPT)
 
+    @classmethod
+    def get_cached(cls, chat_id: int) -> "Chat | None":
+        """Строка чата из кэша, в БД идем только при промахе.
+
+        Отсутствие чата не кэшируем: его мог добавить другой процесс бота, а кэш у каждого свой.
+        """
+        if (chat := chat_cache.get(chat_id)) is not MISSING:
+            return chat
+        version = chat_cache.version(chat_id)
+        chat = cls.get_or_none(cls.id == chat_id)
+        if chat is not None:
+            chat_cache.set(chat_id, chat, version)
+        return chat
+
     @classmethod
     def is_enable(cls, chat_id: int) -> bool:
-        return bool(cls.get_or_none(cls.id == chat_id))
+        return bool(cls.get_cached(chat_id))
 
     @classmethod
     def set_state(cls, id: int, state: bool) -> bool:
@@ -53,6 +75,7 @@ class Chat(BaseModel):
         if not is_new:
             chat.enable = state
             chat.save()
+        chat_cache.invalidate(id)
 
         return chat.enable
 
@@ -69,6 +92,7 @@ class Chat(BaseModel):
         if not is_new:
             chat.mode = mode.value
             chat.save()
+        chat_cache.invalidate(id)
 
         return chat.mode
 
@@ -86,9 +110,16 @@ class Chat(BaseModel):
         if not is_new:
             chat.prompt = prompt
             chat.save()
+        chat_cache.invalidate(id)
 
         return chat.prompt
 
+    @classmethod
+    def set_response_cache(cls, id: int, enable: bool) -> bool:
+        updated = cls.update(response_cache=enable, updated_at=datetime.now()).where(cls.id == id).execute()
+        chat_cache.invalidate(id)
+        return bool(updated)
+
 
 class BotAdmin(BaseModel):
     id = peewee.IntegerField(primary_key=True)
@@ -96,7 +127,7 @@ class BotAdmin(BaseModel):
 
     @classmethod
     def is_admin(cls, user_id: int) -> bool:
-        return bool(cls.get_or_none(cls.id == user_id))
+        return admin_cache.get_or_set(user_id, lambda: bool(cls.get_or_none(cls.id == user_id)))
 
 class ImagePrompt(BaseModel):
     id = peewee.IntegerField(primary_key=True)
@@ -146,3 +177,157 @@ class ChatHistory(BaseModel):
     text = peewee.TextField()
     from_user = peewee.ForeignKeyField(TGUser, backref='user')
     reply_to = peewee.ForeignKeyField('self', null=True)
+
+    class Meta:
+        # tldr читает последние сообщения чата, импорт ищет сообщение по message_id
+        indexes = (
+            (('chat', 'created_at'), False),
+            (('chat', 'message_id'), True),
+        )
+
+
+class SchemaVersion(BaseModel):
+    version = peewee.IntegerField(primary_key=True)
+    name = peewee.CharField()
+    applied_at = peewee.DateTimeField(default=datetime.now)
+
+
+class ConversationMessage(BaseModel):
+    id = peewee.BigIntegerField(primary_key=True)
+    created_at = peewee.DateTimeField(default=datetime.now)
+    chat_id = peewee.BigIntegerField(index=True)
+    role = peewee.CharField()
+    content = peewee.TextField()
+
+
+class ChatDigest(BaseModel):
+    chat_id = peewee.BigIntegerField(primary_key=True)
+    created_at = peewee.DateTimeField(default=datetime.now)
+    updated_at = peewee.DateTimeField(default=datetime.now)
+    summary = peewee.TextField(default='')
+    last_history_id = peewee.BigIntegerField(default=0, help_text="Last ChatHistory.id folded into summary")
+    message_count = peewee.IntegerField(default=0, help_text="Messages folded into summary")
+
+
+class RateBucket(BaseModel):
+    """Token bucket: запас токенов на момент updated_at, пополняется со скоростью rate в секунду"""
+
+    key = peewee.CharField(primary_key=True)
+    capacity = peewee.FloatField()
+    rate = peewee.FloatField()
+    tokens = peewee.FloatField()
+    updated_at = peewee.FloatField(help_text="Unix time of the last update")
+
+    @classmethod
+    def _level(cls, now: float):
+        return fn.MIN(cls.capacity, cls.tokens + (now - cls.updated_at) * cls.rate)
+
+    @classmethod
+    def consume(cls, buckets: list[tuple[str, float, float]], cost: float = 1, now: float | None = None) -> bool:
+        """Списать cost из всех бакетов (key, capacity, rate) или ни из одного"""
+        now = time.time() if now is None else now
+        with cls._meta.database.atomic() as txn:
+            cls.insert_many(
+                [
+                    {"key": key, "capacity": capacity, "rate": rate, "tokens": capacity, "updated_at": now}
+                    for key, capacity, rate in buckets
+                ]
+            ).on_conflict_ignore().execute()
+            for key, capacity, rate in buckets:
+                # лимиты могли поменяться в конфиге, обновляем их вместе с запасом
+                level = fn.MIN(capacity, cls.tokens + (now - cls.updated_at) * rate)
+                updated = (
+                    cls.update(tokens=level - cost, capacity=capacity, rate=rate, updated_at=now)
+                    .where(cls.key == key, level >= cost)
+                    .execute()
+                )
+                if not updated:
+                    txn.rollback()
+                    return False
+        return True
+
+    @classmethod
+    def refund(cls, keys: list[str], cost: float = 1) -> int:
+        """Вернуть токены, например если операция не удалась"""
+        return (
+            cls.update(tokens=fn.MIN(cls.capacity, cls.tokens + cost))
+            .where(cls.key.in_(keys))
+            .execute()
+        )
+
+    @classmethod
+    def available(cls, key: str, capacity: float, now: float | None = None) -> float:
+        """Текущий запас токенов, для нового бакета - capacity"""
+        now = time.time() if now is None else now
+        level = cls.select(cls._level(now)).where(cls.key == key).scalar()
+        return capacity if level is None else level
+
+    @classmethod
+    def expire(cls, now: float | None = None) -> int:
+        """Удалить заполненные бакеты, они ничем не отличаются от отсутствующих"""
+        now = time.time() if now is None else now
+        return cls.delete().where(cls.tokens + (now - cls.updated_at) * cls.rate >= cls.capacity).execute()
+
+
+class ImageJob(BaseModel):
+    """Задача генерации картинки, очередь переживает перезапуск бота"""
+
+    id = peewee.AutoField()
+    created_at = peewee.DateTimeField(default=datetime.now)
+    updated_at = peewee.DateTimeField(default=datetime.now)
+    kind = peewee.CharField(help_text="JobKind")
+    status = peewee.CharField(default=JobStatus.queued.value, index=True, help_text="JobStatus")
+    chat_id = peewee.BigIntegerField()
+    user_id = peewee.BigIntegerField(null=True)
+    message_id = peewee.BigIntegerField(help_text="Message the result replies to")
+    status_message_id = peewee.BigIntegerField(null=True)
+    prompt = peewee.TextField()
+    translate = peewee.BooleanField(default=False, help_text="Translate prompt before generation")
+    photo_file_id = peewee.CharField(null=True)
+    photo_unique_id = peewee.CharField(null=True)
+    attempts = peewee.IntegerField(default=0)
+    error = peewee.TextField(null=True)
+    output_url = peewee.TextField(null=True, help_text="Generated file, retries only resend it")
+
+    @classmethod
+    def update_job(cls, id: int, **fields) -> int:
+        return cls.update(updated_at=datetime.now(), **fields).where(cls.id == id).execute()
+
+    @classmethod
+    def pending(cls, owned: Callable[[int], bool] | None = None) -> list["ImageJob"]:
+        """Задачи для очереди после перезапуска (owned - фильтр по chat_id), прерванные запускаются заново"""
+        active = [JobStatus.queued.value, JobStatus.running.value]
+        jobs = [
+            job
+            for job in cls.select().where(cls.status.in_(active)).order_by(cls.id)
+            if owned is None or owned(job.chat_id)
+        ]
+        if interrupted := [job.id for job in jobs if job.status == JobStatus.running.value]:
+            cls.update(status=JobStatus.queued.value).where(cls.id.in_(interrupted)).execute()
+        for job in jobs:
+            job.status = JobStatus.queued.value
+        return jobs
+
+    @classmethod
+    def purge(cls, before: datetime) -> int:
+        """Удалить завершенные задачи старше before"""
+        finished = [JobStatus.done.value, JobStatus.failed.value, JobStatus.cancelled.value]
+        return cls.delete().where(cls.status.in_(finished), cls.updated_at < before).execute()
+
+
+class ImportCheckpoint(BaseModel):
+    """Докуда импортирована история чата скриптом load_history"""
+
+    chat_id = peewee.BigIntegerField(primary_key=True)
+    updated_at = peewee.DateTimeField(default=datetime.now)
+    last_message_id = peewee.BigIntegerField(default=0)
+    imported = peewee.IntegerField(default=0, help_text="Messages imported so far")
+
+    @classmethod
+    def save_progress(cls, chat_id: int, last_message_id: int, imported: int):
+        cls.insert(
+            chat_id=chat_id, last_message_id=last_message_id, imported=imported, updated_at=datetime.now()
+        ).on_conflict(
+            conflict_target=[cls.chat_id],
+            preserve=[cls.last_message_id, cls.imported, cls.updated_at],
+        ).execute()
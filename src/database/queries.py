@@ -0,0 +1,102 @@
+"""Асинхронные обертки над запросами к БД для хендлеров.
+
+Все запросы выполняются в потоке `db_executor`, event loop не ждет SQLite.
+"""
+
+from datetime import datetime
+
+from src import config
+from src.cache import MISSING
+from src.constants import BotMode
+from src.database import models, transcript
+from src.database.executor import db_executor
+from src.database.history import history_writer
+
+
+async def is_chat_enable(chat_id: int) -> bool:
+    return bool(await get_chat(chat_id))
+
+
+async def is_admin(user_id: int) -> bool:
+    # При попадании в кэш не переключаемся в поток БД
+    if (value := models.admin_cache.get(user_id)) is not MISSING:
+        return value
+    version = models.admin_cache.version(user_id)
+    value = bool(await db_executor.run(models.BotAdmin.get_or_none, models.BotAdmin.id == user_id))
+    models.admin_cache.set(user_id, value, version)
+    return value
+
+
+async def get_chat(chat_id: int) -> models.Chat | None:
+    if (chat := models.chat_cache.get(chat_id)) is not MISSING:
+        return chat
+    # запись, сбросившая кэш во время чтения, не должна затереться старой строкой
+    version = models.chat_cache.version(chat_id)
+    chat = await db_executor.run(models.Chat.get_or_none, models.Chat.id == chat_id)
+    # отсутствие чата не кэшируем, как в Chat.get_cached
+    if chat is not None:
+        models.chat_cache.set(chat_id, chat, version)
+    return chat
+
+
+async def set_chat_state(chat_id: int, state: bool) -> bool:
+    return await db_executor.run(models.Chat.set_state, chat_id, state)
+
+
+async def set_chat_mode(chat_id: int, mode: BotMode) -> str:
+    return await db_executor.run(models.Chat.set_mode, chat_id, mode)
+
+
+async def set_chat_prompt(chat_id: int, prompt: str) -> str:
+    return await db_executor.run(models.Chat.set_prompt, chat_id, prompt)
+
+
+async def set_chat_response_cache(chat_id: int, enable: bool) -> bool:
+    return await db_executor.run(models.Chat.set_response_cache, chat_id, enable)
+
+
+async def add_chat_to_whitelist(chat_id: int) -> None:
+    return await db_executor.run(models.add_chat_to_whitelist, chat_id)
+
+
+async def get_image_prompts() -> list[models.ImagePrompt]:
+    return await db_executor.run(lambda: list(models.ImagePrompt.select()))
+
+
+async def get_transcript(
+    chat_id: int,
+    limit: int | None = None,
+    after_id: int = 0,
+    newest: bool = True,
+    compact: bool = config.TRANSCRIPT_COMPACT,
+) -> transcript.Transcript:
+    """Транскрипт сообщений чата с id больше after_id в хронологическом порядке.
+
+    newest=True - последние limit сообщений, иначе первые limit.
+    """
+    # Сначала запишем буфер, чтобы увидеть еще не сохраненные сообщения
+    await history_writer.flush()
+    return await db_executor.run(transcript.build_transcript, chat_id, limit, after_id, newest, compact)
+
+
+async def get_digest(chat_id: int) -> models.ChatDigest | None:
+    return await db_executor.run(models.ChatDigest.get_or_none, models.ChatDigest.chat_id == chat_id)
+
+
+async def save_digest(chat_id: int, summary: str, last_history_id: int, message_count: int) -> None:
+    query = models.ChatDigest.insert(
+        chat_id=chat_id,
+        summary=summary,
+        last_history_id=last_history_id,
+        message_count=message_count,
+        updated_at=datetime.now(),
+    ).on_conflict(
+        conflict_target=[models.ChatDigest.chat_id],
+        preserve=[
+            models.ChatDigest.summary,
+            models.ChatDigest.last_history_id,
+            models.ChatDigest.message_count,
+            models.ChatDigest.updated_at,
+        ],
+    )
+    await db_executor.run(query.execute)
@@ -0,0 +1,148 @@
+"""Транскрипт истории чата для промптов суммаризации.
+
+Сообщения выбираются кортежами только с нужными колонками и читаются потоком
+в хронологическом порядке по индексу (chat_id, created_at), без загрузки
+моделей и разворота списка.
+
+Полный формат совпадает с прежним `id | reply_to_id | from_user.username | created_at | text`.
+Компактный формат заменяет id на порядковые номера, имена на короткие псевдонимы
+и время на разницу с предыдущим сообщением, чтобы тратить меньше токенов.
+"""
+
+import dataclasses
+import io
+import typing
+from datetime import datetime
+
+import peewee
+
+from src.database import models
+
+FULL_HEADER = 'id | reply_to_id | from_user.username | created_at | text'
+COMPACT_HEADER = 'n | reply | user | dt | text'
+
+# (id, message_id, reply_to_id, username, created_at, text)
+HistoryTuple = tuple[int, int, int | None, str | None, datetime, str]
+# (message_id, строка транскрипта)
+Row = tuple[int, str]
+
+
+@dataclasses.dataclass
+class Transcript:
+    header: str
+    rows: list[Row]
+    last_id: int = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def text(self) -> str:
+        buffer = io.StringIO()
+        buffer.write(self.header)
+        for _, line in self.rows:
+            buffer.write('\n')
+            buffer.write(line)
+        return buffer.getvalue()
+
+
+def select_history(
+    chat_id: int, limit: int | None = None, after_id: int = 0, newest: bool = True
+) -> typing.Iterator[HistoryTuple]:
+    """Сообщения чата с id больше after_id в хронологическом порядке.
+
+    newest=True - последние limit сообщений, иначе первые limit.
+    """
+    history = models.ChatHistory
+    conditions = [history.chat_id == chat_id]
+    if after_id:
+        conditions.append(history.id > after_id)
+
+    query = (
+        history.select(
+            history.id,
+            history.message_id,
+            history.reply_to,
+            models.TGUser.username,
+            history.created_at,
+            history.text,
+        )
+        .join(models.TGUser)
+        .where(*conditions)
+    )
+    if newest and limit:
+        # Время limit-го с конца сообщения, дальше читаем индекс по возрастанию
+        boundary = (
+            history.select(history.created_at)
+            .where(*conditions)
+            .order_by(history.created_at.desc())
+            .limit(1)
+            .offset(limit - 1)
+        )
+        query = query.where(history.created_at >= peewee.fn.COALESCE(boundary, '')).order_by(
+            history.created_at, history.id
+        )
+    else:
+        query = query.order_by(history.id).limit(limit)
+
+    return query.tuples().iterator()
+
+
+def _delta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'+{seconds}s'
+    if seconds < 3600:
+        return f'+{seconds // 60}m'
+    if seconds < 86400:
+        return f'+{seconds // 3600}h'
+    return f'+{seconds // 86400}d'
+
+
+class TranscriptEncoder:
+    def __init__(self, compact: bool = False):
+        self.compact = compact
+        self._aliases: dict[str | None, str] = {}
+        self._numbers: dict[int, int] = {}
+        self._last_time: datetime | None = None
+
+    @property
+    def header(self) -> str:
+        if not self.compact:
+            return FULL_HEADER
+        legend = ', '.join(f'{alias}={username}' for username, alias in self._aliases.items())
+        return f'users: {legend}\n{COMPACT_HEADER}'
+
+    def encode_row(self, row: HistoryTuple) -> str:
+        id, _, reply_to_id, username, created_at, text = row
+        if not self.compact:
+            return f'{id} | {reply_to_id} | {username} | {created_at} | {text}'
+
+        number = self._numbers[id] = len(self._numbers) + 1
+        reply = self._numbers.get(reply_to_id, '') if reply_to_id else ''
+        alias = self._aliases.setdefault(username, f'u{len(self._aliases) + 1}')
+        when = self._when(created_at)
+        self._last_time = created_at
+        return f'{number} | {reply} | {alias} | {when} | {text}'
+
+    def _when(self, created_at: datetime) -> str:
+        if self._last_time is None:
+            return created_at.strftime('%Y-%m-%d %H:%M') if isinstance(created_at, datetime) else str(created_at)
+        try:
+            return _delta((created_at - self._last_time).total_seconds())
+        except TypeError:
+            # Строка в БД в нестандартном формате или время с таймзоной вперемешку с наивным
+            return str(created_at)
+
+    def encode(self, rows: typing.Iterable[HistoryTuple]) -> Transcript:
+        encoded = []
+        last_id = 0
+        for row in rows:
+            encoded.append((row[1], self.encode_row(row)))
+            last_id = max(last_id, row[0])
+        return Transcript(self.header, encoded, last_id)
+
+
+def build_transcript(
+    chat_id: int, limit: int | None = None, after_id: int = 0, newest: bool = True, compact: bool = False
+) -> Transcript:
+    return TranscriptEncoder(compact).encode(select_history(chat_id, limit, after_id, newest))
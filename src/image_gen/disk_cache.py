@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+_SAFE_KEY = re.compile(r"[\w-]{1,64}")
+
+
+class DiskLRU:
+    """Файлы на диске с ограничением суммарного размера, вытесняются давно не использованные.
+
+    Порядок использования восстанавливается при старте по mtime файлов.
+    Методы блокирующие, из event loop их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        if not _SAFE_KEY.fullmatch(key):
+            key = hashlib.sha256(key.encode()).hexdigest()
+        return self.directory / key
+
+    def _index(self) -> OrderedDict[str, int]:
+        if self._files is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            entries = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            self._files = OrderedDict((entry.name, entry.stat().st_size) for entry in entries)
+            self._size = sum(self._files.values())
+        return self._files
+
+    def get(self, key: str) -> Path | None:
+        path = self._path(key)
+        with self._lock:
+            files = self._index()
+            if path.name not in files:
+                return None
+            if not path.exists():
+                self._size -= files.pop(path.name)
+                return None
+            files.move_to_end(path.name)
+        os.utime(path)
+        return path
+
+    def put(self, key: str, data: bytes | bytearray) -> Path:
+        path = self._path(key)
+        tmp = path.with_name(f"{path.name}.tmp")
+        with self._lock:
+            files = self._index()
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            self._size += len(data) - files.pop(path.name, 0)
+            files[path.name] = len(data)
+            self._evict(files)
+        return path
+
+    def _evict(self, files: OrderedDict[str, int]):
+        while self._size > self.max_bytes and len(files) > 1:
+            name, size = files.popitem(last=False)
+            self._size -= size
+            (self.directory / name).unlink(missing_ok=True)
+            log.debug("Evicted %s from %s", name, self.directory)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index())
+
+    @property
+    def size(self) -> int:
+        return self._size
@@ -1,31 +1,70 @@
 import logging
-from io import BytesIO
+from pathlib import Path
 
+import httpx
 from replicate.client import Client
+from replicate.helpers import FileOutput
 
-from src import config
+from src import config, metrics, tracing
 
 log = logging.getLogger(__name__)
 
 class ImageGenerator:
-    def __init__(self, api_token: str | None = None):
+    def __init__(self, api_token: str | None = None, pool_size: int = config.IMAGE_POOL_SIZE):
         """
-        Инициализация генератора изображений
-        :param api_token: API токен Hugging Face (если не указан, берется из конфига)
+        Инициализация генератора изображений.
+        Создается один раз при старте бота: клиент держит пул keep-alive соединений с Replicate.
+        :param api_token: API токен Replicate (если не указан, берется из конфига)
+        :param pool_size: Размер пула соединений
         """
-        self.replicate = Client(api_token=api_token or config.REPLICATE_API_TOKEN)
+        self.replicate = Client(
+            api_token=api_token or config.REPLICATE_API_TOKEN,
+            timeout=httpx.Timeout(config.IMAGE_TIMEOUT, connect=config.IMAGE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=60,
+            ),
+        )
+
+    async def aclose(self):
+        """Закрыть пулы соединений клиента (вызывается при остановке бота)"""
+        # Client создает httpx клиенты лениво и не умеет их закрывать. Свои клиенты ему не передать:
+        # sync и async клиент строятся из одних kwargs, поэтому закрываем его приватные атрибуты.
+        # Они есть в replicate==1.0.4 (версия зафиксирована в pyproject), test_generator_closed
+        # проверяет это при обновлении.
+        if async_client := getattr(self.replicate, "_Client__async_client", None):
+            await async_client.aclose()
+        if client := getattr(self.replicate, "_Client__client", None):
+            client.close()
+
+
+    def _file_output(self, output) -> FileOutput | None:
+        """Первый файл из результата модели (модели отдают файл, список файлов или URL)"""
+        if isinstance(output, list):
+            output = output[0] if output else None
+        if isinstance(output, str):
+            output = FileOutput(output, self.replicate)
+        if not isinstance(output, FileOutput):
+            log.error(f"Unexpected model output: {output!r}")
+            return None
+        return output
 
+    async def read(self, output: FileOutput) -> bytes:
+        """Скачать результат через общий пул соединений"""
+        return await output.aread()
 
-    async def generate_image(self, prompt: str) -> bytes | None:
+    @metrics.timed(metrics.replicate_seconds, metrics.call_errors, empty_is_error=True, call="generate_image")
+    @tracing.traced("replicate:generate_image")
+    async def generate_image(self, prompt: str) -> FileOutput | None:
         """
         Генерация изображения по текстовому описанию через Stable Diffusion
         :param prompt: Текстовое описание желаемого изображения
-        :return: Байты изображения или None в случае ошибки
+        :return: Файл результата (URL и чтение по запросу) или None в случае ошибки
         """
         log.debug(f'Prompt for image {prompt}')
 
         try:
-            # Возвращаем байты изображения напрямую
             response = await self.replicate.async_run(
                 config.IMAGE_MODEL,
                 input={"prompt": prompt},
@@ -35,27 +74,27 @@ class ImageGenerator:
             log.error(f"Error generating image: {e!s}")
             return None
 
-        image_bytes = response.read()  # bytes
-
-        image_io = BytesIO(image_bytes)
-        image_io.name = "yahoo.png"  # нужно имя файла
-
-        return image_io
+        # Не скачиваем результат здесь: по URL его может забрать сам Telegram
+        return self._file_output(response)
 
-    async def generate_image_from_photo(self, prompt: str, photo_url: str | None) -> BytesIO | None:
+    @metrics.timed(
+        metrics.replicate_seconds, metrics.call_errors, empty_is_error=True, call="generate_image_from_photo"
+    )
+    @tracing.traced("replicate:generate_image_from_photo")
+    async def generate_image_from_photo(self, prompt: str, photo: Path | str | None) -> FileOutput | None:
             """
             Generate an image based on a prompt and input photo using Replicate
             :param prompt: Text prompt for image modification
-            :param photo_url: URL of the input image
-            :return: BytesIO of the generated image or None in case of error
+            :param photo: Local file of the input image (uploaded by the client) or its URL
+            :return: File output of the generated image or None in case of error
             """
-            log.debug(f'Prompt for image {prompt}, photo URL: {photo_url}')
+            log.debug(f'Prompt for image {prompt}, photo: {photo}')
 
             try:
                 # Prepare input for Replicate model that accepts image and prompt
                 input_data = {
                     "prompt": prompt,
-                    "image_input": [photo_url] if photo_url else [],
+                    "image_input": [photo] if photo else [],
                 }
 
                 response = await self.replicate.async_run(
@@ -67,11 +106,4 @@ class ImageGenerator:
                 log.error(f"Error generating image from photo: {e!s}")
                 return None
 
-            # Read the response as bytes
-            image_bytes = response.read()  # bytes
-
-            # Create BytesIO object for Telegram
-            image_io = BytesIO(image_bytes)
-            image_io.name = "generated_image.jpg"  # needs a file name
-
-            return image_io
+            return self._file_output(response)
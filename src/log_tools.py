@@ -1,8 +1,15 @@
+import glob
 import logging
 import logging.config
+import logging.handlers
 import os
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+# JSON lines of src.tracing, the file is created on the first written trace
+TRACE_FILE = os.getenv("TRACE_FILE", "sqlite_db/traces.jsonl")
+# Size of a traces file before rotation and rotated files kept, per process
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_FILE_BACKUPS = 2
 
 LOG_SETTINGS = {
     "version": 1,
@@ -11,11 +18,23 @@ LOG_SETTINGS = {
         "default": {
             "()": "logging.Formatter",
             "format": "%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-        }
+        },
+        "message": {"format": "%(message)s"},
+    },
+    "handlers": {
+        "default": {"class": "logging.StreamHandler", "formatter": "default"},
+        "traces": {
+            "class": "logging.handlers.RotatingFileHandler",
+            "formatter": "message",
+            "filename": TRACE_FILE,
+            "maxBytes": TRACE_FILE_MAX_BYTES,
+            "backupCount": TRACE_FILE_BACKUPS,
+            "delay": True,
+        },
     },
-    "handlers": {"default": {"class": "logging.StreamHandler", "formatter": "default"}},
     "loggers": {
         "src": {"level": LOG_LEVEL, "handlers": ["default"]},
+        "traces": {"level": "INFO", "handlers": ["traces"], "propagate": False},
     },
 }
 
@@ -23,3 +42,18 @@ LOG_SETTINGS = {
 logging.config.dictConfig(LOG_SETTINGS)
 # apply logging level for already loaded loggers
 logging.getLogger().setLevel(LOG_LEVEL)
+
+
+def use_trace_file(suffix: str):
+    """Писать трассы процесса в свой файл: ротацию одного файла несколько процессов не поделят"""
+    root, ext = os.path.splitext(TRACE_FILE)
+    for handler in logging.getLogger("traces").handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+            handler.baseFilename = os.path.abspath(f"{root}.{suffix}{ext}")
+
+
+def trace_files() -> list[str]:
+    """Файлы трасс всех процессов вместе с ротированными"""
+    root, ext = os.path.splitext(TRACE_FILE)
+    return sorted(glob.glob(f"{root}*{ext}*"))
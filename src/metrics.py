@@ -0,0 +1,313 @@
+"""Метрики в текстовом формате Prometheus.
+
+Счетчики и гистограммы обновляются по ходу работы, в основном декораторами
+timed и handler. Значения очередей и кэшей снимаются gauge-функциями в момент
+запроса /metrics. Каждый процесс отдает свои метрики: диспетчер и одиночный
+бот на METRICS_PORT, воркеры - на METRICS_PORT + 1 + номер воркера.
+"""
+
+import abc
+import functools
+import inspect
+import logging
+import threading
+import time
+import typing
+from collections.abc import Callable, Iterable
+
+from aiohttp import web
+
+from src import config, tracing
+
+log = logging.getLogger(__name__)
+
+LabelValues = tuple[str, ...]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # обновляются и из event loop, и из потока БД
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        """(суффикс имени, метки, значение)"""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [("", _format_labels(self.labels, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> (счетчики по корзинам, сумма, количество)
+        self._values: dict[LabelValues, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        item = self._values.get(self._key(labels))
+        return item[2] if item else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels((*self.labels, "le"), (*key, _format_value(float(bound))))
+                samples.append(("_bucket", labels, cumulative))
+            samples.append(("_bucket", _format_labels((*self.labels, "le"), (*key, "+Inf")), count))
+            samples.append(("_sum", _format_labels(self.labels, key), total))
+            samples.append(("_count", _format_labels(self.labels, key), count))
+        return samples
+
+
+class Gauge(Metric):
+    """Значения снимаются функцией collect при каждом запросе метрик.
+
+    collect возвращает число или словарь {значения меток: число}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect: Callable[[], typing.Any], labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            return [("", "", values)]
+        return [
+            ("", _format_labels(self.labels, key if isinstance(key, tuple) else (key,)), value)
+            for key, value in values.items()
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # повторная регистрация (перезагрузка модуля, тесты) заменяет метрику
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], typing.Any], labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, collect, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                log.exception("Metric %s not collected", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram("bot_handler_seconds", "Telegram handler duration", ["handler"])
+handler_errors = registry.counter("bot_handler_errors_total", "Telegram handler exceptions", ["handler"])
+openai_seconds = registry.histogram("openai_request_seconds", "OpenAI call duration", ["call"])
+openai_tokens = registry.counter("openai_tokens_total", "OpenAI tokens", ["model", "kind"])
+replicate_seconds = registry.histogram("replicate_request_seconds", "Replicate call duration", ["call"])
+call_errors = registry.counter("external_call_errors_total", "Failed OpenAI and Replicate calls", ["call"])
+db_seconds = registry.histogram(
+    "db_query_seconds", "SQLite query duration by query name", ["query"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+
+
+def timed(histogram: Histogram, errors: Counter | None = None, empty_is_error: bool = False, **labels: str):
+    """Декоратор: длительность вызова в histogram, исключения (и None при empty_is_error) в errors.
+
+    Работает с обычными функциями, корутинами и асинхронными генераторами
+    (для генератора - время до конца итерации).
+    """
+
+    def decorator(func):
+        def record(start: float, failed: bool):
+            histogram.observe(time.perf_counter() - start, **labels)
+            if failed and errors is not None:
+                errors.inc(**labels)
+
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            async def gen_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    async for item in func(*args, **kwargs):
+                        yield item
+                    failed = False
+                except GeneratorExit:
+                    # потребитель закончил итерацию раньше
+                    failed = False
+                    raise
+                finally:
+                    record(start, failed)
+
+            return gen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = None
+                failed = True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(start, failed or (empty_is_error and result is None))
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record(start, failed or (empty_is_error and result is None))
+
+        return wrapper
+
+    return decorator
+
+
+def handler(func):
+    """Декоратор хендлера Telegram: латентность и ошибки с меткой handler=имя функции, span трассы"""
+    traced = tracing.traced(f"handler:{func.__name__}")(func)
+    return timed(handler_seconds, handler_errors, handler=func.__name__)(traced)
+
+
+def query_name(func: Callable) -> str:
+    """Имя запроса для db_query_seconds: Модель.метод или имя функции"""
+    while isinstance(func, functools.partial):
+        func = func.func
+    owner = getattr(func, "__self__", None)
+    if isinstance(owner, type):
+        return f"{owner.__name__}.{func.__name__}"
+    return getattr(func, "__qualname__", repr(func))
+
+
+def cache_stats(caches: dict[str, typing.Any]) -> list[Gauge]:
+    """Размер и доля попаданий кэшей с методом stats() (TTLCache, ResponseCache)"""
+    return [
+        registry.gauge(
+            "cache_size", "Cache entries", lambda: {name: cache.stats()["size"] for name, cache in caches.items()},
+            ["cache"],
+        ),
+        registry.gauge(
+            "cache_hit_ratio", "Cache hit ratio since start",
+            lambda: {name: cache.stats()["hit_rate"] for name, cache in caches.items()}, ["cache"],
+        ),
+    ]
+
+
+class MetricsServer:
+    def __init__(self, registry: Registry = registry):
+        self.registry = registry
+        self._runner: web.AppRunner | None = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, port: int, host: str = config.METRICS_HOST):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError as exc:
+            # без метрик бот работает дальше
+            log.error("Metrics server not started on %s:%s: %s", host, port, exc)
+            await self.stop()
+            return
+        log.info("Metrics on http://%s:%s/metrics", host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
@@ -1,63 +1,74 @@
+import asyncio
 import logging
 import typing
-from collections import defaultdict, deque
-from functools import partial
 
+import aiohttp
 import openai
 
-from src import config
+from src import config, metrics, tracing
+from src.open_ai import tokens
+from src.open_ai.conversation import create_store
+from src.open_ai.response_cache import response_cache
+from src.scheduler import Priority, llm_scheduler
 
 log = logging.getLogger(__name__)
 MIN_LEN_RESPONSE = 15
 ERROR_MESSAGE = "Something wrong, retry"
-CHAT_CONVERSATION = defaultdict(
-    partial(deque, iterable=[], maxlen=config.MAX_HISTORY_LEN)
-)
+CHAT_CONVERSATION = create_store(config.CONVERSATION_STORE)
 
 openai.api_key = config.OPEN_AI_TOKEN
 
+# Shared aiohttp pool for async requests, recreated if the event loop changes
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+
 
 def get_conversation_by_id(id: int) -> typing.Iterable[dict[str, str]]:
-    return CHAT_CONVERSATION[id]
+    return CHAT_CONVERSATION.get(id)
 
 
 def append_to_conversation(id: int, messages: list[dict[str, str]]):
-    for message in messages:
-        CHAT_CONVERSATION[id].append(message)
-    return CHAT_CONVERSATION[id]
+    return CHAT_CONVERSATION.append(id, messages)
 
 
 def clear_conversation(id: int):
-    CHAT_CONVERSATION[id] = deque(iterable=[], maxlen=config.MAX_HISTORY_LEN)
+    CHAT_CONVERSATION.clear(id)
 
 
-def get_answer(prompt: str, message: str, conversation_id: int | None, model=config.AI_MODEL) -> str:
-    message_text = [
-        {
-            "role": "system",
-            "content": prompt,
-        }
-    ]
-    if conversation_id:
-        for conversation_message in get_conversation_by_id(conversation_id):
-            message_text.append(conversation_message)
-
-    # Add user message to request
-    message_text.append(
-        {
-            "role": "user",
-            "content": message,
-        }
-    )
-    try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=message_text,
+def _get_session() -> aiohttp.ClientSession:
+    """Вернуть общий пул соединений для текущего event loop"""
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.OPEN_AI_POOL_SIZE, keepalive_timeout=60),
         )
-    except Exception as exc:
-        log.error(exc)
-        return ERROR_MESSAGE
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    """Закрыть пул соединений (вызывается при остановке бота)"""
+    global _session, _session_loop
 
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = _session_loop = None
+
+
+def _build_messages(prompt: str, message: str, conversation_id: int | None, model: str) -> list[dict[str, str]]:
+    history = list(get_conversation_by_id(conversation_id)) if conversation_id else []
+    return tokens.build_messages(prompt, message, history, model)
+
+
+async def _abuild_messages(prompt: str, message: str, conversation_id: int | None, model: str) -> list[dict[str, str]]:
+    """_build_messages, диалог загружается в потоке БД"""
+    history = await CHAT_CONVERSATION.aget(conversation_id) if conversation_id else []
+    return tokens.build_messages(prompt, message, history, model)
+
+
+def _process_response(response, message: str, conversation_id: int | None) -> str:
     result = ""
     for choice in response.choices:
         result += choice.message.content
@@ -68,6 +79,11 @@ def get_answer(prompt: str, message: str, conversation_id: int | None, model=con
     if len(result) < MIN_LEN_RESPONSE and "No content" in result:
         return ""
 
+    _append_answer(conversation_id, message, result)
+    return result
+
+
+def _append_answer(conversation_id: int | None, message: str, result: str):
     if conversation_id:
         append_to_conversation(
             conversation_id,
@@ -77,4 +93,161 @@ def get_answer(prompt: str, message: str, conversation_id: int | None, model=con
             ],
         )
 
+
+def _count_tokens(model: str, messages: list[dict[str, str]], result: str, usage: dict | None = None):
+    """Токены запроса и ответа: из usage ответа API, для потока - оценка"""
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+    else:
+        prompt_tokens = sum(tokens.message_tokens(message, model) for message in messages)
+        completion_tokens = tokens.count_tokens(result, model)
+    metrics.openai_tokens.inc(prompt_tokens, model=model, kind="prompt")
+    metrics.openai_tokens.inc(completion_tokens, model=model, kind="completion")
+
+
+@metrics.timed(metrics.openai_seconds, call="get_answer")
+@tracing.traced("openai:get_answer")
+def get_answer(prompt: str, message: str, conversation_id: int | None, model=config.AI_MODEL) -> str:
+    message_text = _build_messages(prompt, message, conversation_id, model)
+    try:
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=message_text,
+        )
+    except Exception as exc:
+        log.error(exc)
+        metrics.call_errors.inc(call="get_answer")
+        return ERROR_MESSAGE
+
+    result = _process_response(response, message, conversation_id)
+    _count_tokens(model, message_text, result, response.get("usage"))
+    return result
+
+
+def _scheduler_key(chat_id: int | None, conversation_id: int | None) -> int:
+    return chat_id if chat_id is not None else conversation_id or 0
+
+
+@metrics.timed(metrics.openai_seconds, call="aget_answer")
+@tracing.traced("openai:aget_answer")
+async def aget_answer(
+    prompt: str,
+    message: str,
+    conversation_id: int | None,
+    model=config.AI_MODEL,
+    chat_id: int | None = None,
+    priority: Priority = Priority.HIGH,
+    cache: bool = False,
+) -> str:
+    """Асинхронный вариант get_answer, не блокирует event loop.
+
+    Запрос ждет слота в llm_scheduler: chat_id (по умолчанию conversation_id)
+    определяет очередь чата, priority - очередность относительно других запросов.
+    С cache=True ответ на такой же или почти такой же вопрос берется из response_cache.
+    """
+    if cache and (answer := response_cache.get(prompt, message, model)):
+        if conversation_id:
+            await CHAT_CONVERSATION.aget(conversation_id)
+        _append_answer(conversation_id, message, answer)
+        return answer
+
+    message_text = await _abuild_messages(prompt, message, conversation_id, model)
+    session = _get_session()
+    try:
+        async with llm_scheduler.slot(_scheduler_key(chat_id, conversation_id), priority):
+            # openai берет сессию из ContextVar, выставляем ее в контексте текущей задачи
+            openai.aiosession.set(session)
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=message_text,
+                request_timeout=(config.OPEN_AI_CONNECT_TIMEOUT, config.OPEN_AI_TIMEOUT),
+            )
+    except Exception as exc:
+        log.error(exc)
+        metrics.call_errors.inc(call="aget_answer")
+        return ERROR_MESSAGE
+
+    result = _process_response(response, message, conversation_id)
+    _count_tokens(model, message_text, result, response.get("usage"))
+    if cache and result:
+        response_cache.set(prompt, message, model, result)
     return result
+
+
+@metrics.timed(metrics.openai_seconds, call="astream_answer")
+@tracing.traced("openai:astream_answer")
+async def astream_answer(
+    prompt: str,
+    message: str,
+    conversation_id: int | None,
+    model=config.AI_MODEL,
+    chat_id: int | None = None,
+    priority: Priority = Priority.HIGH,
+    cache: bool = False,
+) -> typing.AsyncIterator[str]:
+    """Потоковый вариант aget_answer, отдает ответ частями по мере генерации"""
+    if cache and (answer := response_cache.get(prompt, message, model)):
+        if conversation_id:
+            await CHAT_CONVERSATION.aget(conversation_id)
+        _append_answer(conversation_id, message, answer)
+        yield answer
+        return
+
+    message_text = await _abuild_messages(prompt, message, conversation_id, model)
+    session = _get_session()
+    deltas: asyncio.Queue[str | None] = asyncio.Queue()
+
+    async def read():
+        """Читает поток в очередь: слот планировщика держится, пока идет ответ API, а не пока его показывают"""
+        try:
+            async with llm_scheduler.slot(_scheduler_key(chat_id, conversation_id), priority):
+                openai.aiosession.set(session)
+                response = await openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=message_text,
+                    stream=True,
+                    request_timeout=(config.OPEN_AI_CONNECT_TIMEOUT, config.OPEN_AI_TIMEOUT),
+                )
+                async for chunk in response:
+                    for choice in chunk.choices:
+                        if delta := choice.delta.get("content"):
+                            deltas.put_nowait(delta)
+        finally:
+            deltas.put_nowait(None)
+
+    reader = asyncio.create_task(read())
+    result = ""
+    # начало ответа придерживаем, пока не ясно, что это не "No content"
+    pending = ""
+    try:
+        while (delta := await deltas.get()) is not None:
+            result += delta
+            pending += delta
+            if len(result) >= MIN_LEN_RESPONSE:
+                yield pending
+                pending = ""
+        await reader
+    except Exception as exc:
+        log.error(exc)
+        metrics.call_errors.inc(call="astream_answer")
+        if not result:
+            yield ERROR_MESSAGE
+        elif pending:
+            yield pending
+        return
+    finally:
+        # потребитель перестал читать (ответ отменен)
+        reader.cancel()
+
+    if len(result.strip()) < MIN_LEN_RESPONSE and "No content" in result:
+        return
+    if pending:
+        yield pending
+
+    result = result.strip()
+    log.debug("result: %s", result)
+    _count_tokens(model, message_text, result)
+    if result:
+        _append_answer(conversation_id, message, result)
+        if cache:
+            response_cache.set(prompt, message, model, result)
@@ -0,0 +1,165 @@
+"""Хранилища истории диалога бота с чатом.
+
+Интерфейс `ConversationStore` с двумя реализациями: в памяти процесса (LRU
+с вытеснением неактивных чатов) и в SQLite, переживающая перезапуск.
+"""
+
+import abc
+import logging
+from collections import deque
+
+from src import config
+from src.cache import MISSING, TTLCache
+from src.database import models
+from src.database.executor import db_executor
+
+log = logging.getLogger(__name__)
+
+Message = dict[str, str]
+
+
+class ConversationStore(abc.ABC):
+    def __init__(self, maxlen: int = config.MAX_HISTORY_LEN):
+        self.maxlen = maxlen
+
+    @abc.abstractmethod
+    def get(self, id: int) -> list[Message]:
+        """Последние сообщения диалога, от старых к новым"""
+
+    async def aget(self, id: int) -> list[Message]:
+        """Асинхронный вариант get, не блокирует event loop"""
+        return self.get(id)
+
+    @abc.abstractmethod
+    def append(self, id: int, messages: list[Message]) -> list[Message]:
+        """Добавить сообщения в диалог, вернуть диалог"""
+
+    @abc.abstractmethod
+    def clear(self, id: int):
+        """Очистить диалог"""
+
+
+class MemoryConversationStore(ConversationStore):
+    """Диалоги в памяти процесса.
+
+    Хранится не больше `max_chats` чатов, чат без активности дольше `idle_ttl`
+    секунд вытесняется.
+    """
+
+    def __init__(
+        self,
+        maxlen: int = config.MAX_HISTORY_LEN,
+        max_chats: int = config.CONVERSATION_MAX_CHATS,
+        idle_ttl: float = config.CONVERSATION_IDLE_TTL,
+    ):
+        super().__init__(maxlen)
+        self.chats: TTLCache[int, deque[Message]] = TTLCache(maxsize=max_chats, ttl=idle_ttl)
+
+    def __len__(self) -> int:
+        return len(self.chats)
+
+    def __contains__(self, id: int) -> bool:
+        return self.chats.get(id) is not MISSING
+
+    def get(self, id: int) -> list[Message]:
+        conversation = self.chats.get(id)
+        return [] if conversation is MISSING else list(conversation)
+
+    def set(self, id: int, messages: list[Message]):
+        self.chats.set(id, deque(messages, maxlen=self.maxlen))
+
+    def append(self, id: int, messages: list[Message]) -> list[Message]:
+        conversation = self.chats.get(id)
+        if conversation is MISSING:
+            conversation = deque(maxlen=self.maxlen)
+        conversation.extend(messages)
+        # Перезаписываем, чтобы продлить время жизни активного чата
+        self.chats.set(id, conversation)
+        return list(conversation)
+
+    def clear(self, id: int):
+        self.chats.invalidate(id)
+
+
+class SqliteConversationStore(ConversationStore):
+    """Диалоги в таблице ConversationMessage рядом с ChatHistory.
+
+    В ChatHistory нет ответов бота, поэтому реплики диалога хранятся отдельно.
+    Чтение идет из кэша в памяти, диалог загружается из БД при первом обращении
+    к чату. Запись уходит в поток БД и не задерживает ответ.
+
+    Кэш у каждого процесса свой и из БД повторно не читается, поэтому диалог
+    одного чата должен вести один процесс (диспетчер распределяет чаты по
+    воркерам по chat_id).
+    """
+
+    def __init__(
+        self,
+        maxlen: int = config.MAX_HISTORY_LEN,
+        max_chats: int = config.CONVERSATION_MAX_CHATS,
+        idle_ttl: float = config.CONVERSATION_IDLE_TTL,
+    ):
+        super().__init__(maxlen)
+        self.cache = MemoryConversationStore(maxlen, max_chats, idle_ttl)
+
+    def _load(self, id: int) -> list[Message]:
+        rows = (
+            models.ConversationMessage.select(models.ConversationMessage.role, models.ConversationMessage.content)
+            .where(models.ConversationMessage.chat_id == id)
+            .order_by(models.ConversationMessage.id.desc())
+            .limit(self.maxlen)
+            .dicts()
+        )
+        return list(reversed(list(rows)))
+
+    def get(self, id: int) -> list[Message]:
+        if id not in self.cache:
+            self.cache.set(id, self._load(id))
+        return self.cache.get(id)
+
+    async def aget(self, id: int) -> list[Message]:
+        if id not in self.cache:
+            messages = await db_executor.run(self._load, id)
+            # пока шла загрузка, в диалог могли дописать
+            if id not in self.cache:
+                self.cache.set(id, messages)
+        return self.cache.get(id)
+
+    def append(self, id: int, messages: list[Message]) -> list[Message]:
+        self.get(id)
+        db_executor.submit(self._save, id, messages)
+        return self.cache.append(id, messages)
+
+    def _save(self, id: int, messages: list[Message]):
+        with models.BaseModel._meta.database.atomic():
+            models.ConversationMessage.insert_many(
+                [{"chat_id": id, "role": message["role"], "content": message["content"]} for message in messages]
+            ).execute()
+            # Старше maxlen реплик нам не понадобятся
+            keep = (
+                models.ConversationMessage.select(models.ConversationMessage.id)
+                .where(models.ConversationMessage.chat_id == id)
+                .order_by(models.ConversationMessage.id.desc())
+                .limit(self.maxlen)
+            )
+            models.ConversationMessage.delete().where(
+                models.ConversationMessage.chat_id == id,
+                models.ConversationMessage.id.not_in(keep),
+            ).execute()
+
+    def clear(self, id: int):
+        self.cache.set(id, [])
+        db_executor.submit(
+            models.ConversationMessage.delete().where(models.ConversationMessage.chat_id == id).execute
+        )
+
+
+STORES: dict[str, type[ConversationStore]] = {
+    "memory": MemoryConversationStore,
+    "sqlite": SqliteConversationStore,
+}
+
+
+def create_store(name: str = config.CONVERSATION_STORE) -> ConversationStore:
+    log.info("Conversation store: %s", name)
+    return STORES[name]()
@@ -0,0 +1,128 @@
+"""Скользящее краткое содержание чатов.
+
+Фоновая задача каждые DIGEST_EVERY новых сообщений сворачивает их в хранимое
+содержание чата (ChatDigest). /tldr отвечает по содержанию и хвосту еще не
+свернутых сообщений вместо всей истории.
+"""
+
+import asyncio
+import contextlib
+import logging
+
+from src import config
+from src.database import queries
+from src.database.history import history_writer
+from src.open_ai import chat_gpt, summarize
+from src.open_ai.tokens import count_tokens, get_token_budget
+from src.scheduler import Priority
+
+log = logging.getLogger(__name__)
+
+
+def _digest_message(summary: str, transcript: str) -> str:
+    return f"Текущее содержание:\n{summary or '-'}\n\nНовые сообщения:\n{transcript}"
+
+
+class DigestUpdater:
+    def __init__(
+        self,
+        every: int = config.DIGEST_EVERY,
+        interval: float = config.DIGEST_INTERVAL,
+        batch: int = config.DIGEST_BATCH,
+        model: str = config.SUMARIZE_MODEL,
+    ):
+        self.every = every
+        self.interval = interval
+        self.batch = batch
+        self.model = model
+        self._dirty: set[int] = set()
+        self._task: asyncio.Task | None = None
+
+    def mark_dirty(self, chat_ids: set[int]):
+        self._dirty.update(chat_ids)
+
+    def start(self):
+        history_writer.listeners.append(self.mark_dirty)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.mark_dirty in history_writer.listeners:
+            history_writer.listeners.remove(self.mark_dirty)
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            dirty, self._dirty = self._dirty, set()
+            for chat_id in dirty:
+                try:
+                    await self.update(chat_id)
+                except Exception as exc:
+                    log.error("Digest update for %s failed: %s", chat_id, exc)
+
+    async def update(self, chat_id: int) -> bool:
+        """Свернуть новые сообщения чата в содержание, если их накопилось достаточно"""
+        stored = await queries.get_digest(chat_id)
+        if stored:
+            history = await queries.get_transcript(chat_id, self.batch, after_id=stored.last_history_id, newest=False)
+        else:
+            # Для нового чата начинаем с последних сообщений, а не со всей истории
+            history = await queries.get_transcript(chat_id, self.batch)
+
+        if len(history) < self.every:
+            return False
+
+        summary = stored.summary if stored else ''
+        transcript = history.text()
+        if count_tokens(transcript, self.model) > get_token_budget(self.model) // 2:
+            transcript = await summarize.summarize_history(
+                chat_id, history.header, history.rows, self.model, Priority.LOW
+            )
+
+        answer = await chat_gpt.aget_answer(
+            prompt=config.DIGEST_PROMPT,
+            message=_digest_message(summary, transcript),
+            conversation_id=None,
+            model=self.model,
+            chat_id=chat_id,
+            priority=Priority.LOW,
+        )
+        if not answer or answer == chat_gpt.ERROR_MESSAGE:
+            return False
+
+        message_count = (stored.message_count if stored else 0) + len(history)
+        await queries.save_digest(chat_id, answer, history.last_id, message_count)
+        log.info("Digest for %s updated: %s messages", chat_id, message_count)
+
+        if len(history) == self.batch:
+            # Остались еще не свернутые сообщения
+            self._dirty.add(chat_id)
+        return True
+
+
+async def tldr_from_digest(chat_id: int) -> str | None:
+    """Ответ /tldr по содержанию и хвосту новых сообщений, None если содержания еще нет"""
+    stored = await queries.get_digest(chat_id)
+    if not stored or not stored.summary:
+        return None
+
+    model = config.SUMARIZE_MODEL
+    tail = await queries.get_transcript(chat_id, config.DIGEST_TAIL_LIMIT, after_id=stored.last_history_id)
+    transcript = tail.text()
+    # Как при свертке: хвост, который не влезает в запрос, сначала пересказываем по частям
+    if count_tokens(transcript, model) > get_token_budget(model) // 2:
+        transcript = await summarize.summarize_history(chat_id, tail.header, tail.rows, model)
+    return await chat_gpt.aget_answer(
+        prompt=config.DIGEST_TLDR_PROMPT,
+        message=_digest_message(stored.summary, transcript),
+        conversation_id=None,
+        model=model,
+        chat_id=chat_id,
+    )
+
+
+digest_updater = DigestUpdater()
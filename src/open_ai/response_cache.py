@@ -0,0 +1,159 @@
+"""Кэш ответов модели на повторяющиеся вопросы.
+
+Два уровня: точное совпадение по (промпт, нормализованный вопрос, модель) и
+почти-дубликаты того же промпта и модели. Почти-дубликаты ищутся по MinHash
+сигнатурам символьных шинглов через LSH: сигнатура режется на полосы, кандидаты -
+записи, совпавшие хотя бы в одной полосе, из них берется самая похожая.
+"""
+
+import hashlib
+import logging
+import random
+import re
+import zlib
+
+from src import config
+from src.cache import MISSING, TTLCache
+
+log = logging.getLogger(__name__)
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+Key = tuple[str, str, str]
+Signature = tuple[int, ...]
+
+
+def normalize(message: str) -> str:
+    """Нижний регистр, без пунктуации и лишних пробелов"""
+    message = _PUNCTUATION.sub(" ", message.lower())
+    return _SPACES.sub(" ", message).strip()
+
+
+def shingles(text: str, size: int) -> set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHash:
+    """Семейство хеш-функций (a * x + b) mod p для MinHash сигнатур"""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rnd = random.Random(seed)
+        self.params = [(rnd.randrange(1, _PRIME), rnd.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def signature(self, tokens: set[str]) -> Signature:
+        hashes = [zlib.crc32(token.encode()) for token in tokens]
+        return tuple(min((a * x + b) % _PRIME & _MAX_HASH for x in hashes) for a, b in self.params)
+
+    @staticmethod
+    def similarity(left: Signature, right: Signature) -> float:
+        """Оценка коэффициента Жаккара по доле совпавших позиций"""
+        return sum(1 for x, y in zip(left, right, strict=True) if x == y) / len(left)
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        maxsize: int = config.RESPONSE_CACHE_SIZE,
+        ttl: float = config.RESPONSE_CACHE_TTL,
+        threshold: float = config.RESPONSE_CACHE_NEAR_THRESHOLD,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 4,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.minhash = MinHash(num_perm)
+        self._entries: TTLCache[Key, tuple[str, Signature]] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._index: dict[tuple, set[Key]] = {}
+        self._indexed = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(prompt: str, message: str, model: str) -> Key:
+        return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest(), normalize(message), model
+
+    def _bands(self, key: Key, signature: Signature):
+        scope = (key[0], key[2])
+        for band in range(self.bands):
+            yield scope, band, signature[band * self.rows : (band + 1) * self.rows]
+
+    def get(self, prompt: str, message: str, model: str) -> str | None:
+        key = self.key(prompt, message, model)
+        if (entry := self._entries.get(key)) is not MISSING:
+            self.exact_hits += 1
+            return entry[0]
+
+        signature = self.minhash.signature(shingles(key[1], self.shingle_size))
+        best, best_score = None, self.threshold
+        seen: set[Key] = set()
+        for band in self._bands(key, signature):
+            for candidate in list(self._index.get(band, ())):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                entry = self._entries.get(candidate)
+                if entry is MISSING:
+                    # запись вытеснена или устарела
+                    self._index[band].discard(candidate)
+                    continue
+                if (score := MinHash.similarity(signature, entry[1])) >= best_score:
+                    best, best_score = entry[0], score
+
+        if best is None:
+            self.misses += 1
+            return None
+        self.near_hits += 1
+        log.debug("Near duplicate answer for %r, similarity %.2f", key[1], best_score)
+        return best
+
+    def set(self, prompt: str, message: str, model: str, answer: str):
+        key = self.key(prompt, message, model)
+        signature = self.minhash.signature(shingles(key[1], self.shingle_size))
+        self._entries.set(key, (answer, signature))
+        for band in self._bands(key, signature):
+            self._index.setdefault(band, set()).add(key)
+        self._indexed += 1
+        if self._indexed > 2 * self._entries.maxsize:
+            self._reindex()
+
+    def _reindex(self):
+        """Пересобрать LSH индекс по живым записям"""
+        self._index.clear()
+        self._indexed = 0
+        for key, (_, signature) in self._entries.items():
+            for band in self._bands(key, signature):
+                self._index.setdefault(band, set()).add(key)
+            self._indexed += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+        self._indexed = 0
+
+    def stats(self) -> dict[str, float]:
+        hits = self.exact_hits + self.near_hits
+        total = hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+response_cache = ResponseCache()
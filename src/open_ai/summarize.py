@@ -0,0 +1,164 @@
+"""Иерархическая суммаризация истории чата для /tldr.
+
+Если история не влезает в один запрос, она делится на фрагменты по токенам,
+фрагменты пересказываются параллельно, а пересказы объединяются (map-reduce).
+Пересказы фрагментов кэшируются, поэтому повторный /tldr по пересекающемуся окну
+отправляет в модель только новые сообщения.
+"""
+
+import asyncio
+import logging
+
+from src import config
+from src.cache import MISSING, TTLCache
+from src.database.transcript import Row
+from src.open_ai import chat_gpt
+from src.open_ai.tokens import count_tokens, get_token_budget, truncate_to_tokens
+from src.scheduler import Priority
+
+log = logging.getLogger(__name__)
+
+chunk_cache: TTLCache[tuple, str] = TTLCache(maxsize=config.TLDR_CACHE_SIZE, ttl=config.TLDR_CACHE_TTL)
+
+
+def _input_budget(prompt: str, model: str) -> int:
+    # Половину бюджета оставляем запасом на заголовок и разметку
+    return (get_token_budget(model) - count_tokens(prompt, model)) // 2
+
+
+def chunk_rows(
+    rows: list[Row], max_tokens: int, model: str, bucket_size: int = config.TLDR_CHUNK_MESSAGES
+) -> list[list[Row]]:
+    """Разбить строки на фрагменты не больше max_tokens.
+
+    Границы фрагментов выровнены по message_id // bucket_size, чтобы при сдвиге окна
+    истории внутренние фрагменты совпадали с прошлыми и брались из кэша.
+    """
+    chunks: list[list[Row]] = []
+    current: list[Row] = []
+    used = 0
+    bucket = None
+    for message_id, line in rows:
+        cost = count_tokens(line, model) + 1
+        row_bucket = message_id // bucket_size
+        if current and (row_bucket != bucket or used + cost > max_tokens):
+            chunks.append(current)
+            current, used = [], 0
+        current.append((message_id, line))
+        used += cost
+        bucket = row_bucket
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _join(header: str, rows: list[Row]) -> str:
+    return '\n'.join([header, *(line for _, line in rows)])
+
+
+async def _summarize_chunk(
+    chat_id: int, header: str, chunk: list[Row], model: str, semaphore: asyncio.Semaphore, priority: Priority
+) -> str:
+    # В компактном транскрипте заголовок содержит легенду псевдонимов, без нее пересказ с u1, u2 не тот
+    key = (chat_id, chunk[0][0], chunk[-1][0], model, hash(header))
+    if (summary := chunk_cache.get(key)) is not MISSING:
+        return summary
+
+    async with semaphore:
+        summary = await chat_gpt.aget_answer(
+            prompt=config.SUMARIZE_CHUNK_PROMPT,
+            message=_join(header, chunk),
+            conversation_id=None,
+            model=model,
+            chat_id=chat_id,
+            priority=priority,
+        )
+    if summary and summary != chat_gpt.ERROR_MESSAGE:
+        chunk_cache.set(key, summary)
+    return summary
+
+
+def _succeeded(answers: list[str]) -> list[str]:
+    """Ответы модели без ошибок и пустых"""
+    return [answer for answer in answers if answer and answer != chat_gpt.ERROR_MESSAGE]
+
+
+def _group(summaries: list[str], budget: int, model: str) -> list[list[str]]:
+    """Разложить пересказы по запросам в пределах бюджета.
+
+    Если каждый пересказ больше половины бюджета и объединять нечего, пересказы
+    обрезаются и объединяются попарно, чтобы следующий уровень был короче.
+    """
+    groups: list[list[str]] = [[]]
+    used = 0
+    for summary in summaries:
+        cost = count_tokens(summary, model) + 1
+        if groups[-1] and used + cost > budget:
+            groups.append([])
+            used = 0
+        groups[-1].append(summary)
+        used += cost
+
+    if len(summaries) > 1 and len(groups) == len(summaries):
+        summaries = [truncate_to_tokens(summary, budget // 2 - 1, model) for summary in summaries]
+        groups = [summaries[index : index + 2] for index in range(0, len(summaries), 2)]
+    return groups
+
+
+async def _reduce(chat_id: int, summaries: list[str], model: str, priority: Priority) -> str:
+    """Объединить пересказы, при необходимости в несколько уровней"""
+    budget = _input_budget(config.SUMARIZE_REDUCE_PROMPT, model)
+    while True:
+        answers = await asyncio.gather(
+            *(
+                chat_gpt.aget_answer(
+                    prompt=config.SUMARIZE_REDUCE_PROMPT,
+                    message='\n-------------------------\n'.join(group),
+                    conversation_id=None,
+                    model=model,
+                    chat_id=chat_id,
+                    priority=priority,
+                )
+                for group in _group(summaries, budget, model)
+            )
+        )
+        summaries = _succeeded(answers)
+        if not summaries:
+            return chat_gpt.ERROR_MESSAGE
+        if len(summaries) == 1:
+            return summaries[0]
+
+
+async def summarize_history(
+    chat_id: int,
+    header: str,
+    rows: list[Row],
+    model: str = config.SUMARIZE_MODEL,
+    priority: Priority = Priority.HIGH,
+) -> str:
+    """Суммаризировать историю чата (строки в хронологическом порядке)"""
+    budget = _input_budget(config.SUMARIZE_PROMT, model)
+    if sum(count_tokens(line, model) + 1 for _, line in rows) <= budget:
+        return await chat_gpt.aget_answer(
+            prompt=config.SUMARIZE_PROMT,
+            message=_join(header, rows),
+            conversation_id=None,
+            model=model,
+            chat_id=chat_id,
+            priority=priority,
+        )
+
+    chunks = chunk_rows(rows, _input_budget(config.SUMARIZE_CHUNK_PROMPT, model), model, config.TLDR_CHUNK_MESSAGES)
+    log.info("tldr %s: %s rows in %s chunks", chat_id, len(rows), len(chunks))
+
+    semaphore = asyncio.Semaphore(config.TLDR_CONCURRENCY)
+    summaries = await asyncio.gather(
+        *(_summarize_chunk(chat_id, header, chunk, model, semaphore, priority) for chunk in chunks)
+    )
+    succeeded = _succeeded(summaries)
+    if len(succeeded) < len(summaries):
+        log.warning("tldr %s: %s of %s chunks not summarized", chat_id, len(summaries) - len(succeeded), len(chunks))
+    if not succeeded:
+        return chat_gpt.ERROR_MESSAGE
+    return await _reduce(chat_id, succeeded, model, priority)
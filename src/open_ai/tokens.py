@@ -0,0 +1,100 @@
+"""Подсчет токенов локальным токенизатором (tiktoken).
+
+Если словарь токенизатора недоступен (например, нет сети при первом запуске),
+используется грубая оценка по длине текста.
+"""
+
+import asyncio
+import functools
+import logging
+
+import tiktoken
+
+from src import config
+
+log = logging.getLogger(__name__)
+
+# Служебные токены на каждое сообщение в chat completion
+MESSAGE_OVERHEAD = 4
+# Консервативная оценка, когда токенизатор недоступен
+CHARS_PER_TOKEN = 3
+FALLBACK_ENCODING = "o200k_base"
+
+
+@functools.cache
+def get_encoding(model: str) -> tiktoken.Encoding | None:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as exc:
+        log.warning("Tokenizer for %s is unavailable, estimate by length: %s", model, exc)
+        return None
+
+
+async def preload(*models: str):
+    """Загрузить словари токенизатора заранее: при первом обращении tiktoken скачивает их синхронно"""
+    loop = asyncio.get_running_loop()
+    for model in models:
+        await loop.run_in_executor(None, get_encoding, model)
+
+
+@functools.lru_cache(maxsize=config.TOKEN_CACHE_SIZE)
+def count_tokens(text: str, model: str) -> int:
+    """Число токенов в тексте, результат кэшируется по тексту сообщения"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: dict[str, str], model: str) -> int:
+    return count_tokens(message["content"], model) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str, tail: bool = False) -> str:
+    """Обрезать текст до max_tokens токенов, с tail=True оставить конец текста"""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        size = (max_tokens - 1) * CHARS_PER_TOKEN
+        return text[len(text) - size :] if tail else text[:size]
+    encoded = encoding.encode(text, disallowed_special=())
+    return encoding.decode(encoded[len(encoded) - max_tokens :] if tail else encoded[:max_tokens])
+
+
+def get_token_budget(model: str) -> int:
+    return config.MODEL_TOKEN_BUDGET.get(model, config.DEFAULT_TOKEN_BUDGET)
+
+
+def build_messages(
+    prompt: str, message: str, history: list[dict[str, str]], model: str
+) -> list[dict[str, str]]:
+    """Собрать запрос из промпта, истории и сообщения в пределах бюджета токенов модели.
+
+    Из истории берутся самые новые реплики, которые помещаются в бюджет.
+    Если не помещается даже сообщение пользователя, от него остается конец:
+    в расшифровках чата для /tldr там самые новые сообщения.
+    """
+    budget = get_token_budget(model)
+    system = {"role": "system", "content": prompt}
+    used = message_tokens(system, model)
+
+    user = {"role": "user", "content": message}
+    if used + message_tokens(user, model) > budget:
+        log.info("Message is over token budget %s of %s, truncate", budget, model)
+        user["content"] = truncate_to_tokens(message, budget - used - MESSAGE_OVERHEAD, model, tail=True)
+    used += message_tokens(user, model)
+
+    packed = []
+    for turn in reversed(history):
+        cost = message_tokens(turn, model)
+        if used + cost > budget:
+            break
+        packed.append(turn)
+        used += cost
+
+    log.debug("Context for %s: %s history messages, %s tokens", model, len(packed), used)
+    return [system, *reversed(packed), user]
@@ -0,0 +1,97 @@
+"""Ограничение частоты операций token bucket'ами в SQLite.
+
+Состояние бакетов хранится в таблице RateBucket, поэтому переживает
+перезапуск и общее для всех процессов бота. Списание - один UPDATE с
+условием на запас, без чтения строки в Python.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+
+from src import config
+from src.database import models
+from src.database.executor import db_executor
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Limit:
+    capacity: float
+    period: float  # секунд на полное пополнение
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+    @classmethod
+    def parse(cls, value: tuple[float, float] | None) -> "Limit | None":
+        return cls(*value) if value else None
+
+
+class RateLimiter:
+    """Бакеты на чат, пользователя и общий; операция проходит, только если хватает во всех"""
+
+    def __init__(
+        self,
+        name: str,
+        chat: Limit | None = None,
+        user: Limit | None = None,
+        total: Limit | None = None,
+        expire_interval: float = config.RATE_EXPIRE_INTERVAL,
+    ):
+        self.name = name
+        self.chat = chat
+        self.user = user
+        self.total = total
+        self.expire_interval = expire_interval
+        self._expired_at = time.monotonic()
+
+    def buckets(self, chat_id: int | None = None, user_id: int | None = None) -> list[tuple[str, float, float]]:
+        buckets = []
+        if self.chat and chat_id is not None:
+            buckets.append((f"{self.name}:chat:{chat_id}", self.chat.capacity, self.chat.rate))
+        if self.user and user_id is not None:
+            buckets.append((f"{self.name}:user:{user_id}", self.user.capacity, self.user.rate))
+        if self.total:
+            buckets.append((f"{self.name}:total", self.total.capacity, self.total.rate))
+        return buckets
+
+    async def acquire(self, chat_id: int | None = None, user_id: int | None = None, cost: float = 1) -> bool:
+        """Списать cost, False если лимит исчерпан"""
+        self._maybe_expire()
+        buckets = self.buckets(chat_id, user_id)
+        if not buckets:
+            return True
+        allowed = await db_executor.run(models.RateBucket.consume, buckets, cost)
+        if not allowed:
+            log.info("Rate limit %s: chat=%s user=%s", self.name, chat_id, user_id)
+        return allowed
+
+    async def refund(self, chat_id: int | None = None, user_id: int | None = None, cost: float = 1):
+        keys = [key for key, _, _ in self.buckets(chat_id, user_id)]
+        await db_executor.run(models.RateBucket.refund, keys, cost)
+
+    async def available(self, chat_id: int | None = None, user_id: int | None = None, cost: float = 1) -> bool:
+        """Хватает ли запаса, без списания"""
+        for key, capacity, _ in self.buckets(chat_id, user_id):
+            if await db_executor.run(models.RateBucket.available, key, capacity) < cost:
+                return False
+        return True
+
+    def _maybe_expire(self):
+        if time.monotonic() - self._expired_at < self.expire_interval:
+            return
+        self._expired_at = time.monotonic()
+        db_executor.submit(models.RateBucket.expire)
+
+
+# Генерации картинок и неудачные генерации (после исчерпания генерация приостанавливается)
+image_limiter = RateLimiter(
+    "image",
+    chat=Limit.parse(config.IMAGE_RATE_CHAT),
+    user=Limit.parse(config.IMAGE_RATE_USER),
+    total=Limit.parse(config.IMAGE_RATE_TOTAL),
+)
+image_fail_limiter = RateLimiter("image_fail", total=Limit.parse(config.IMAGE_FAIL_RATE))
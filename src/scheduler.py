@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import enum
+import heapq
+import itertools
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+
+from src import config, tracing
+
+log = logging.getLogger(__name__)
+
+
+class Priority(enum.IntEnum):
+    HIGH = 0  # команды: /request, /tldr, генерация картинок, админские
+    LOW = 1  # ответы в режиме member и фоновые задачи
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    tag: float
+    seq: int
+    chat_id: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+class FairScheduler:
+    """Ограничение одновременных запросов с честной очередью между чатами.
+
+    Не больше `limit` запросов всего и `per_chat` запросов одного чата.
+    Ожидающие запросы упорядочены по приоритету, затем по виртуальному
+    времени завершения (weighted fair queuing): чат с весом 2 получает
+    вдвое больше слотов, чем чат с весом 1, а шумный чат не вытесняет остальные.
+    """
+
+    def __init__(self, name: str, limit: int, per_chat: int, weights: dict[int, float] | None = None):
+        self.name = name
+        self.limit = limit
+        self.per_chat = per_chat
+        self.weights = dict(weights or {})
+        self._queue: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._running: Counter[int] = Counter()
+        self._waiting: Counter[int] = Counter()
+        self._finish: dict[int, float] = {}
+        self._vtime = 0.0
+        # метрики
+        self.max_queued = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int, priority: Priority = Priority.HIGH):
+        await self.acquire(chat_id, priority)
+        try:
+            yield
+        finally:
+            self.release(chat_id)
+
+    async def acquire(self, chat_id: int, priority: Priority = Priority.HIGH):
+        loop = asyncio.get_running_loop()
+        tag = max(self._vtime, self._finish.get(chat_id, 0.0)) + 1 / self.weights.get(chat_id, 1.0)
+        self._finish[chat_id] = tag
+        self._waiting[chat_id] += 1
+        waiter = _Waiter(priority, tag, next(self._seq), chat_id, loop.create_future(), loop.time())
+        heapq.heappush(self._queue, waiter)
+        self.max_queued = max(self.max_queued, len(self._queue))
+        self._dispatch()
+
+        try:
+            # свободный слот выдается сразу, span только для ожидания
+            if not waiter.future.done():
+                with tracing.span(f"wait:{self.name}"):
+                    await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # слот уже выдан, но задачу отменили до старта
+                self.release(chat_id)
+            else:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                self._leave(chat_id)
+            raise
+
+        wait = loop.time() - waiter.enqueued_at
+        self.waited += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        if wait > 1:
+            log.debug("%s: chat %s waited %.1fs, queued %s", self.name, chat_id, wait, len(self._queue))
+
+    def release(self, chat_id: int):
+        self._active -= 1
+        self._running[chat_id] -= 1
+        if self._running[chat_id] <= 0:
+            del self._running[chat_id]
+        self._dispatch()
+
+    def _leave(self, chat_id: int):
+        self._waiting[chat_id] -= 1
+        if self._waiting[chat_id] <= 0:
+            del self._waiting[chat_id]
+            # виртуальное время уже не меньше последней метки чата
+            self._finish.pop(chat_id, None)
+
+    def _dispatch(self):
+        blocked = []
+        while self._queue and self._active < self.limit:
+            waiter = heapq.heappop(self._queue)
+            if self._running[waiter.chat_id] >= self.per_chat:
+                blocked.append(waiter)
+                continue
+
+            self._vtime = max(self._vtime, waiter.tag)
+            self._active += 1
+            self._running[waiter.chat_id] += 1
+            self._leave(waiter.chat_id)
+            waiter.future.set_result(None)
+
+        for waiter in blocked:
+            heapq.heappush(self._queue, waiter)
+
+    def queue_depth(self) -> dict[Priority, int]:
+        depth = Counter(Priority(waiter.priority) for waiter in self._queue)
+        return {priority: depth[priority] for priority in Priority}
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "active": self._active,
+            "queued": len(self._queue),
+            "max_queued": self.max_queued,
+            "waited": self.waited,
+            "avg_wait": self.wait_total / self.waited if self.waited else 0.0,
+            "max_wait": self.wait_max,
+        }
+
+
+llm_scheduler = FairScheduler("llm", config.OPEN_AI_CONCURRENCY, config.LLM_CHAT_CONCURRENCY, config.CHAT_WEIGHTS)
+image_scheduler = FairScheduler("image", config.IMAGE_CONCURRENCY, config.IMAGE_CHAT_CONCURRENCY, config.CHAT_WEIGHTS)
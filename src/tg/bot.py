@@ -7,9 +7,23 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
-from src import config
-from src.tg.handlers.image import generate_image_from_photo
+from src import config, metrics, tracing
+from src.database.executor import db_executor
+from src.database.history import history_writer
+from src.database.models import admin_cache, chat_cache
+from src.image_gen import ImageGenerator
+from src.open_ai import chat_gpt, tokens
+from src.open_ai.digest import digest_updater
+from src.open_ai.response_cache import response_cache
+from src.open_ai.summarize import chunk_cache
+from src.scheduler import image_scheduler, llm_scheduler
+from src.tg.cluster import SHARD, ChatLocks, run_webhook
+from src.tg.handlers.chat import member_coalescer
+from src.tg.handlers.image import IMAGE_GENERATOR, generate_image_from_photo
+from src.tg.image_jobs import image_jobs
+from src.tg.photos import output_cache, photo_files
 
 from .handlers import (
     add_chat_or_user,
@@ -19,6 +33,7 @@ from .handlers import (
     get_status,
     on_message,
     request,
+    set_cache,
     set_default_prompt,
     set_disable,
     set_enable,
@@ -29,6 +44,57 @@ from .handlers import (
 
 log = logging.getLogger(__name__)
 
+class TracedApplication(Application):
+    """Application с трассой на каждый апдейт.
+
+    С concurrent_updates апдейты разных чатов обрабатываются параллельно, одного чата - по порядку.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_locks = ChatLocks()
+
+    async def process_update(self, update: object) -> None:
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        key = chat.id if chat else user.id if user else 0
+        with tracing.trace("update", update_id=getattr(update, "update_id", None), chat_id=chat.id if chat else None):
+            async with self.chat_locks.hold(key):
+                await super().process_update(update)
+
+
+class TracedRequest(HTTPXRequest):
+    """Запросы к Bot API в span-ах tg:<метод>"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with tracing.span(f"tg:{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def register_metrics():
+    """Очереди и кэши процесса бота, снимаются при запросе метрик"""
+    schedulers = {"llm": llm_scheduler, "image": image_scheduler}
+    metrics.registry.gauge(
+        "scheduler_queued", "Requests waiting for a scheduler slot",
+        lambda: {name: scheduler.stats()["queued"] for name, scheduler in schedulers.items()}, ["scheduler"],
+    )
+    metrics.registry.gauge(
+        "scheduler_active", "Requests holding a scheduler slot",
+        lambda: {name: scheduler.stats()["active"] for name, scheduler in schedulers.items()}, ["scheduler"],
+    )
+    metrics.registry.gauge("image_jobs_queued", "Image jobs waiting for a worker", lambda: len(image_jobs))
+    metrics.registry.gauge("history_buffer", "Chat history messages waiting for a flush", lambda: len(history_writer))
+    metrics.cache_stats(
+        {
+            "chat": chat_cache,
+            "admin": admin_cache,
+            "tldr_chunks": chunk_cache,
+            "response": response_cache,
+            "photo_files": photo_files,
+            "image_output": output_cache,
+        }
+    )
+
 async def post_init(application: Application) -> None:
     """Initialize bot handlers and commands"""
     application.add_handler(CommandHandler("enable", set_enable))
@@ -38,6 +104,7 @@ async def post_init(application: Application) -> None:
     application.add_handler(CommandHandler("default_prompt", set_default_prompt))
     application.add_handler(CommandHandler("clear", clear))
     application.add_handler(CommandHandler("set_mode", set_mode))
+    application.add_handler(CommandHandler("cache", set_cache))
     application.add_handler(CommandHandler("status", get_status))
     application.add_handler(CommandHandler("request", request))
     application.add_handler(CommandHandler("add_chat_or_user", add_chat_or_user))
@@ -64,6 +131,52 @@ async def post_init(application: Application) -> None:
         ]
     )
 
+    await tokens.preload(config.AI_MODEL, config.SUMARIZE_MODEL)
+
+    if config.IMAGE_GEN:
+        generator = application.bot_data[IMAGE_GENERATOR] = ImageGenerator()
+        await image_jobs.start(application.bot, generator, shard=application.bot_data.get(SHARD))
+
+    if config.DIGEST_ENABLED:
+        digest_updater.start()
+
+    if config.METRICS_ENABLED:
+        register_metrics()
+        shard = application.bot_data.get(SHARD)
+        # воркеры диспетчера - на следующих портах
+        await metrics.metrics_server.start(config.METRICS_PORT + (shard[0] + 1 if shard else 0))
+
+async def post_shutdown(application: Application) -> None:
+    """Release shared resources"""
+    await metrics.metrics_server.stop()
+    await digest_updater.stop()
+    await member_coalescer.close()
+    await image_jobs.stop()
+    if generator := application.bot_data.pop(IMAGE_GENERATOR, None):
+        await generator.aclose()
+    await chat_gpt.close_session()
+    await history_writer.close()
+    db_executor.shutdown()
+
+def build_application(updater: bool = True) -> Application:
+    """Application с хендлерами, без updater - для воркеров webhook-режима"""
+    builder = (
+        Application.builder()
+        .application_class(TracedApplication)
+        .token(config.TELEGRAM_TOKEN)
+        .base_url(config.TELEGRAM_BASE_URL)
+        .request(TracedRequest(connection_pool_size=256, http_version=config.TELEGRAM_HTTP_VERSION))
+        .concurrent_updates(config.CONCURRENT_UPDATES or False)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if updater:
+        # с заданным request PTB не дает выставить get_updates_http_version
+        builder.get_updates_request(HTTPXRequest(connection_pool_size=1, http_version=config.TELEGRAM_HTTP_VERSION))
+    else:
+        builder.updater(None)
+    return builder.build()
+
 def start_bot() -> None:
     """Start the bot."""
     log.info("Start BOT")
@@ -71,18 +184,9 @@ def start_bot() -> None:
     # Инициализируем базовые промпты
     # models.ImagePrompt.initialize_default_prompts()
 
-    # Create the Application and pass it your bot's token.
-    application = (
-        Application.builder().token(config.TELEGRAM_TOKEN).post_init(post_init).build()
-    )
     # connect_db()
     if config.RUN_POOLING:
         log.info("Run bot in pollling mode 🚗")
-        application.run_polling()
+        build_application().run_polling()
     else:
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=config.PORT,
-            secret_token="ASecretTokenIHaveChangedByNow",
-            webhook_url="https://<appname>.herokuapp.com/",
-        )
+        run_webhook(build_application)
@@ -0,0 +1,434 @@
+"""Обработка апдейтов в нескольких процессах.
+
+Диспетчер один раз получает апдейты (webhook на aiohttp или long polling) и
+раскладывает их по воркерам по хешу chat_id. Воркер - отдельный процесс с
+обычным Application без updater и тем же набором хендлеров. Внутри воркера
+апдейты одного чата обрабатываются по порядку, разных чатов - параллельно.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import zlib
+from collections import deque
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager, suppress
+from multiprocessing.connection import Connection
+from typing import Any
+
+import telegram
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+from src import config, log_tools, metrics
+
+log = logging.getLogger(__name__)
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# (номер воркера, число воркеров) в bot_data, None - один процесс
+SHARD = "shard"
+
+ApplicationFactory = Callable[..., Application]
+
+
+def update_chat_id(data: dict) -> int:
+    """chat_id апдейта, для апдейтов без чата (inline query и т.п.) - id пользователя"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if user := value.get("from"):
+            return user["id"]
+    return 0
+
+
+def partition(chat_id: int, workers: int) -> int:
+    """Номер воркера для чата, одинаковый во всех процессах и между перезапусками"""
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+def owns(shard: tuple[int, int] | None, chat_id: int) -> bool:
+    """Обрабатывает ли воркер shard данный чат"""
+    if shard is None:
+        return True
+    index, workers = shard
+    return partition(chat_id, workers) == index
+
+
+class ChatSerializer:
+    """Апдейты одного чата обрабатываются по порядку, разных чатов - параллельно"""
+
+    def __init__(self, process: Callable[[Any], Awaitable]):
+        self.process = process
+        self._queues: dict[int, deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, chat_id: int, update: Any):
+        if (queue := self._queues.get(chat_id)) is not None:
+            queue.append(update)
+            return
+        self._queues[chat_id] = deque([update])
+        task = asyncio.create_task(self._drain(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                update = queue.popleft()
+                try:
+                    await self.process(update)
+                except Exception:
+                    log.exception("Update of chat %s failed", chat_id)
+        finally:
+            del self._queues[chat_id]
+
+    async def join(self):
+        """Дождаться обработки всех принятых апдейтов"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+class ChatLocks:
+    """Апдейты одного чата по порядку при параллельной обработке в одном Application.
+
+    Задачи апдейтов создаются в порядке очереди и захватывают блокировку чата
+    до первого await, а ожидающие asyncio.Lock получают ее по очереди.
+    """
+
+    def __init__(self):
+        # chat_id -> (блокировка, сколько задач ее держат или ждут)
+        self._locks: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        lock, users = self._locks.get(chat_id) or (asyncio.Lock(), 0)
+        self._locks[chat_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[chat_id]
+            if users == 1:
+                del self._locks[chat_id]
+            else:
+                self._locks[chat_id] = (lock, users - 1)
+
+
+def _receive(conn: Connection):
+    try:
+        return conn.recv()
+    except EOFError:
+        # диспетчер завершился
+        return None
+
+
+async def serve_worker(index: int, workers: int, conn: Connection, factory: ApplicationFactory):
+    """Обработка апдейтов из канала диспетчера до None, каждый обработанный подтверждается"""
+    application = factory(updater=False)
+    application.bot_data[SHARD] = (index, workers)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    log.info("Worker %s/%s started", index, workers)
+
+    async def process(update: Update):
+        try:
+            await application.process_update(update)
+        finally:
+            with suppress(OSError):
+                conn.send(1)
+
+    serializer = ChatSerializer(process)
+    loop = asyncio.get_running_loop()
+    try:
+        while (data := await loop.run_in_executor(None, _receive, conn)) is not None:
+            serializer.submit(update_chat_id(data), Update.de_json(data, application.bot))
+        await serializer.join()
+    finally:
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        conn.close()
+        log.info("Worker %s/%s stopped", index, workers)
+
+
+def run_worker(index: int, workers: int, conn: Connection, factory: ApplicationFactory):
+    """Точка входа процесса воркера"""
+    # Ctrl+C приходит всей группе процессов, воркеры останавливает диспетчер
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_tools.use_trace_file(f"worker{index}")
+    asyncio.run(serve_worker(index, workers, conn, factory))
+
+
+class _Worker:
+    """Процесс воркера и сторона канала диспетчера"""
+
+    def __init__(self, process: multiprocessing.Process, conn: Connection):
+        self.process = process
+        self.conn = conn
+        self.in_flight = 0
+        self.freed = asyncio.Event()
+        self.alive = True
+
+
+class WorkerPool:
+    """Процессы-воркеры, апдейты раскладываются по хешу chat_id.
+
+    Апдейты передаются по Pipe, воркер подтверждает каждый обработанный. Пока у
+    воркера queue_size неподтвержденных апдейтов, submit ждет - так источник
+    апдейтов притормаживает вместе с самым загруженным воркером. Упавший воркер
+    перезапускается через restart_delay, его неподтвержденные апдейты теряются.
+    """
+
+    def __init__(
+        self,
+        factory: ApplicationFactory,
+        workers: int = config.WORKERS,
+        queue_size: int = config.WORKER_QUEUE_SIZE,
+        restart_delay: float = config.WORKER_RESTART_DELAY,
+    ):
+        self.factory = factory
+        self.size = workers
+        self.queue_size = queue_size
+        self.restart_delay = restart_delay
+        # spawn: воркеры не наследуют состояние цикла событий и соединения диспетчера
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[_Worker] = []
+        self._stopping = False
+        self.restarts = 0
+        self.lost = 0
+
+    def start(self):
+        self._stopping = False
+        self._workers = [self._spawn(index) for index in range(self.size)]
+        log.info("Started %s workers", self.size)
+
+    async def stop(self, timeout: float = 30):
+        """Воркеры дорабатывают принятые апдейты и завершаются"""
+        self._stopping = True
+        for worker in self._workers:
+            if worker.alive:
+                with suppress(OSError):
+                    worker.conn.send(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._join, timeout)
+        for worker in self._workers:
+            if worker.alive:
+                self._close(worker)
+        self._workers = []
+
+    def _join(self, timeout: float):
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                log.warning("Worker %s did not stop, terminate", worker.process.name)
+                worker.process.terminate()
+                worker.process.join()
+
+    def in_flight(self) -> list[int]:
+        """Неподтвержденные апдейты по воркерам"""
+        return [worker.in_flight for worker in self._workers]
+
+    async def submit(self, data: dict) -> int:
+        """Передать апдейт воркеру его чата, дождавшись места в его очереди"""
+        index = partition(update_chat_id(data), self.size)
+        while (worker := self._workers[index]).in_flight >= self.queue_size:
+            worker.freed.clear()
+            await worker.freed.wait()
+        worker.in_flight += 1
+        try:
+            worker.conn.send(data)
+        except OSError as exc:
+            # воркер упал, апдейт будет учтен в потерянных при перезапуске
+            log.debug("Update not sent to worker %s: %s", index, exc)
+        return index
+
+    def _spawn(self, index: int) -> _Worker:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.size, child_conn, self.factory),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        # без копии в диспетчере канал закроется вместе с процессом воркера
+        child_conn.close()
+        worker = _Worker(process, conn)
+        asyncio.get_running_loop().add_reader(conn.fileno(), self._on_readable, index, worker)
+        return worker
+
+    def _close(self, worker: _Worker):
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        worker.alive = False
+
+    def _on_readable(self, index: int, worker: _Worker):
+        try:
+            while worker.conn.poll():
+                worker.in_flight -= worker.conn.recv()
+        except (EOFError, OSError):
+            self._on_exit(index, worker)
+            return
+        worker.freed.set()
+
+    def _on_exit(self, index: int, worker: _Worker):
+        self._close(worker)
+        if self._stopping:
+            return
+        worker.process.join(1)
+        log.error(
+            "Worker %s exited with code %s, %s updates lost, restart in %s s",
+            index, worker.process.exitcode, worker.in_flight, self.restart_delay,
+        )
+        self.lost += worker.in_flight
+        # до перезапуска новые апдейты ждут
+        worker.in_flight = self.queue_size
+        asyncio.get_running_loop().call_later(self.restart_delay, self._restart, index)
+
+    def _restart(self, index: int):
+        if self._stopping:
+            return
+        dead = self._workers[index]
+        self._workers[index] = self._spawn(index)
+        self.restarts += 1
+        dead.freed.set()
+
+
+async def start_metrics(pool: WorkerPool):
+    """Метрики диспетчера, воркеры отдают свои на следующих портах"""
+    if not config.METRICS_ENABLED:
+        return
+    metrics.registry.gauge(
+        "dispatcher_in_flight", "Unacknowledged updates per worker",
+        lambda: {str(index): count for index, count in enumerate(pool.in_flight())}, ["worker"],
+    )
+    metrics.registry.gauge("dispatcher_worker_restarts", "Restarted workers", lambda: pool.restarts)
+    metrics.registry.gauge("dispatcher_lost_updates", "Updates lost with dead workers", lambda: pool.lost)
+    await metrics.metrics_server.start(config.METRICS_PORT)
+
+
+def dispatcher_bot(poll_timeout: float = config.POLL_TIMEOUT) -> telegram.Bot:
+    """Bot диспетчера: webhook и getUpdates"""
+    return telegram.Bot(
+        config.TELEGRAM_TOKEN,
+        base_url=config.TELEGRAM_BASE_URL,
+        request=HTTPXRequest(http_version=config.TELEGRAM_HTTP_VERSION),
+        get_updates_request=HTTPXRequest(http_version=config.TELEGRAM_HTTP_VERSION, read_timeout=poll_timeout + 10),
+    )
+
+
+async def poll_updates(pool: WorkerPool, bot: telegram.Bot, timeout: int = config.POLL_TIMEOUT):
+    """Long polling: следующая пачка запрашивается, когда воркеры приняли предыдущую"""
+    await bot.delete_webhook()
+    offset = 0
+    delay = 1
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES
+            )
+        except telegram.error.RetryAfter as exc:
+            log.warning("getUpdates flood control, retry in %s s", exc.retry_after)
+            await asyncio.sleep(exc.retry_after)
+            continue
+        except telegram.error.InvalidToken:
+            raise
+        except telegram.error.TelegramError as exc:
+            # сеть или Conflict: другой getUpdates или еще не снятый webhook, воркеры без апдейтов ждут
+            log.warning("getUpdates failed: %s, retry in %s s", exc, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        delay = 1
+        for update in updates:
+            await pool.submit(update.to_dict())
+            offset = update.update_id + 1
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        pool: WorkerPool,
+        secret: str = config.WEBHOOK_SECRET,
+        path: str = config.WEBHOOK_PATH,
+    ):
+        self.pool = pool
+        self.secret = secret
+        self.path = path
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            raise web.HTTPForbidden()
+        try:
+            data = await request.json()
+        except ValueError as exc:
+            raise web.HTTPBadRequest() from exc
+        # пока очередь воркера полна, ответ задерживается и Telegram не шлет лишнего
+        await self.pool.submit(data)
+        return web.Response()
+
+    async def set_webhook(self):
+        async with dispatcher_bot() as bot:
+            await bot.set_webhook(
+                url=config.WEBHOOK_URL,
+                secret_token=self.secret or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        log.info("Webhook set to %s", config.WEBHOOK_URL)
+
+    async def _on_startup(self, app: web.Application):
+        self.pool.start()
+        await start_metrics(self.pool)
+        if config.WEBHOOK_URL:
+            await self.set_webhook()
+
+    async def _on_cleanup(self, app: web.Application):
+        await metrics.metrics_server.stop()
+        await self.pool.stop()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def run_webhook(factory: ApplicationFactory, workers: int = config.WORKERS):
+    server = WebhookServer(WorkerPool(factory, workers))
+    log.info("Run bot in webhook mode on %s:%s%s, %s workers", config.WEBHOOK_LISTEN, config.PORT,
+             config.WEBHOOK_PATH, workers)
+    web.run_app(server.app(), host=config.WEBHOOK_LISTEN, port=config.PORT, print=None)
+
+
+async def _dispatch_polling(factory: ApplicationFactory, workers: int):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    pool = WorkerPool(factory, workers)
+    pool.start()
+    await start_metrics(pool)
+    try:
+        async with dispatcher_bot() as bot:
+            await poll_updates(pool, bot)
+    finally:
+        await metrics.metrics_server.stop()
+        await pool.stop()
+
+
+def run_polling(factory: ApplicationFactory, workers: int = config.WORKERS):
+    log.info("Run bot in polling mode, %s workers", workers)
+    with suppress(KeyboardInterrupt):
+        asyncio.run(_dispatch_polling(factory, workers))
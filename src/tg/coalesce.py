@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import typing
+
+import telegram
+
+from src import config
+from src.cache import MISSING, TTLCache
+
+log = logging.getLogger(__name__)
+
+BatchHandler = typing.Callable[[list[telegram.Message]], typing.Awaitable[typing.Any]]
+
+
+class ChatCoalescer:
+    """Объединяет сообщения чата, пришедшие подряд, в один запрос.
+
+    Ответ запускается через `window` секунд после последнего сообщения чата.
+    Если новое сообщение приходит, пока ответ на предыдущие еще готовится,
+    этот ответ отменяется и предыдущие сообщения попадают в следующий запрос.
+    Повторная доставка того же сообщения игнорируется.
+    """
+
+    def __init__(self, handler: BatchHandler, window: float = config.MEMBER_DEBOUNCE):
+        self.handler = handler
+        self.window = window
+        self._pending: dict[int, list[telegram.Message]] = {}
+        self._timers: dict[int, asyncio.Task] = {}
+        self._inflight: dict[int, tuple[asyncio.Task, list[telegram.Message]]] = {}
+        self._seen: TTLCache[tuple[int, int], bool] = TTLCache(maxsize=10000, ttl=60 * 60)
+
+    def pending(self, chat_id: int) -> int:
+        return len(self._pending.get(chat_id, []))
+
+    def submit(self, message: telegram.Message) -> bool:
+        """Добавить сообщение, вернет False для дубликата"""
+        key = (message.chat_id, message.id)
+        if self._seen.get(key) is not MISSING:
+            log.debug("Duplicate message %s skipped", key)
+            return False
+        self._seen.set(key, True)
+
+        chat_id = message.chat_id
+        pending = self._pending.setdefault(chat_id, [])
+        if inflight := self._inflight.pop(chat_id, None):
+            task, messages = inflight
+            log.debug("Cancel answer for %s, superseded by %s", chat_id, message.id)
+            task.cancel()
+            pending[:0] = messages
+        pending.append(message)
+
+        if timer := self._timers.get(chat_id):
+            timer.cancel()
+        self._timers[chat_id] = asyncio.create_task(self._fire_later(chat_id))
+        return True
+
+    async def _fire_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        self._timers.pop(chat_id, None)
+        messages = self._pending.pop(chat_id, [])
+        if not messages:
+            return
+
+        task = asyncio.create_task(self.handler(messages))
+        self._inflight[chat_id] = (task, messages)
+        task.add_done_callback(lambda done: self._on_done(chat_id, done))
+
+    def _on_done(self, chat_id: int, task: asyncio.Task):
+        if self._inflight.get(chat_id, (None,))[0] is task:
+            del self._inflight[chat_id]
+        if not task.cancelled() and (exc := task.exception()):
+            log.error("Answer for %s failed: %s", chat_id, exc)
+
+    async def close(self):
+        """Отменить ожидающие и выполняющиеся ответы"""
+        tasks = [*self._timers.values(), *(task for task, _ in self._inflight.values())]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._timers.clear()
+        self._inflight.clear()
+        self._pending.clear()
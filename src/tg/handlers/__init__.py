@@ -2,6 +2,7 @@ from .admin import (
     add_chat_or_user,
     clear,
     get_status,
+    set_cache,
     set_default_prompt,
     set_disable,
     set_enable,
@@ -20,6 +21,7 @@ __all__ = [
     'get_status',
     'on_message',
     'request',
+    'set_cache',
     'set_default_prompt',
     'set_disable',
     'set_enable',
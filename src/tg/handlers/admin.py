@@ -5,10 +5,11 @@ import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.ext import CallbackContext
 
-from src import config
+from src import config, metrics
 from src.constants import BotMode
-from src.database import models
+from src.database import queries
 from src.open_ai import chat_gpt
+from src.open_ai.response_cache import response_cache
 
 from ..utils import check_access_to_chat
 
@@ -20,11 +21,12 @@ def get_message_and_chat_id(update: Update) -> tuple[Message | None, int | None]
     chat_id = message.chat_id if message and message.chat else None
     return message, chat_id
 
+@metrics.handler
 async def set_enable(update: Update, context: CallbackContext):
     """Активируем бота в чате"""
     log.debug("enable command")
 
-    if not check_access_to_chat(update, check_admin_rights=True):
+    if not await check_access_to_chat(update, check_admin_rights=True):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -32,8 +34,8 @@ async def set_enable(update: Update, context: CallbackContext):
         log.error("Chat ID is None")
         return
 
-    models.Chat.set_state(chat_id, True)
-    chat = models.Chat.get_by_id(chat_id)
+    await queries.set_chat_state(chat_id, True)
+    chat = await queries.get_chat(chat_id)
     if not chat:
         log.error("Chat not found")
         return
@@ -43,10 +45,11 @@ async def set_enable(update: Update, context: CallbackContext):
         text=config.DEFAULT_BOT_PROMPT + f"""prompt: {chat.prompt}""",
     )
 
+@metrics.handler
 async def set_disable(update: Update, context: CallbackContext):
     """Деактивируем бота в чате"""
     log.debug("disable command")
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -54,16 +57,17 @@ async def set_disable(update: Update, context: CallbackContext):
         log.error("Chat ID is None")
         return
 
-    models.Chat.set_state(chat_id, False)
+    await queries.set_chat_state(chat_id, False)
     await context.bot.send_message(
         chat_id=chat_id,
         text="Я отключился. Всем пока в этом чате."
     )
 
+@metrics.handler
 async def set_prompt(update: Update, context: CallbackContext):
     """Установит контекст для бота в чате"""
     log.debug("set_prompt command")
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -76,7 +80,7 @@ async def set_prompt(update: Update, context: CallbackContext):
         log.error("Message text is None")
         return
 
-    new_prompt = models.Chat.set_prompt(chat_id, prompt_text.removeprefix("/set_prompt"))
+    new_prompt = await queries.set_chat_prompt(chat_id, prompt_text.removeprefix("/set_prompt"))
     chat_gpt.clear_conversation(chat_id)
 
     return await context.bot.send_message(
@@ -85,10 +89,11 @@ async def set_prompt(update: Update, context: CallbackContext):
         parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
     )
 
+@metrics.handler
 async def set_default_prompt(update: Update, context: CallbackContext):
     """Сбросить на дефолтный контекст."""
     log.debug("set_default_prompt command")
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -96,7 +101,7 @@ async def set_default_prompt(update: Update, context: CallbackContext):
         log.error("Chat ID is None")
         return
 
-    new_prompt = models.Chat.set_prompt(chat_id, config.DEFAULT_PROMPT)
+    new_prompt = await queries.set_chat_prompt(chat_id, config.DEFAULT_PROMPT)
     chat_gpt.clear_conversation(chat_id)
 
     return await context.bot.send_message(
@@ -105,10 +110,11 @@ async def set_default_prompt(update: Update, context: CallbackContext):
         parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
     )
 
+@metrics.handler
 async def clear(update: Update, context: CallbackContext):
     """Очистить историю/контекст бота"""
     log.debug("clear command")
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -122,13 +128,14 @@ async def clear(update: Update, context: CallbackContext):
         text="Ok."
     )
 
+@metrics.handler
 async def set_mode(update: Update, context: CallbackContext):
     """Установить способ участия бота в чате.
         member: Отвечает на все
         request: только на команду /request
     """
     log.debug("set_mode command")
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message, chat_id = get_message_and_chat_id(update)
@@ -151,17 +158,40 @@ async def set_mode(update: Update, context: CallbackContext):
             parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
         )
 
-    chat = models.Chat.get_by_id(chat_id)
+    chat = await queries.get_chat(chat_id)
     if not chat:
         log.error("Chat not found")
         return
 
-    new_mode = models.Chat.set_mode(chat_id, BotMode(mode))
+    new_mode = await queries.set_chat_mode(chat_id, BotMode(mode))
     return await context.bot.send_message(
         chat_id=chat_id,
         text=f"Ok. {new_mode}",
     )
 
+@metrics.handler
+async def set_cache(update: Update, context: CallbackContext):
+    """Включить/выключить кэш ответов на повторяющиеся вопросы: /cache on|off"""
+    log.debug("set_cache command")
+    if not await check_access_to_chat(update, check_admin_rights=True):
+        return
+
+    message, chat_id = get_message_and_chat_id(update)
+    if not message or not chat_id or not message.text:
+        log.error("Message or chat_id is None")
+        return
+
+    value = message.text.split(" ", 1)[1].strip() if " " in message.text else ""
+    if value not in ("on", "off"):
+        return await context.bot.send_message(chat_id=chat_id, text="Only on or off")
+
+    if not await queries.set_chat_response_cache(chat_id, value == "on"):
+        log.error("Chat not found")
+        return
+
+    return await context.bot.send_message(chat_id=chat_id, text=f"Ok. cache {value}")
+
+@metrics.handler
 async def get_status(update: Update, context: CallbackContext):
     """Вернет текущие настройки бота"""
     log.debug("get_status command")
@@ -171,7 +201,7 @@ async def get_status(update: Update, context: CallbackContext):
         log.error("Chat ID is None")
         return
 
-    chat = models.Chat.get_or_none(chat_id)
+    chat = await queries.get_chat(chat_id)
     if not chat:
         log.error("Chat not found")
         return
@@ -183,6 +213,8 @@ async def get_status(update: Update, context: CallbackContext):
             "prompt": chat.prompt,
             "model": config.AI_MODEL,
             "chat_id": chat_id,
+            "response_cache": chat.response_cache,
+            "response_cache_stats": response_cache.stats(),
         },
         indent=4,
         default=str,
@@ -226,6 +258,7 @@ async def request_admin_approval(bot, chat_id: int, admin_id: int):
     )
     return True
 
+@metrics.handler
 async def add_chat_or_user(update: Update, context: CallbackContext):
     """Добавить чат или пользователя в белый список"""
     log.debug("add_chat_or_user command")
@@ -3,10 +3,14 @@ import logging
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from src.database.models import add_chat_to_whitelist
+from src import metrics
+from src.database import queries
+from src.tg.handlers.image import cancel_image_job
+from src.tg.image_jobs import CANCEL_JOB_PREFIX
 
 log = logging.getLogger(__name__)
 
+@metrics.handler
 async def button_callback(update: Update, context: CallbackContext) -> None:
     """Обработка нажатий на кнопки"""
     query = update.callback_query
@@ -20,6 +24,10 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         log.error("Callback data is None")
         return
 
+    if callback_data.startswith(CANCEL_JOB_PREFIX):
+        await cancel_image_job(query)
+        return
+
     chat_id = None
     if callback_data.startswith(("approve_", "deny_")):
         chat_id = callback_data.split("_")[1]
@@ -39,7 +47,7 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
             text="✅ Запрос на добавление бота одобрен. Теперь вы можете общаться со мной.",
         )
         await query.edit_message_text(text=f"✅ Запрос на добавление бота в чат {chat_id} одобрен.")
-        add_chat_to_whitelist(chat_id)
+        await queries.add_chat_to_whitelist(chat_id)
     elif callback_data.startswith("deny_"):
         await context.bot.send_message(chat_id=chat_id, text="❌ Запрос на добавление бота отклонен.")
         await query.edit_message_text(text=f"❌ Запрос на добавление бота в чат {chat_id} отклонен.")
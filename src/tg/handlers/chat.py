@@ -1,39 +1,47 @@
+import asyncio
 import logging
+import typing
 
 import telegram
 from telegram.ext import CallbackContext
 
-from src import config
-from src.database import models
-from src.open_ai import chat_gpt
+from src import config, metrics, tracing
+from src.database import queries
+from src.database.history import history_writer
+from src.open_ai import chat_gpt, digest, summarize
+from src.scheduler import Priority
+from src.tg.coalesce import ChatCoalescer
 from src.tg.handlers.image import generate_image_from_photo
 
 from ..utils import check_access_to_chat
 
 log = logging.getLogger(__name__)
+STREAM_PLACEHOLDER = "…"
 
 
+@tracing.traced()
 def save_history(message: telegram.Message):
+    """Добавить сообщение (и сообщение, на которое оно отвечает) в буфер истории"""
+    reply_to = message.reply_to_message
+    if reply_to:
+        save_history(reply_to)
+
     user = message.from_user
-    tg_user, _ = models.TGUser.get_or_create(
+    history_writer.add_user(
         id=user.id,
-        defaults={
-            'name': user.name,
-            'username': user.username,
-            'is_bot': user.is_bot,
-            'full_name': user.full_name,
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-        },
+        name=user.name,
+        username=user.username,
+        is_bot=user.is_bot,
+        full_name=user.full_name,
+        first_name=user.first_name,
+        last_name=user.last_name,
     )
-
-
-    return models.ChatHistory.create(
-        chat = message.chat_id,
-        message_id = message.id,
-        text = message.text or '',
-        from_user = tg_user,
-        reply_to = save_history(message.reply_to_message) if message.reply_to_message else None
+    history_writer.add_message(
+        chat_id=message.chat_id,
+        message_id=message.id,
+        text=message.text or '',
+        from_user_id=user.id,
+        reply_to_message_id=reply_to.id if reply_to else None,
     )
 
 def split_message(msg: str, *, with_photo: bool) -> list[str]:
@@ -93,6 +101,7 @@ def split_message(msg: str, *, with_photo: bool) -> list[str]:
 
     return parts
 
+@tracing.traced()
 async def send_long_message(message: telegram.Message, text: str, parse_mode: str | None= None):
 
     for part in split_message(text, with_photo=False):
@@ -101,10 +110,64 @@ async def send_long_message(message: telegram.Message, text: str, parse_mode: st
             parse_mode=parse_mode
         )
 
+async def _edit_message(message: telegram.Message, text: str) -> None:
+    """Отредактировать сообщение с учетом ограничений Telegram"""
+    try:
+        await message.edit_text(text=text)
+    except telegram.error.RetryAfter as exc:
+        log.info("Edit flood control, retry after %s", exc.retry_after)
+        await asyncio.sleep(exc.retry_after)
+        await message.edit_text(text=text)
+    except telegram.error.BadRequest as exc:
+        if "not modified" not in str(exc):
+            raise
+
+@tracing.traced()
+async def send_streaming_message(message: telegram.Message, deltas: typing.AsyncIterator[str]):
+    """Отправить ответ по мере генерации.
+
+    Сначала отправляется заглушка, которая редактируется не чаще STREAM_EDIT_INTERVAL.
+    Когда текст перестает влезать в одно сообщение, оно фиксируется и начинается новое.
+    При отмене текущее недописанное сообщение удаляется.
+    """
+    loop = asyncio.get_running_loop()
+    sent = await message.reply_text(text=STREAM_PLACEHOLDER)
+    text = ""
+    shown = ""
+    last_edit = loop.time()
+
+    try:
+        async for delta in deltas:
+            text += delta
+
+            while len(parts := split_message(text, with_photo=False)) > 1:
+                await _edit_message(sent, parts[0])
+                text = text[len(parts[0]) :].lstrip()
+                sent = await message.reply_text(text=STREAM_PLACEHOLDER)
+                shown = ""
+                last_edit = loop.time()
+
+            visible = text.strip()
+            if visible and visible != shown and loop.time() - last_edit >= config.STREAM_EDIT_INTERVAL:
+                await _edit_message(sent, visible)
+                shown = visible
+                last_edit = loop.time()
+    except asyncio.CancelledError:
+        # ответ отменен новым сообщением - недописанную часть убираем
+        await sent.delete()
+        raise
+
+    visible = text.strip()
+    if not visible:
+        await sent.delete()
+    elif visible != shown:
+        await _edit_message(sent, visible)
+
+@metrics.handler
 async def request(update: telegram.Update, context: CallbackContext):
     log.debug("request %s", update.message.text if update.message else "No message")
 
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     if not update.message or not update.message.text:
@@ -116,22 +179,33 @@ async def request(update: telegram.Update, context: CallbackContext):
     # вырезаем команду /request
     message = ' '.join(update.message.text.split(' ')[1:]).strip()
 
-    chat = models.Chat.get_by_id(update.message.chat_id)
+    chat = await queries.get_chat(update.message.chat_id)
     if not chat:
         log.error("Chat not found")
         return
 
-    answer = chat_gpt.get_answer(
+    if config.STREAM_ANSWERS:
+        deltas = chat_gpt.astream_answer(
+            prompt=chat.prompt,
+            message=message,
+            conversation_id=chat.id,
+            cache=chat.response_cache,
+        )
+        return await send_streaming_message(update.message, deltas)
+
+    answer = await chat_gpt.aget_answer(
         prompt=chat.prompt,
         message=message,
         conversation_id=chat.id,
+        cache=chat.response_cache,
     )
-    await send_long_message(update.message, answer)
+    return await send_long_message(update.message, answer)
 
+@metrics.handler
 async def on_message(update: telegram.Update, context: CallbackContext):
     log.debug("on_message %s", update.message.text)
 
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
     save_history(update.message)
 
@@ -144,23 +218,51 @@ async def on_message(update: telegram.Update, context: CallbackContext):
         update.message.text
         and update.message.text.startswith(config.BANANO_PREFIX)
     ):
-        return await generate_image_from_photo(update=update, context=context)
+        await generate_image_from_photo(update=update, context=context)
+        return
+
+    chat = await queries.get_chat(update.message.chat_id)
+    if not chat or chat.mode != "member":
+        return
+
+    member_coalescer.submit(update.message)
 
-    chat = models.Chat.get_by_id(update.message.chat_id)
-    if chat.mode != "member":
+
+@metrics.handler
+async def answer_messages(messages: list[telegram.Message]):
+    """Ответить одним запросом на несколько подряд идущих сообщений чата"""
+    message = messages[-1]
+    chat = await queries.get_chat(message.chat_id)
+    if not chat or chat.mode != "member":
         return
 
-    answer = chat_gpt.get_answer(
+    text = "\n".join(m.text for m in messages if m.text)
+    if config.STREAM_ANSWERS:
+        deltas = chat_gpt.astream_answer(
+            prompt=chat.prompt,
+            message=text,
+            conversation_id=chat.id,
+            priority=Priority.LOW,
+            cache=chat.response_cache,
+        )
+        return await send_streaming_message(message, deltas)
+
+    answer = await chat_gpt.aget_answer(
         prompt=chat.prompt,
-        message=update.message.text,
+        message=text,
         conversation_id=chat.id,
+        priority=Priority.LOW,
+        cache=chat.response_cache,
     )
+    return await send_long_message(message, answer)
 
-    return await send_long_message(update.message, answer)
+
+member_coalescer = ChatCoalescer(answer_messages)
 
 
+@metrics.handler
 async def tldr(update: telegram.Update, context: CallbackContext):
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
     log.info('run tldr')
     # remove command
@@ -179,36 +281,14 @@ async def tldr(update: telegram.Update, context: CallbackContext):
             except ValueError:
                 log.info(f'Not chat_id {messages[1]}')
 
-    log.info(f'tldr {chat_id=}, {log_cnt=}')
-    history = list(
-        models.ChatHistory.select(models.ChatHistory, models.TGUser)
-        .join(models.TGUser)
-        .where(
-            models.ChatHistory.chat_id==chat_id,
-        ).order_by(
-            models.ChatHistory.created_at.desc()
-        ).limit(log_cnt)
-    )
+    if not messages and config.DIGEST_ENABLED:
+        answer = await digest.tldr_from_digest(chat_id)
+        if answer:
+            return await send_long_message(update.message, answer)
 
-    history.reverse()
-    _columns = [
-        'id',
-        'reply_to_id',
-        'from_user.username',
-        'created_at',
-        'text',
-    ]
-
-    rows = [' | '.join(_columns)]
-    for row in history:
-        values = [str(models.get_attr(row, col)) for col in _columns]
-        rows.append(' | '.join(values))
-
-
-    answer = chat_gpt.get_answer(
-        prompt=config.SUMARIZE_PROMT,
-        message='\\n'.join(rows),
-        conversation_id=None,
-    )
+    log_cnt = min(max(log_cnt, 1), config.TLDR_MAX_MESSAGES)
+    log.info(f'tldr {chat_id=}, {log_cnt=}')
+    history = await queries.get_transcript(chat_id, log_cnt)
+    answer = await summarize.summarize_history(chat_id, history.header, history.rows)
 
-    await send_long_message(update.message, answer)
+    return await send_long_message(update.message, answer)
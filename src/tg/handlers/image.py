@@ -1,31 +1,34 @@
 import logging
 import random
-from collections import defaultdict
-from datetime import date
 
 import telegram
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from src import config
-from src.database import models
-from src.image_gen import ImageGenerator
-from src.open_ai import chat_gpt
+from src import config, metrics
+from src.cache import MISSING
+from src.constants import JobKind
+from src.database import queries
+from src.ratelimit import image_fail_limiter, image_limiter
 from src.tg import utils
+from src.tg.image_jobs import CANCEL_JOB_PREFIX, CAPTIONS, image_jobs
+from src.tg.photos import output_cache
 
 from ..utils import check_access_to_chat
 
 log = logging.getLogger(__name__)
-fails_by_date = defaultdict(int)
-cnt_by_chat = defaultdict(int)
+LIMIT_MESSAGE = "Упс! Лимит генераций исчерпан, попробуйте позже"
+IMAGE_GENERATOR = "image_generator"
 
+
+@metrics.handler
 async def generate_image(update: Update, context: CallbackContext):
     """Генерация изображения по описанию"""
     log.debug("generate_image command")
     if not config.IMAGE_GEN:
         return
 
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message = update.message
@@ -40,12 +43,14 @@ async def generate_image(update: Update, context: CallbackContext):
     # Получаем промпт из сообщения или используем случайный
     prompt = ' '.join(message.text.split(' ')[1:]).strip()
 
-    if fails_by_date[date.today()] > 3:
+    if not await image_fail_limiter.available():
         log.info("Закончились попытки на сегодня!")
         return
 
+    # Свой промпт переводится на английский уже в задаче
+    translate = bool(prompt)
     if not prompt:
-        prompts = list(models.ImagePrompt.select())
+        prompts = await queries.get_image_prompts()
         if not prompts:
             await context.bot.send_message(
                 chat_id=message.chat_id,
@@ -55,33 +60,17 @@ async def generate_image(update: Update, context: CallbackContext):
 
         random_prompt = random.choice(prompts)
         prompt = random_prompt.prompt
-    else:
-        prompt = chat_gpt.get_answer(
-            prompt=config.DEFAULT_PROMPT_IMAGE,
-            message=prompt,
-            conversation_id=None,
-        )
-    # Генерируем изображение
-    generator = ImageGenerator()
-    image_data = await generator.generate_image(prompt)
 
-    if not image_data:
-        fails_by_date[date.today()] += 1
-        log.debug("Не удалось сгенерировать изображение.")
+    user_id = message.from_user.id if message.from_user else None
+    if not await image_limiter.acquire(message.chat_id, user_id):
         if is_command:
-            await context.bot.send_message(
-                chat_id=message.chat_id,
-                text="Уууу! Бесплатный генератор не всегда может",
-                parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
-            )
+            await message.reply_text(LIMIT_MESSAGE)
         return
 
-    await message.reply_photo(
-        photo=image_data,
-        caption="🎨 Что то интересное",
-    )
+    await image_jobs.enqueue(JobKind.text, message, prompt, translate=translate)
 
 
+@metrics.handler
 async def generate_image_from_photo(update: Update, context: CallbackContext):
     """Generate an image based on a photo and prompt"""
     log.debug("generate_image_from_photo command")
@@ -89,7 +78,7 @@ async def generate_image_from_photo(update: Update, context: CallbackContext):
     if not config.IMAGE_GEN:
         return
 
-    if not check_access_to_chat(update):
+    if not await check_access_to_chat(update):
         return
 
     message = update.message
@@ -98,13 +87,6 @@ async def generate_image_from_photo(update: Update, context: CallbackContext):
         log.error("Update message or chat is None")
         return
 
-    if cnt_by_chat[f"{message.chat_id}_{date.today()}"] > 100:
-        await context.bot.send_message(
-            chat_id=message.chat_id,
-            text="Упс! ну все все !",
-            parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
-        )
-
     # Check if message contains photo and caption (prompt)
     message_photo = message.photo
     message_caption = message.caption or message.text
@@ -127,30 +109,27 @@ async def generate_image_from_photo(update: Update, context: CallbackContext):
         return
     prompt = utils.remove_any_prefix(prompt, config.BANANO_PREFIX).strip()
 
-    photo_url = None
-    if message_photo:
-        photo = message_photo[-1] # Get the largest photo
-        # Get file URL from Telegram
-        file = await context.bot.get_file(photo.file_id)
-        photo_url = file.file_path
-
-    # Generate image from photo and prompt
-    generator = ImageGenerator()
-    image_data = await generator.generate_image_from_photo(prompt, photo_url)
+    photo = message_photo[-1] if message_photo else None  # Get the largest photo
+    output_key = (photo.file_unique_id if photo else None, prompt, config.IMAGE_TO_IMAGE_MODEL)
+    if (file_id := output_cache.get(output_key)) is not MISSING:
+        await message.reply_photo(photo=file_id, caption=CAPTIONS[JobKind.photo].format(prompt=prompt))
+        return
 
-    if not image_data:
-        log.debug("Не удалось сгенерировать изображение.")
-        await context.bot.send_message(
-            chat_id=message.chat_id,
-            text="Упс Что то пошло не так",
-            parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
-        )
+    user_id = message.from_user.id if message.from_user else None
+    if not await image_limiter.acquire(message.chat_id, user_id):
+        await message.reply_text(LIMIT_MESSAGE)
         return
 
-    cnt_by_chat[f"{message.chat_id}_{date.today()}"] += 1
-    log.debug(f'''cnt_by_chat={ cnt_by_chat[f"{message.chat_id}_{date.today()}"]}''')
+    await image_jobs.enqueue(JobKind.photo, message, prompt, photo=photo)
+
+
+async def cancel_image_job(query: telegram.CallbackQuery) -> bool:
+    """Кнопка отмены под статусом задачи"""
+    try:
+        job_id = int(query.data.removeprefix(CANCEL_JOB_PREFIX))
+    except ValueError:
+        log.error("Bad job id in %s", query.data)
+        return False
 
-    await message.reply_photo(
-        photo=image_data,
-        caption=f"🎨 Generated from your photo with prompt: {prompt}",
-    )
+    user_id = query.from_user.id
+    return await image_jobs.cancel(job_id, user_id, is_admin=await queries.is_admin(user_id))
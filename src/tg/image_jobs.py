@@ -0,0 +1,291 @@
+"""Очередь задач генерации картинок.
+
+Хендлер создает задачу в таблице ImageJob, отправляет сообщение со статусом и
+сразу возвращается. Воркеры выполняют задачи по очереди, при ошибке задача
+возвращается в очередь с экспоненциальной задержкой. Адрес готовой картинки
+сохраняется в задаче, и повтор после ошибки отправки не генерирует ее заново. Статусное сообщение
+показывает позицию в очереди и ход генерации, кнопка под ним отменяет задачу.
+"""
+
+import asyncio
+import functools
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import telegram
+from replicate.helpers import FileOutput
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from src import config
+from src.constants import JobKind, JobStatus
+from src.database import models
+from src.database.executor import db_executor
+from src.image_gen import ImageGenerator
+from src.open_ai import chat_gpt
+from src.ratelimit import image_fail_limiter, image_limiter
+from src.scheduler import image_scheduler
+from src.tg.cluster import owns
+from src.tg.photos import load_photo, output_cache, send_generated_photo
+
+log = logging.getLogger(__name__)
+CANCEL_JOB_PREFIX = "cancel_job_"
+CAPTIONS = {
+    JobKind.text: "🎨 Что то интересное",
+    JobKind.photo: "🎨 Generated from your photo with prompt: {prompt}",
+}
+FAILURES = {
+    JobKind.text: "Уууу! Бесплатный генератор не всегда может",
+    JobKind.photo: "Упс Что то пошло не так",
+}
+
+
+def _cancel_markup(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"{CANCEL_JOB_PREFIX}{job_id}")]])
+
+
+class ImageJobQueue:
+    def __init__(
+        self,
+        workers: int = config.IMAGE_JOB_WORKERS,
+        attempts: int = config.IMAGE_JOB_ATTEMPTS,
+        backoff: float = config.IMAGE_JOB_BACKOFF,
+    ):
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.bot: telegram.Bot | None = None
+        self.generator: ImageGenerator | None = None
+        self._queue: asyncio.Queue[int] | None = None
+        self._waiting: OrderedDict[int, models.ImageJob] = OrderedDict()
+        self._running: dict[int, asyncio.Task] = {}
+        self._retries: dict[int, asyncio.TimerHandle] = {}
+        self._positions: dict[int, int] = {}
+        self._refresh = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    async def start(self, bot: telegram.Bot, generator: ImageGenerator, shard: tuple[int, int] | None = None):
+        """Загрузить незавершенные задачи (только своих чатов при нескольких процессах) и запустить воркеры"""
+        self.bot = bot
+        self.generator = generator
+        self._queue = asyncio.Queue()
+        self._refresh = asyncio.Event()
+
+        before = datetime.now() - timedelta(seconds=config.IMAGE_JOB_RETENTION)
+        await db_executor.run(models.ImageJob.purge, before)
+        pending = await db_executor.run(models.ImageJob.pending, functools.partial(owns, shard))
+        for job in pending:
+            self._push(job)
+        if pending:
+            log.info("Restored %s image jobs", len(pending))
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._refresher()))
+
+    async def stop(self):
+        """Остановить воркеры, прерванные задачи выполнятся после перезапуска"""
+        for handle in self._retries.values():
+            handle.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._retries.clear()
+        self._waiting.clear()
+        self._positions.clear()
+
+    async def enqueue(
+        self,
+        kind: JobKind,
+        message: telegram.Message,
+        prompt: str,
+        translate: bool = False,
+        photo: telegram.PhotoSize | None = None,
+    ) -> models.ImageJob:
+        """Поставить задачу в очередь и показать статус"""
+        job = await db_executor.run(
+            models.ImageJob.create,
+            kind=kind.value,
+            chat_id=message.chat_id,
+            user_id=message.from_user.id if message.from_user else None,
+            message_id=message.message_id,
+            prompt=prompt,
+            translate=translate,
+            photo_file_id=photo.file_id if photo else None,
+            photo_unique_id=photo.file_unique_id if photo else None,
+        )
+        position = len(self._waiting) + 1
+        status = await message.reply_text(self._position_text(position), reply_markup=_cancel_markup(job.id))
+        job.status_message_id = status.message_id
+        await db_executor.run(models.ImageJob.update_job, job.id, status_message_id=status.message_id)
+        self._positions[job.id] = position
+        self._push(job)
+        return job
+
+    async def cancel(self, job_id: int, user_id: int, is_admin: bool = False) -> bool:
+        """Отменить задачу (автором задачи или админом)"""
+        job = await db_executor.run(models.ImageJob.get_or_none, models.ImageJob.id == job_id)
+        if not job or JobStatus(job.status) not in (JobStatus.queued, JobStatus.running):
+            return False
+        if job.user_id != user_id and not is_admin:
+            return False
+
+        if task := self._running.get(job_id):
+            # воркер сам запишет отмену
+            task.cancel()
+            return True
+
+        self._waiting.pop(job_id, None)
+        if handle := self._retries.pop(job_id, None):
+            handle.cancel()
+        await self._finish(job, JobStatus.cancelled, "❌ Отменено")
+        self._refresh.set()
+        return True
+
+    def _push(self, job: models.ImageJob):
+        self._retries.pop(job.id, None)
+        self._waiting[job.id] = job
+        self._queue.put_nowait(job.id)
+
+    def _position_text(self, position: int) -> str:
+        return f"⏳ В очереди: {position}"
+
+    async def _edit_status(self, job: models.ImageJob, text: str, cancellable: bool = True):
+        if not job.status_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job.chat_id,
+                message_id=job.status_message_id,
+                text=text,
+                reply_markup=_cancel_markup(job.id) if cancellable else None,
+            )
+        except telegram.error.TelegramError as exc:
+            log.debug("Status of job %s not updated: %s", job.id, exc)
+
+    async def _delete_status(self, job: models.ImageJob):
+        if not job.status_message_id:
+            return
+        try:
+            await self.bot.delete_message(chat_id=job.chat_id, message_id=job.status_message_id)
+        except telegram.error.TelegramError as exc:
+            log.debug("Status of job %s not deleted: %s", job.id, exc)
+
+    async def _refresher(self):
+        """Обновить позиции в статусах ожидающих задач"""
+        while True:
+            await self._refresh.wait()
+            self._refresh.clear()
+            for position, job in enumerate(list(self._waiting.values()), 1):
+                if position > config.IMAGE_JOB_STATUS_LIMIT:
+                    break
+                if self._positions.get(job.id) != position:
+                    self._positions[job.id] = position
+                    await self._edit_status(job, self._position_text(position))
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self._waiting.pop(job_id, None)
+            if job is None:
+                # задачу отменили, пока она ждала
+                continue
+            self._positions.pop(job_id, None)
+            self._refresh.set()
+
+            task = asyncio.create_task(self._run(job))
+            self._running[job_id] = task
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                self._running.pop(job_id, None)
+
+            if task.cancelled():
+                await self._finish(job, JobStatus.cancelled, "❌ Отменено")
+
+    async def _run(self, job: models.ImageJob):
+        job.attempts += 1
+        await db_executor.run(
+            models.ImageJob.update_job, job.id, status=JobStatus.running.value, attempts=job.attempts
+        )
+        attempt = f" (попытка {job.attempts})" if job.attempts > 1 else ""
+        await self._edit_status(job, f"🎨 Генерирую{attempt}…")
+
+        try:
+            if job.output_url:
+                # картинка уже сгенерирована, не удалось только отправить ее
+                output = FileOutput(job.output_url, self.generator.replicate)
+            else:
+                output = await self._generate(job)
+                if output:
+                    job.output_url = output.url
+                    await db_executor.run(models.ImageJob.update_job, job.id, output_url=job.output_url)
+            if output:
+                await self._send(job, output)
+                await self._delete_status(job)
+                await db_executor.run(models.ImageJob.update_job, job.id, status=JobStatus.done.value, error=None)
+                return
+            error = "empty output"
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            log.exception("Image job %s failed", job.id)
+            error = str(exc)
+
+        if job.attempts < self.attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            await db_executor.run(
+                models.ImageJob.update_job, job.id, status=JobStatus.queued.value, error=error
+            )
+            await self._edit_status(job, f"⚠️ Не получилось, повторю через {delay:.0f} с")
+            self._retries[job.id] = asyncio.get_running_loop().call_later(delay, self._push, job)
+            return
+
+        job.error = error
+        kind = JobKind(job.kind)
+        if kind == JobKind.text:
+            await image_fail_limiter.acquire()
+        await self._finish(job, JobStatus.failed, FAILURES[kind])
+
+    async def _generate(self, job: models.ImageJob) -> FileOutput | None:
+        if JobKind(job.kind) == JobKind.text:
+            if job.translate:
+                prompt = await chat_gpt.aget_answer(
+                    prompt=config.DEFAULT_PROMPT_IMAGE,
+                    message=job.prompt,
+                    conversation_id=None,
+                    chat_id=job.chat_id,
+                )
+                if not prompt or prompt == chat_gpt.ERROR_MESSAGE:
+                    # задача уйдет на повтор с исходным промптом
+                    raise RuntimeError("prompt translation failed")
+                job.prompt, job.translate = prompt, False
+                await db_executor.run(models.ImageJob.update_job, job.id, prompt=job.prompt, translate=False)
+            async with image_scheduler.slot(job.chat_id):
+                return await self.generator.generate_image(job.prompt)
+
+        photo = await load_photo(self.bot, job.photo_file_id, job.photo_unique_id) if job.photo_file_id else None
+        async with image_scheduler.slot(job.chat_id):
+            return await self.generator.generate_image_from_photo(job.prompt, photo)
+
+    async def _send(self, job: models.ImageJob, output: FileOutput):
+        kind = JobKind(job.kind)
+        caption = CAPTIONS[kind].format(prompt=job.prompt)
+        sent = await send_generated_photo(self.bot, job.chat_id, job.message_id, self.generator, output, caption)
+        if kind == JobKind.photo and sent.photo:
+            output_cache.set((job.photo_unique_id, job.prompt, config.IMAGE_TO_IMAGE_MODEL), sent.photo[-1].file_id)
+
+    async def _finish(self, job: models.ImageJob, status: JobStatus, text: str):
+        """Завершить задачу без результата, вернуть токен лимита"""
+        await db_executor.run(models.ImageJob.update_job, job.id, status=status.value, error=job.error)
+        await image_limiter.refund(job.chat_id, job.user_id)
+        await self._edit_status(job, text, cancellable=False)
+
+
+image_jobs = ImageJobQueue()
@@ -0,0 +1,62 @@
+"""Входные фото и отправка результатов генерации картинок"""
+
+import asyncio
+import logging
+from pathlib import Path
+
+import telegram
+from replicate.helpers import FileOutput
+
+from src import config
+from src.cache import MISSING, TTLCache
+from src.image_gen import ImageGenerator
+from src.image_gen.disk_cache import DiskLRU
+
+log = logging.getLogger(__name__)
+
+# Файлы Telegram и скачанные фото по file_unique_id, отправленные результаты
+photo_files: TTLCache[str, telegram.File] = TTLCache(maxsize=config.IMAGE_OUTPUT_CACHE_SIZE, ttl=config.PHOTO_FILE_TTL)
+photo_cache = DiskLRU(config.PHOTO_CACHE_DIR, config.PHOTO_CACHE_MAX_BYTES)
+output_cache: TTLCache[tuple[str | None, str, str], str] = TTLCache(
+    maxsize=config.IMAGE_OUTPUT_CACHE_SIZE, ttl=config.IMAGE_OUTPUT_CACHE_TTL
+)
+
+
+async def load_photo(bot: telegram.Bot, file_id: str, file_unique_id: str) -> Path:
+    """Локальная копия фото: из кэша на диске или скачанная из Telegram.
+
+    Модели отдается файл, а не ссылка Telegram: в ссылке есть токен бота.
+    """
+    if path := await asyncio.to_thread(photo_cache.get, file_unique_id):
+        return path
+
+    file = photo_files.get(file_unique_id)
+    if file is MISSING:
+        file = await bot.get_file(file_id)
+        photo_files.set(file_unique_id, file)
+    data = await file.download_as_bytearray()
+    return await asyncio.to_thread(photo_cache.put, file_unique_id, data)
+
+
+async def send_generated_photo(
+    bot: telegram.Bot,
+    chat_id: int,
+    reply_to_message_id: int | None,
+    generator: ImageGenerator,
+    output: FileOutput,
+    caption: str,
+) -> telegram.Message:
+    """Отправить результат генерации.
+
+    Если у результата есть http URL, Telegram скачивает картинку сам и бот ее не
+    держит в памяти. Иначе (или если Telegram не смог скачать) байты читаются
+    один раз и отдаются на загрузку без промежуточных копий.
+    """
+    kwargs = {"chat_id": chat_id, "caption": caption, "reply_to_message_id": reply_to_message_id}
+    if output.url.startswith(("http://", "https://")):
+        try:
+            return await bot.send_photo(photo=output.url, **kwargs)
+        except telegram.error.BadRequest as exc:
+            log.warning("Telegram could not fetch %s: %s", output.url, exc)
+
+    return await bot.send_photo(photo=await generator.read(output), **kwargs)
@@ -1,9 +1,16 @@
+import asyncio
 import logging
 import os
+from datetime import datetime
 
-from telethon.sync import Message, TelegramClient
+import peewee
+from telethon import TelegramClient
+from telethon.tl.custom import Message
 
+from src import config
 from src.database import models
+from src.database.executor import db_executor
+from src.database.history import INSERT_BATCH_SIZE, write_batch
 
 log = logging.getLogger(__name__)
 
@@ -15,65 +22,147 @@ def load_tg_client() -> TelegramClient:
     return TelegramClient("session_name", api_id, api_hash)
 
 
-async def _save_history(message: Message, client: TelegramClient) -> tuple[bool, bool]:
-    user_id = message.from_id.user_id
-    user_added = False
-    msg_added = False
-
-    if not (tg_user := models.TGUser.get_or_none(id=user_id)):
-        user_entity = await client.get_entity(user_id)
-        full_name = ' '.join(filter(None, [user_entity.first_name, user_entity.last_name]))
-        tg_user, _  = models.TGUser.get_or_create(
-            id=user_id,
-            defaults={
-                'name': user_entity.username,
-                'username': user_entity.username,
-                'is_bot': user_entity.bot,
-                'full_name': full_name,
-                'first_name': user_entity.first_name,
-                'last_name': user_entity.last_name,
-            },
+def _user_row(user_id: int, user=None) -> dict:
+    """Строка TGUser, без user (не удалось получить) сохраняем только id"""
+    now = datetime.now()
+    first_name = getattr(user, 'first_name', None)
+    last_name = getattr(user, 'last_name', None)
+    username = getattr(user, 'username', None)
+    full_name = ' '.join(filter(None, [first_name, last_name]))
+    return {
+        'id': user_id,
+        'created_at': now,
+        'updated_at': now,
+        'name': username or full_name or str(user_id),
+        'username': username or '',
+        'is_bot': bool(getattr(user, 'bot', False)),
+        'full_name': full_name,
+        'first_name': first_name,
+        'last_name': last_name,
+    }
+
+
+def _message_row(message: Message) -> dict:
+    return {
+        'created_at': message.date,
+        'updated_at': message.date,
+        'chat': message.chat_id,
+        'message_id': message.id,
+        'text': message.text,
+        'from_user': message.sender_id,
+        'reply_to_message_id': message.reply_to_msg_id,
+    }
+
+
+def _write_page(
+    chat_id: int, users: list[dict], placeholders: list[dict], rows: list[dict], last_message_id: int, imported: int
+):
+    """Страница истории и чекпоинт одной транзакцией.
+
+    Заглушки для неразрешенных пользователей только создаются и не перезаписывают
+    уже сохраненные данные пользователя.
+    """
+    with models.BaseModel._meta.database.atomic():
+        for batch in peewee.chunked(placeholders, INSERT_BATCH_SIZE):
+            models.TGUser.insert_many(batch).on_conflict_ignore().execute()
+        write_batch(users, rows)
+        models.ImportCheckpoint.save_progress(chat_id, last_message_id, imported)
+
+
+class HistoryImporter:
+    """Импорт всей истории чата страницами, от старых сообщений к новым.
+
+    Пользователи берутся из msg.sender (приходят вместе с сообщениями), остальные
+    запрашиваются одним get_entity на страницу. Пока страница пишется в БД,
+    читается следующая. После каждой страницы сохраняется последний message_id,
+    прерванный импорт продолжается с него.
+    """
+
+    def __init__(self, client: TelegramClient, page_size: int = config.IMPORT_PAGE_SIZE):
+        self.client = client
+        self.page_size = page_size
+        self._known_users: set[int] = set()
+
+    async def _resolve_users(self, page: list[Message]) -> tuple[list[dict], list[dict]]:
+        """Строки пользователей страницы: полученные из Telegram и заглушки для остальных"""
+        users = {}
+        placeholders = {}
+        missing = set()
+        for message in page:
+            user_id = message.sender_id
+            if user_id in self._known_users or user_id in users:
+                continue
+            if hasattr(message.sender, 'first_name'):
+                users[user_id] = _user_row(user_id, message.sender)
+            else:
+                missing.add(user_id)
+
+        missing -= users.keys()
+        if missing:
+            try:
+                entities = await self.client.get_entity(list(missing))
+            except ValueError as exc:
+                log.warning('Users not resolved %s: %s', missing, exc)
+                entities = []
+            users.update((entity.id, _user_row(entity.id, entity)) for entity in entities)
+            for user_id in missing - users.keys():
+                placeholders[user_id] = _user_row(user_id)
+
+        # заглушки не запоминаем: на следующих страницах пользователь может найтись
+        self._known_users.update(users)
+        return list(users.values()), list(placeholders.values())
+
+    async def run(self, chat_id: int) -> int:
+        """Импортировать историю чата, вернуть число импортированных сообщений"""
+        checkpoint = await db_executor.run(
+            models.ImportCheckpoint.get_or_none, models.ImportCheckpoint.chat_id == chat_id
         )
-        log.info('User added %s', tg_user)
-        user_added = True
-
-    reply_history_msg = None
-    if message.reply_to_msg_id:
-        reply_history_msg = models.ChatHistory.get_or_none(chat_id=message.chat_id, message_id=message.reply_to_msg_id)
-
-    if not models.ChatHistory.get_or_none(
-        message_id=message.id,
-        chat=message.chat_id,
-    ) and message.text:
-        models.ChatHistory.create(
-            created_at=message.date,
-            chat = message.chat_id,
-            message_id = message.id,
-            text = message.text,
-            from_user = tg_user,
-            reply_to = reply_history_msg if reply_history_msg else None
+        last_message_id = checkpoint.last_message_id if checkpoint else 0
+        imported = checkpoint.imported if checkpoint else 0
+        if last_message_id:
+            log.info('Resume import of %s after message %s (%s imported)', chat_id, last_message_id, imported)
+
+        page: list[Message] = []
+        writing: asyncio.Future | None = None
+        async for message in self.client.iter_messages(
+            chat_id, min_id=last_message_id, reverse=True, wait_time=config.IMPORT_WAIT_TIME
+        ):
+            last_message_id = message.id
+            if message.text and message.sender_id:
+                page.append(message)
+            if len(page) < self.page_size:
+                continue
+
+            imported += len(page)
+            writing = await self._write(chat_id, page, last_message_id, imported, writing)
+            page = []
+
+        imported += len(page)
+        writing = await self._write(chat_id, page, last_message_id, imported, writing)
+        await writing
+        log.info('Import of %s finished: %s messages', chat_id, imported)
+        return imported
+
+    async def _write(
+        self, chat_id: int, page: list[Message], last_message_id: int, imported: int, previous: asyncio.Future | None
+    ) -> asyncio.Future:
+        """Запустить запись страницы, дождавшись предыдущей (чекпоинты пишутся по порядку)"""
+        users, placeholders = await self._resolve_users(page)
+        rows = [_message_row(message) for message in page]
+        if previous is not None:
+            await previous
+        log.info('Import %s: page of %s messages, up to %s', chat_id, len(rows), last_message_id)
+        return asyncio.ensure_future(
+            db_executor.run(_write_page, chat_id, users, placeholders, rows, last_message_id, imported)
         )
-        log.info(f'Message added {message.text[:20]}...')
-        msg_added = True
 
-    return (msg_added, user_added)
 
 async def get_messages(chat_id):
     client = load_tg_client()
     phone = os.getenv('SCRIPT_TELEGRAM_PHONE')
     password = os.getenv('SCRIPT_TELEGRAM_PASSWORD')
 
-    client.start(phone=phone, password=password)
+    await client.start(phone=phone, password=password)
     async with client:
-        messages = await client.get_messages(int(chat_id), limit=200)
-        messages.reverse()
-
-        cnt_msg = 0
-        cnt_users = 0
-
-        for msg in messages:
-            m, u = await _save_history(message=msg, client=client)
-            cnt_msg += m
-            cnt_users += u
-
-        log.info(f'Обработка закончена: {cnt_msg=}, {cnt_users=}')
+        await HistoryImporter(client).run(int(chat_id))
+    db_executor.shutdown()
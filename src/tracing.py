@@ -0,0 +1,282 @@
+"""Трассировка обработки апдейтов.
+
+На каждый апдейт открывается корневой span, вложенные span-ы (хендлер, запросы
+к БД, вызовы OpenAI/Replicate/Telegram, ожидание слота планировщика) берут
+родителя из contextvars. Span-ы копятся в памяти и после завершения корня
+записываются одной строкой JSON в логгер traces (файл TRACE_FILE из log_tools),
+если трассу выбрало сэмплирование или она дольше TRACE_SLOW_SECONDS.
+
+Строка трассы: {"trace", "name", "ts", "ms", "attrs", "spans"}, span -
+[id, id родителя, имя, начало от корня в мс, длительность в мс, атрибуты?].
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+from collections.abc import Iterable, Iterator
+
+from src import config
+
+log = logging.getLogger(__name__)
+trace_log = logging.getLogger("traces")
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "finished", "sampled", "follows")
+
+    def __init__(self, sampled: bool, follows: str | None = None):
+        self.trace_id = os.urandom(8).hex()
+        self.spans: list[Span] = []
+        self.finished = False
+        self.sampled = sampled
+        self.follows = follows
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "duration", "attrs")
+
+    def __init__(self, trace: Trace, parent_id: int | None, name: str, attrs: dict):
+        self.trace = trace
+        self.span_id = len(trace.spans)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.attrs = attrs
+        trace.spans.append(self)
+
+
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar("trace_span", default=None)
+
+
+def _record(trace: Trace, root: Span, wall_start: float):
+    spans = []
+    for span in trace.spans[1:]:
+        item = [
+            span.span_id,
+            span.parent_id,
+            span.name,
+            round((span.start - root.start) * 1000, 3),
+            round(span.duration * 1000, 3),
+        ]
+        if span.attrs:
+            item.append(span.attrs)
+        spans.append(item)
+    record = {
+        "trace": trace.trace_id,
+        "name": root.name,
+        "ts": round(wall_start, 3),
+        "ms": round(root.duration * 1000, 3),
+        "attrs": root.attrs,
+        "spans": spans,
+    }
+    if trace.follows:
+        record["follows"] = trace.follows
+    trace_log.info(json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=str))
+
+
+@contextlib.contextmanager
+def _root(name: str, follows: str | None, attrs: dict) -> Iterator[Span | None]:
+    """Корневой span без установки текущего, запись трассы после его конца"""
+    if not config.TRACING_ENABLED:
+        yield None
+        return
+
+    current = Trace(sampled=random.random() < config.TRACE_SAMPLE_RATE, follows=follows)
+    root = Span(current, None, name, attrs)
+    wall_start = time.time()
+    try:
+        yield root
+    except GeneratorExit:
+        raise
+    except BaseException as exc:
+        root.attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        current.finished = True
+        if current.sampled or root.duration >= config.TRACE_SLOW_SECONDS:
+            try:
+                _record(current, root, wall_start)
+            except Exception:
+                log.exception("Trace %s not written", current.trace_id)
+
+
+@contextlib.contextmanager
+def _child(name: str, attrs: dict) -> Iterator[Span | None]:
+    """Span под текущим без установки текущего"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    if parent.trace.finished:
+        with _root(name, parent.trace.trace_id, attrs) as root:
+            yield root
+        return
+
+    child = Span(parent.trace, parent.span_id, name, attrs)
+    try:
+        yield child
+    except GeneratorExit:
+        raise
+    except BaseException as exc:
+        child.attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        child.duration = time.perf_counter() - child.start
+
+
+@contextlib.contextmanager
+def _activate(current: Span | None) -> Iterator[Span | None]:
+    """Сделать span текущим для вложенных"""
+    if current is None:
+        yield None
+        return
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def trace(name: str, follows: str | None = None, **attrs) -> Iterator[Span | None]:
+    """Корневой span трассы"""
+    with _root(name, follows, attrs) as root, _activate(root):
+        yield root
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs) -> Iterator[Span | None]:
+    """Вложенный span, вне трассы ничего не делает.
+
+    Задачи, запущенные из апдейта, наследуют его контекст. Если они работают
+    после конца трассы (ответ на пачку сообщений), открывается новая трасса со
+    ссылкой follows на исходную.
+    """
+    with _child(name, attrs) as child, _activate(child):
+        yield child
+
+
+def traced(name: str | None = None):
+    """Декоратор: вызов функции (обычной, корутины, асинхронного генератора) в span"""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            async def gen_wrapper(*args, **kwargs):
+                # Между элементами генератор работает в контексте потребителя, поэтому span
+                # текущий только на время каждого шага, а не до конца генератора
+                with _child(span_name, {}) as current:
+                    items = func(*args, **kwargs)
+                    try:
+                        while True:
+                            with _activate(current):
+                                try:
+                                    item = await items.__anext__()
+                                except StopAsyncIteration:
+                                    break
+                            yield item
+                    finally:
+                        with _activate(current):
+                            await items.aclose()
+
+            return gen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def load_traces(lines: Iterable[str]) -> Iterator[dict]:
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            log.warning("Bad trace line %s", number)
+
+
+def breakdown(traces: Iterable[dict]) -> dict[tuple[str, ...], list[float]]:
+    """Время по стекам span-ов: стек -> [количество, общее мс, собственное мс]"""
+    stacks: dict[tuple[str, ...], list[float]] = {}
+    for item in traces:
+        # корень - span 0, его дети ссылаются на него
+        names = {0: item["name"]}
+        parents: dict[int, int | None] = {0: None}
+        durations = {0: item["ms"]}
+        for span_id, parent_id, name, _, duration, *_ in item["spans"]:
+            names[span_id] = name
+            parents[span_id] = parent_id
+            durations[span_id] = duration
+        children_time = dict.fromkeys(names, 0.0)
+        for span_id, parent_id in parents.items():
+            if parent_id is not None:
+                children_time[parent_id] += durations[span_id]
+
+        for span_id in names:
+            stack = []
+            node = span_id
+            while node is not None:
+                stack.append(names[node])
+                node = parents[node]
+            entry = stacks.setdefault(tuple(reversed(stack)), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += durations[span_id]
+            # параллельные дети (gather) могут быть дольше родителя
+            entry[2] += max(durations[span_id] - children_time[span_id], 0.0)
+    return stacks
+
+
+def format_tree(stacks: dict[tuple[str, ...], list[float]], min_percent: float = 0.5) -> str:
+    """Дерево стеков как во flame graph: общее и собственное время, доля от корней"""
+    total = sum(entry[1] for stack, entry in stacks.items() if len(stack) == 1) or 1.0
+    children: dict[tuple[str, ...], list[tuple[str, ...]]] = {}
+    for stack in stacks:
+        children.setdefault(stack[:-1], []).append(stack)
+
+    lines = [f"{'total ms':>12} {'self ms':>12} {'%':>6} {'count':>7}  span"]
+
+    def walk(parent: tuple[str, ...]):
+        for stack in sorted(children.get(parent, []), key=lambda item: -stacks[item][1]):
+            count, span_total, span_self = stacks[stack]
+            percent = span_total / total * 100
+            if percent < min_percent:
+                continue
+            name = "  " * (len(stack) - 1) + stack[-1]
+            lines.append(f"{span_total:12.1f} {span_self:12.1f} {percent:6.1f} {count:7d}  {name}")
+            walk(stack)
+
+    walk(())
+    return "\n".join(lines)
+
+
+def format_folded(stacks: dict[tuple[str, ...], list[float]]) -> str:
+    """Свернутые стеки для flamegraph.pl и speedscope: собственное время в микросекундах"""
+    return "\n".join(
+        f"{';'.join(stack)} {round(entry[2] * 1000)}" for stack, entry in sorted(stacks.items()) if entry[2] > 0
+    )
@@ -1,11 +1,37 @@
 import os
+from unittest import mock
 
 import pytest
 from playhouse.sqlite_ext import SqliteExtDatabase
 
-from src.database.models import BaseModel, BotAdmin, Chat, ImagePrompt
+from src.database.executor import db_executor
+from src.database.models import (
+    BaseModel,
+    BotAdmin,
+    Chat,
+    ChatDigest,
+    ChatHistory,
+    ConversationMessage,
+    ImageJob,
+    ImagePrompt,
+    ImportCheckpoint,
+    RateBucket,
+    SchemaVersion,
+    TGUser,
+    admin_cache,
+    chat_cache,
+)
 
 TEST_DB = "sqlite_db/test.db"
+MODELS = [BaseModel, Chat, BotAdmin, ImagePrompt, TGUser, ChatHistory, SchemaVersion, ConversationMessage,
+          ChatDigest, RateBucket, ImageJob, ImportCheckpoint]
+
+
+def _remove_test_db():
+    """Удаляем тестовую базу вместе с WAL файлами"""
+    for path in (TEST_DB, f"{TEST_DB}-wal", f"{TEST_DB}-shm"):
+        if os.path.exists(path):
+            os.unlink(path)
 
 @pytest.fixture(autouse=True)
 def test_db():
@@ -13,9 +39,7 @@ def test_db():
     # Создаем директорию для базы данных, если её нет
     os.makedirs(os.path.dirname(TEST_DB), exist_ok=True)
 
-    # Удаляем тестовую базу, если она существует
-    if os.path.exists(TEST_DB):
-        os.unlink(TEST_DB)
+    _remove_test_db()
 
     # Создаем новую тестовую базу
     test_db = SqliteExtDatabase(
@@ -26,16 +50,24 @@ def test_db():
     )
 
     # Подменяем базу данных в моделях
-    BaseModel._meta.database = test_db
+    test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
 
     # Создаем таблицы
-    test_db.create_tables([Chat, BotAdmin, ImagePrompt])
+    test_db.create_tables(MODELS[1:])
 
     yield test_db
 
-    # Закрываем соединение
+    # Закрываем соединения, в том числе в потоке БД
+    db_executor.shutdown()
     test_db.close()
+    chat_cache.clear()
+    admin_cache.clear()
+
+    _remove_test_db()
 
-    # Удаляем тестовую базу
-    if os.path.exists(TEST_DB):
-        os.unlink(TEST_DB)
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer():
+    """Не скачиваем словари tiktoken в тестах, считаем токены по длине"""
+    with mock.patch('src.open_ai.tokens.get_encoding', return_value=None):
+        yield
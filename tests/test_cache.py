@@ -0,0 +1,105 @@
+from unittest.mock import patch
+
+import pytest
+
+from src.cache import MISSING, TTLCache
+from src.constants import BotMode
+from src.database import queries
+from src.database.models import Chat, chat_cache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_ttl_cache_expire() -> None:
+    """Запись пропадает по истечении ttl"""
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set(1, None)
+
+    assert cache.get(1) is None
+    timer.now = 6
+    assert cache.get(1) is MISSING
+    assert cache.stats() == {"size": 0, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_ttl_cache_lru() -> None:
+    """При переполнении вытесняется самая давно использованная запись"""
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)
+    cache.set(3, "c")
+
+    assert cache.get(2) is MISSING
+    assert cache.get(1) == "a"
+    assert cache.get(3) == "c"
+
+
+@pytest.mark.asyncio
+async def test_chat_cache_invalidate() -> None:
+    """Изменение настроек чата сбрасывает кэш, повторное чтение идет без БД"""
+    chat_id = 33333333
+
+    assert await queries.get_chat(chat_id) is None
+    Chat.set_mode(chat_id, BotMode.request)
+
+    chat = await queries.get_chat(chat_id)
+    assert chat.mode == BotMode.request.value
+
+    hits = chat_cache.hits
+    with patch.object(Chat, 'get_or_none', side_effect=AssertionError):
+        assert await queries.is_chat_enable(chat_id) is True
+    assert chat_cache.hits == hits + 1
+
+
+def test_ttl_cache_set_skips_value_read_before_invalidate() -> None:
+    cache = TTLCache(maxsize=10, ttl=60)
+    version = cache.version(1)
+    cache.invalidate(1)
+    cache.set(1, "old", version)
+    assert cache.get(1) is MISSING
+
+    version = cache.version(1)
+    cache.clear()
+    cache.set(1, "old", version)
+    assert cache.get(1) is MISSING
+
+    cache.set(1, "new", cache.version(1))
+    assert cache.get(1) == "new"
+
+
+@pytest.mark.asyncio
+async def test_get_chat_does_not_cache_row_changed_during_read() -> None:
+    chat_id = 44444444
+    Chat.set_mode(chat_id, BotMode.member)
+    chat_cache.clear()
+    read = Chat.get_or_none
+
+    def changed_while_reading(*args):
+        chat = read(*args)
+        Chat.set_mode(chat_id, BotMode.request)
+        return chat
+
+    with patch.object(Chat, 'get_or_none', side_effect=changed_while_reading):
+        assert (await queries.get_chat(chat_id)).mode == BotMode.member.value
+
+    assert (await queries.get_chat(chat_id)).mode == BotMode.request.value
+
+
+@pytest.mark.asyncio
+async def test_missing_chat_is_not_cached() -> None:
+    """Чат, добавленный в обход кэша (другим процессом), виден сразу"""
+    chat_id = 44444444
+
+    assert await queries.get_chat(chat_id) is None
+    assert Chat.get_cached(chat_id) is None
+    Chat.insert(id=chat_id, enable=True).execute()
+
+    assert Chat.get_cached(chat_id).enable is True
+    assert (await queries.get_chat(chat_id)).enable is True
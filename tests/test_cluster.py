@@ -0,0 +1,233 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from telegram.error import Conflict, RetryAfter
+
+from benchmarks.fake_telegram import FakeTelegram, message_update, post_update
+from src import config
+from src.database.models import Chat
+from src.tg.bot import build_application
+from src.tg.cluster import (
+    ChatLocks,
+    ChatSerializer,
+    WebhookServer,
+    WorkerPool,
+    dispatcher_bot,
+    partition,
+    poll_updates,
+    update_chat_id,
+)
+
+CHAT_IDS = [-1, -2, -3, -4]
+
+
+def test_update_chat_id() -> None:
+    assert update_chat_id(message_update(1, -100, "hi")) == -100
+    callback = {"update_id": 2, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": -5}}}}
+    assert update_chat_id(callback) == -5
+    assert update_chat_id({"update_id": 3, "inline_query": {"from": {"id": 7}}}) == 7
+    assert update_chat_id({"update_id": 4}) == 0
+
+
+def test_partition_is_stable() -> None:
+    assert {partition(chat_id, 4) for chat_id in range(-50, 50)} == {0, 1, 2, 3}
+    assert partition(-100123, 4) == partition(-100123, 4)
+
+
+@pytest.mark.asyncio
+async def test_chat_serializer_keeps_chat_order() -> None:
+    events = []
+
+    async def process(update):
+        chat_id, number = update
+        events.append(("start", chat_id, number))
+        await asyncio.sleep(0.01 if chat_id == 1 else 0)
+        events.append(("end", chat_id, number))
+
+    serializer = ChatSerializer(process)
+    for number in range(3):
+        serializer.submit(1, (1, number))
+        serializer.submit(2, (2, number))
+    await serializer.join()
+
+    chat_1 = [event for event in events if event[1] == 1]
+    assert chat_1 == [(kind, 1, number) for number in range(3) for kind in ("start", "end")]
+    # чат 2 не ждет медленный чат 1
+    assert events.index(("end", 2, 2)) < events.index(("end", 1, 0))
+
+
+@pytest.mark.asyncio
+async def test_chat_locks_keep_chat_order_of_concurrent_tasks() -> None:
+    locks = ChatLocks()
+    events = []
+
+    async def process(chat_id, number):
+        async with locks.hold(chat_id):
+            events.append(("start", chat_id, number))
+            await asyncio.sleep(0.01 if chat_id == 1 else 0)
+            events.append(("end", chat_id, number))
+
+    # как Application с concurrent_updates: задача на каждый апдейт в порядке очереди
+    await asyncio.gather(*(process(chat_id, number) for number in range(3) for chat_id in (1, 2)))
+
+    chat_1 = [event for event in events if event[1] == 1]
+    assert chat_1 == [(kind, 1, number) for number in range(3) for kind in ("start", "end")]
+    assert events.index(("end", 2, 2)) < events.index(("end", 1, 0))
+    assert len(locks) == 0
+
+
+@pytest_asyncio.fixture
+async def telegram(monkeypatch, test_db):
+    """Fake Telegram и конфиг воркеров для него"""
+    telegram = FakeTelegram()
+    await telegram.start()
+    overrides = {
+        "TELEGRAM_TOKEN": telegram.token,
+        "TELEGRAM_BASE_URL": telegram.base_url,
+        "TELEGRAM_HTTP_VERSION": "1.1",
+        "WEBHOOK_URL": "https://bot.example/telegram",
+        "DB_NAME": test_db.database,
+        "IMAGE_GEN": False,
+        "DIGEST_ENABLED": False,
+        "METRICS_ENABLED": False,
+        "TRACING_ENABLED": False,
+    }
+    for key, value in overrides.items():
+        # воркеры читают конфиг из окружения
+        monkeypatch.setenv(f"BOT_{key}", repr(value))
+        monkeypatch.setattr(config, key, value)
+    for chat_id in CHAT_IDS:
+        Chat.create(id=chat_id, enable=True)
+    yield telegram
+    await telegram.stop()
+
+
+@pytest.mark.asyncio
+async def test_webhook_workers_answer_all_chats(telegram) -> None:
+    pool = WorkerPool(build_application, workers=2)
+    server = WebhookServer(pool, secret="secret", path="/telegram")
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    url = f"http://{host}:{port}/telegram"
+    try:
+        assert await post_update(url, message_update(1, -1, "/status")) == 403
+        for update_id, chat_id in enumerate(CHAT_IDS * 2, 1):
+            assert await post_update(url, message_update(update_id, chat_id, "/status"), secret="secret") == 200
+
+        sent = await telegram.wait_for(len(CHAT_IDS) * 2)
+        assert sorted(params["chat_id"] for params in sent) == sorted(CHAT_IDS * 2)
+        assert {partition(chat_id, 2) for chat_id in CHAT_IDS} == {0, 1}
+        assert telegram.sent("setWebhook")[0]["secret_token"] == "secret"
+    finally:
+        await runner.cleanup()
+
+    assert pool.in_flight() == []
+
+
+@pytest.mark.asyncio
+async def test_submit_waits_for_worker_acks(telegram) -> None:
+    pool = WorkerPool(build_application, workers=1, queue_size=1)
+    pool.start()
+    try:
+        await pool.submit(message_update(1, -1, "/status"))
+        second = asyncio.create_task(pool.submit(message_update(2, -1, "/status")))
+        await asyncio.sleep(0.1)
+        # воркер еще не подтвердил первый апдейт
+        assert not second.done()
+        await asyncio.wait_for(second, 30)
+        await telegram.wait_for(2)
+    finally:
+        await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_polling_dispatcher_restarts_dead_worker(telegram) -> None:
+    pool = WorkerPool(build_application, workers=2, restart_delay=0.1)
+    pool.start()
+    bot = dispatcher_bot(poll_timeout=1)
+    polling = asyncio.create_task(poll_updates(pool, bot, timeout=1))
+    try:
+        for update_id, chat_id in enumerate(CHAT_IDS, 1):
+            await telegram.push_update(message_update(update_id, chat_id, "/status"))
+        await telegram.wait_for(len(CHAT_IDS))
+        assert telegram.sent("deleteWebhook")
+        while any(pool.in_flight()):
+            await asyncio.sleep(0.01)
+
+        pool._workers[partition(CHAT_IDS[0], 2)].process.kill()
+        for _ in range(300):
+            if pool.restarts:
+                break
+            await asyncio.sleep(0.1)
+        assert pool.restarts == 1
+        assert pool.lost == 0
+
+        for update_id, chat_id in enumerate(CHAT_IDS, len(CHAT_IDS) + 1):
+            await telegram.push_update(message_update(update_id, chat_id, "/status"))
+        sent = await telegram.wait_for(len(CHAT_IDS) * 2)
+        assert sorted(params["chat_id"] for params in sent) == sorted(CHAT_IDS * 2)
+    finally:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_single_process_polling(telegram) -> None:
+    application = build_application()
+    assert application.concurrent_updates == config.CONCURRENT_UPDATES
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    await application.updater.start_polling(timeout=1)
+    try:
+        for update_id, chat_id in enumerate(CHAT_IDS, 1):
+            await telegram.push_update(message_update(update_id, chat_id, "/status"))
+        sent = await telegram.wait_for(len(CHAT_IDS))
+        assert sorted(params["chat_id"] for params in sent) == sorted(CHAT_IDS)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+
+def _polling_bot(*results) -> MagicMock:
+    """Bot, getUpdates которого по очереди возвращает results, затем останавливает цикл"""
+    update = MagicMock(update_id=5)
+    update.to_dict.return_value = {"update_id": 5}
+    bot = MagicMock()
+    bot.delete_webhook = AsyncMock()
+    bot.get_updates = AsyncMock(side_effect=[*results, [update], asyncio.CancelledError()])
+    return bot
+
+
+@pytest.mark.asyncio
+async def test_poll_updates_waits_retry_after() -> None:
+    bot = _polling_bot(RetryAfter(7))
+    pool = MagicMock(submit=AsyncMock())
+
+    with patch('src.tg.cluster.asyncio.sleep', AsyncMock()) as sleep, pytest.raises(asyncio.CancelledError):
+        await poll_updates(pool, bot, timeout=1)
+
+    sleep.assert_awaited_once_with(7)
+    pool.submit.assert_awaited_once_with({"update_id": 5})
+    assert bot.get_updates.await_args.kwargs["offset"] == 6
+
+
+@pytest.mark.asyncio
+async def test_poll_updates_survives_conflict() -> None:
+    """Conflict (другой getUpdates) не останавливает polling, повтор с растущей задержкой"""
+    bot = _polling_bot(Conflict("terminated by other getUpdates request"), Conflict("terminated"))
+    pool = MagicMock(submit=AsyncMock())
+
+    with patch('src.tg.cluster.asyncio.sleep', AsyncMock()) as sleep, pytest.raises(asyncio.CancelledError):
+        await poll_updates(pool, bot, timeout=1)
+
+    assert [call.args[0] for call in sleep.await_args_list] == [1, 2]
+    pool.submit.assert_awaited_once_with({"update_id": 5})
@@ -0,0 +1,60 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.tg.coalesce import ChatCoalescer
+
+
+def _message(chat_id: int, message_id: int, text: str) -> MagicMock:
+    message = MagicMock()
+    message.chat_id = chat_id
+    message.id = message_id
+    message.text = text
+    return message
+
+
+@pytest.mark.asyncio
+async def test_coalesce_window() -> None:
+    batches = []
+
+    async def handler(messages):
+        batches.append([m.text for m in messages])
+
+    coalescer = ChatCoalescer(handler, window=0.05)
+    coalescer.submit(_message(1, 1, "a"))
+    coalescer.submit(_message(1, 2, "b"))
+    coalescer.submit(_message(2, 1, "c"))
+    assert not coalescer.submit(_message(1, 2, "b"))
+
+    await asyncio.sleep(0.1)
+    assert sorted(batches) == [["a", "b"], ["c"]]
+    await coalescer.close()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_cancels_superseded() -> None:
+    started = asyncio.Event()
+    batches = []
+    cancelled = []
+
+    async def handler(messages):
+        texts = [m.text for m in messages]
+        try:
+            if len(texts) == 1:
+                started.set()
+                await asyncio.sleep(1)
+            batches.append(texts)
+        except asyncio.CancelledError:
+            cancelled.append(texts)
+            raise
+
+    coalescer = ChatCoalescer(handler, window=0.01)
+    coalescer.submit(_message(1, 1, "a"))
+    await started.wait()
+    coalescer.submit(_message(1, 2, "b"))
+
+    await asyncio.sleep(0.05)
+    assert cancelled == [["a"]]
+    assert batches == [["a", "b"]]
+    await coalescer.close()
@@ -3,6 +3,7 @@ from collections.abc import Generator
 import pytest
 
 from src.constants import BotMode
+from src.database import queries
 from src.database.models import Chat
 
 
@@ -50,3 +51,15 @@ async def test_set_chat_mode() -> None:
     assert result == mode.value
     chat = Chat.get(Chat.id == chat_id)
     assert chat.mode == mode.value
+
+@pytest.mark.asyncio
+async def test_queries_run_off_loop() -> None:
+    """Асинхронные запросы выполняются в потоке БД"""
+    chat_id = 22222222
+
+    assert await queries.is_chat_enable(chat_id) is False
+    assert await queries.set_chat_state(chat_id, True) is True
+    assert await queries.is_chat_enable(chat_id) is True
+
+    chat = await queries.get_chat(chat_id)
+    assert chat.enable is True
@@ -0,0 +1,75 @@
+from unittest import mock
+
+import pytest
+
+from src.database.models import ChatDigest, ChatHistory, TGUser
+from src.open_ai import digest
+
+CHAT_ID = 1
+
+
+def _history(first: int, last: int):
+    TGUser.get_or_create(id=1, defaults={"name": "@user", "username": "user", "is_bot": False})
+    for message_id in range(first, last):
+        ChatHistory.create(chat=CHAT_ID, message_id=message_id, text=f"message {message_id}", from_user=1)
+
+
+@pytest.mark.asyncio
+async def test_update__folds_new_messages() -> None:
+    """Новые сообщения сворачиваются в содержание, пока их меньше every - ничего не делаем"""
+    updater = digest.DigestUpdater(every=5, batch=100)
+    answer = mock.AsyncMock(side_effect=["first digest", "second digest"])
+    _history(0, 3)
+
+    with mock.patch('src.open_ai.chat_gpt.aget_answer', answer):
+        assert await updater.update(CHAT_ID) is False
+        _history(3, 6)
+        assert await updater.update(CHAT_ID) is True
+        _history(6, 12)
+        assert await updater.update(CHAT_ID) is True
+
+    stored = ChatDigest.get_by_id(CHAT_ID)
+    assert stored.summary == "second digest"
+    assert stored.message_count == 12
+    assert stored.last_history_id == ChatHistory.select().order_by(ChatHistory.id.desc()).get().id
+    assert "first digest" in answer.await_args.kwargs['message']
+    assert "message 5" not in answer.await_args.kwargs['message']
+
+
+@pytest.mark.asyncio
+async def test_tldr_from_digest() -> None:
+    """tldr отвечает по содержанию и хвосту еще не свернутых сообщений"""
+    answer = mock.AsyncMock(return_value="tldr")
+
+    with mock.patch('src.open_ai.chat_gpt.aget_answer', answer):
+        assert await digest.tldr_from_digest(CHAT_ID) is None
+
+        _history(0, 3)
+        ChatDigest.create(chat_id=CHAT_ID, summary="stored digest", last_history_id=ChatHistory.get().id)
+        assert await digest.tldr_from_digest(CHAT_ID) == "tldr"
+
+    message = answer.await_args.kwargs['message']
+    assert "stored digest" in message
+    assert "message 0" not in message
+    assert "message 2" in message
+
+
+@pytest.mark.asyncio
+async def test_tldr_from_digest__long_tail_summarized() -> None:
+    """Хвост больше бюджета модели пересказывается до запроса /tldr"""
+    answer = mock.AsyncMock(return_value="tldr")
+    summarize_history = mock.AsyncMock(return_value="tail summary")
+    _history(0, 50)
+    ChatDigest.create(chat_id=CHAT_ID, summary="stored digest", last_history_id=ChatHistory.get().id)
+
+    with (
+        mock.patch('src.open_ai.chat_gpt.aget_answer', answer),
+        mock.patch('src.open_ai.summarize.summarize_history', summarize_history),
+        mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {digest.config.SUMARIZE_MODEL: 100}),
+    ):
+        assert await digest.tldr_from_digest(CHAT_ID) == "tldr"
+
+    assert len(summarize_history.await_args.args[2]) == 49
+    message = answer.await_args.kwargs['message']
+    assert "tail summary" in message
+    assert "message 49" not in message
@@ -6,8 +6,10 @@ from telegram import Chat, Message, Update, User
 from telegram.ext import ContextTypes
 
 from src.constants import BotMode
+from src.database import models
 from src.database.models import BotAdmin
 from src.tg.handlers.admin import set_disable, set_enable, set_mode
+from src.tg.handlers.chat import STREAM_PLACEHOLDER, send_streaming_message, tldr
 
 
 @pytest.fixture
@@ -40,7 +42,7 @@ def setup_admin() -> Generator[None, None, None]:
 @pytest.mark.asyncio
 async def test_set_enable_command(mock_update: MagicMock, mock_context: MagicMock) -> None:
     """Тест команды /enable"""
-    with patch('src.tg.utils.check_access_to_chat', return_value=True):
+    with patch('src.tg.handlers.admin.check_access_to_chat', AsyncMock(return_value=True)):
         await set_enable(mock_update, mock_context)
 
         mock_context.bot.send_message.assert_called_once()
@@ -50,7 +52,7 @@ async def test_set_enable_command(mock_update: MagicMock, mock_context: MagicMoc
 @pytest.mark.asyncio
 async def test_set_disable_command(mock_update: MagicMock, mock_context: MagicMock) -> None:
     """Тест команды /disable"""
-    with patch('src.tg.utils.check_access_to_chat', return_value=True):
+    with patch('src.tg.handlers.admin.check_access_to_chat', AsyncMock(return_value=True)):
         await set_disable(mock_update, mock_context)
 
         mock_context.bot.send_message.assert_called_once()
@@ -62,11 +64,60 @@ async def test_set_disable_command(mock_update: MagicMock, mock_context: MagicMo
 async def test_set_mode_command(mock_update: MagicMock, mock_context: MagicMock) -> None:
     """Тест команды /mode"""
     mock_update.message.text = f"/set_mode {BotMode.member.value}"
+    models.Chat.set_state(mock_update.message.chat_id, True)
 
-    with patch('src.tg.utils.check_access_to_chat', return_value=True):
+    with patch('src.tg.handlers.admin.check_access_to_chat', AsyncMock(return_value=True)):
         await set_mode(mock_update, mock_context)
 
         mock_context.bot.send_message.assert_called_once()
         args = mock_context.bot.send_message.call_args
         assert args[1]['chat_id'] == 123456789
         assert "Ok" in args[1]['text']
+
+async def _deltas(*parts: str):
+    for part in parts:
+        yield part
+
+@pytest.mark.asyncio
+async def test_send_streaming_message() -> None:
+    """Ответ приходит частями и дописывается в одно сообщение"""
+    sent = MagicMock(spec=Message)
+    sent.edit_text = AsyncMock()
+    message = MagicMock(spec=Message)
+    message.reply_text = AsyncMock(return_value=sent)
+
+    await send_streaming_message(message, _deltas("Hello", ", ", "world"))
+
+    message.reply_text.assert_called_once_with(text=STREAM_PLACEHOLDER)
+    assert sent.edit_text.call_args[1]['text'] == "Hello, world"
+
+@pytest.mark.asyncio
+async def test_send_streaming_message_rollover() -> None:
+    """Длинный ответ переносится в новое сообщение"""
+    sent = MagicMock(spec=Message)
+    sent.edit_text = AsyncMock()
+    message = MagicMock(spec=Message)
+    message.reply_text = AsyncMock(return_value=sent)
+
+    await send_streaming_message(message, _deltas("a" * 3000, "\n", "b" * 3000))
+
+    assert message.reply_text.call_count == 2
+    texts = [call[1]['text'] for call in sent.edit_text.call_args_list]
+    assert texts == ["a" * 3000, "b" * 3000]
+
+
+@pytest.mark.asyncio
+async def test_tldr_clamps_message_count(mock_update: MagicMock, mock_context: MagicMock) -> None:
+    """/tldr N не читает больше TLDR_MAX_MESSAGES сообщений"""
+    mock_update.message.text = "/tldr 100000000"
+    transcript = MagicMock(header="header", rows=[])
+    with (
+        patch('src.tg.handlers.chat.check_access_to_chat', AsyncMock(return_value=True)),
+        patch('src.tg.handlers.chat.queries.get_transcript', AsyncMock(return_value=transcript)) as get_transcript,
+        patch('src.tg.handlers.chat.summarize.summarize_history', AsyncMock(return_value="summary")),
+        patch('src.tg.handlers.chat.send_long_message', AsyncMock()),
+        patch('src.config.TLDR_MAX_MESSAGES', 1000),
+    ):
+        await tldr(mock_update, mock_context)
+
+    get_transcript.assert_awaited_once_with(123456789, 1000)
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from src.database import queries
+from src.database.history import HistoryWriter
+from src.database.models import ChatHistory, TGUser
+
+CHAT_ID = 123456789
+
+
+def _add(writer: HistoryWriter, message_id: int, reply_to: int | None = None):
+    writer.add_user(id=1, name="@user", username="user", is_bot=False, full_name="User", first_name="User",
+                    last_name=None)
+    writer.add_message(CHAT_ID, message_id, f"text {message_id}", 1, reply_to)
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_batch() -> None:
+    """Буфер пишет сообщения и пользователей одной пачкой"""
+    writer = HistoryWriter(flush_size=100, flush_interval=60)
+    _add(writer, 1)
+    _add(writer, 2, reply_to=1)
+    _add(writer, 2, reply_to=1)
+
+    assert len(writer) == 2
+    assert ChatHistory.select().count() == 0
+
+    await writer.flush()
+
+    assert len(writer) == 0
+    assert TGUser.select().count() == 1
+    rows = list(ChatHistory.select().order_by(ChatHistory.message_id))
+    assert [row.message_id for row in rows] == [1, 2]
+    assert rows[1].reply_to_id == rows[0].id
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_flush_by_size() -> None:
+    """При заполнении буфера запись запускается сама"""
+    writer = HistoryWriter(flush_size=2, flush_interval=60)
+    _add(writer, 1)
+    _add(writer, 2)
+
+    await writer._flush_task
+
+    assert ChatHistory.select().count() == 2
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_read_sees_buffered_rows() -> None:
+    """Чтение истории видит еще не записанные сообщения"""
+    _add(queries.history_writer, 10)
+
+    history = await queries.get_transcript(CHAT_ID, 10)
+
+    assert [message_id for message_id, _ in history.rows] == [10]
+    assert "| user |" in history.rows[0][1]
+
+
+@pytest.mark.asyncio
+async def test_user_without_username_is_written() -> None:
+    writer = HistoryWriter(flush_size=100, flush_interval=60)
+    writer.add_user(id=2, name="User", username=None, is_bot=False, full_name="User", first_name="User",
+                    last_name=None)
+    writer.add_message(CHAT_ID, 1, "text", 2, None)
+
+    await writer.flush()
+
+    assert TGUser.get_by_id(2).username == ""
+    assert ChatHistory.select().count() == 1
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_failing_batch_drops_only_bad_rows() -> None:
+    """После нескольких неудачных попыток строки пишутся по одной, плохие теряются"""
+    writer = HistoryWriter(flush_size=100, flush_interval=60, attempts=2)
+    _add(writer, 1)
+    writer.add_user(id=3, name=None, username="broken", is_bot=False)
+
+    await writer.flush()
+    assert len(writer) == 1
+    assert ChatHistory.select().count() == 0
+
+    await writer.flush()
+    assert len(writer) == 0
+    assert [row.message_id for row in ChatHistory.select()] == [1]
+    assert [user.id for user in TGUser.select()] == [1]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_buffer_is_capped() -> None:
+    writer = HistoryWriter(max_rows=3)
+    writer._restore({}, {(CHAT_ID, number): {} for number in range(5)})
+    assert list(writer._rows) == [(CHAT_ID, 2), (CHAT_ID, 3), (CHAT_ID, 4)]
+
+
+@pytest.mark.asyncio
+async def test_rows_added_during_flush_are_flushed_next() -> None:
+    writer = HistoryWriter(flush_size=2, flush_interval=60)
+    _add(writer, 1)
+    _add(writer, 2)
+    first = writer._flush_task
+    await asyncio.sleep(0)
+    # первая пачка уже пишется, новые строки не ждут следующего сообщения или таймера
+    _add(writer, 3)
+    _add(writer, 4)
+    await first
+    await writer._flush_task
+
+    assert ChatHistory.select().count() == 4
+    await writer.close()
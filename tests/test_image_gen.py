@@ -0,0 +1,83 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from replicate.helpers import FileOutput
+from telegram.error import BadRequest
+
+from src.image_gen import ImageGenerator
+from src.image_gen.disk_cache import DiskLRU
+from src.tg.photos import load_photo, send_generated_photo
+
+
+@pytest.mark.asyncio
+async def test_generator_closed() -> None:
+    generator = ImageGenerator(api_token="token")
+    client = generator.replicate._async_client
+    await generator.aclose()
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_generator_close_without_requests() -> None:
+    await ImageGenerator(api_token="token").aclose()
+
+
+@pytest.mark.asyncio
+async def test_send_generated_photo_by_url() -> None:
+    generator = ImageGenerator(api_token="token")
+    bot = MagicMock()
+    bot.send_photo = AsyncMock()
+
+    await send_generated_photo(bot, 1, 2, generator, FileOutput("https://replicate.delivery/out.png", None), "cap")
+    bot.send_photo.assert_awaited_once_with(
+        photo="https://replicate.delivery/out.png", chat_id=1, caption="cap", reply_to_message_id=2
+    )
+
+    bot.send_photo.reset_mock()
+    await send_generated_photo(bot, 1, 2, generator, FileOutput("data:image/png;base64,aGVsbG8=", None), "cap")
+    assert bot.send_photo.await_args.kwargs["photo"] == b"hello"
+
+
+@pytest.mark.asyncio
+async def test_send_generated_photo_fallback_to_bytes() -> None:
+    generator = ImageGenerator(api_token="token")
+    generator.read = AsyncMock(return_value=b"image")
+    bot = MagicMock()
+    bot.send_photo = AsyncMock(side_effect=[BadRequest("Wrong file identifier/http url specified"), None])
+
+    await send_generated_photo(bot, 1, 2, generator, FileOutput("https://replicate.delivery/out.png", None), "cap")
+    assert bot.send_photo.await_args.kwargs["photo"] == b"image"
+
+
+def test_disk_lru(tmp_path) -> None:
+    cache = DiskLRU(tmp_path, max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == tmp_path / "a"
+    cache.put("c", b"1234")
+
+    assert cache.get("b") is None
+    assert (tmp_path / "a").read_bytes() == b"1234"
+    assert cache.size == 8
+
+    # после перезапуска индекс восстанавливается с диска
+    restarted = DiskLRU(tmp_path, max_bytes=10)
+    assert len(restarted) == 2
+    assert restarted.get("c") == tmp_path / "c"
+
+
+@pytest.mark.asyncio
+async def test_load_photo_cached(tmp_path) -> None:
+    file = MagicMock()
+    file.download_as_bytearray = AsyncMock(return_value=bytearray(b"photo"))
+    bot = MagicMock()
+    bot.get_file = AsyncMock(return_value=file)
+
+    with patch("src.tg.photos.photo_cache", DiskLRU(tmp_path, max_bytes=100)):
+        first = await load_photo(bot, "file-id", "unique-id")
+        second = await load_photo(bot, "file-id", "unique-id")
+
+    assert first == second == tmp_path / "unique-id"
+    assert first.read_bytes() == b"photo"
+    bot.get_file.assert_awaited_once_with("file-id")
+    file.download_as_bytearray.assert_awaited_once()
@@ -0,0 +1,124 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from replicate.helpers import FileOutput
+
+from src.constants import JobKind, JobStatus
+from src.database.models import ImageJob
+from src.open_ai import chat_gpt
+from src.tg.image_jobs import ImageJobQueue
+
+
+def _message(message_id: int = 10) -> MagicMock:
+    message = MagicMock()
+    message.chat_id = 1
+    message.message_id = message_id
+    message.from_user.id = 100
+    message.reply_text = AsyncMock(return_value=MagicMock(message_id=message_id + 1))
+    return message
+
+
+def _bot() -> MagicMock:
+    bot = MagicMock()
+    bot.send_photo = AsyncMock(return_value=MagicMock(photo=[]))
+    bot.edit_message_text = AsyncMock()
+    bot.delete_message = AsyncMock()
+    return bot
+
+
+async def _wait_status(job_id: int, status: JobStatus) -> None:
+    for _ in range(100):
+        if ImageJob.get_by_id(job_id).status == status.value:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} is {ImageJob.get_by_id(job_id).status}")
+
+
+@pytest.mark.asyncio
+async def test_job_retried_then_done() -> None:
+    bot = _bot()
+    generator = MagicMock()
+    output = FileOutput("https://replicate.delivery/out.png", None)
+    generator.generate_image = AsyncMock(side_effect=[None, output])
+    queue = ImageJobQueue(workers=1, attempts=3, backoff=0.01)
+    await queue.start(bot, generator)
+
+    job = await queue.enqueue(JobKind.text, _message(), "a cat")
+    await _wait_status(job.id, JobStatus.done)
+
+    assert ImageJob.get_by_id(job.id).attempts == 2
+    bot.send_photo.assert_awaited_once()
+    assert bot.send_photo.await_args.kwargs["reply_to_message_id"] == 10
+    bot.delete_message.assert_awaited_once_with(chat_id=1, message_id=11)
+    await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_send_retried_without_generation() -> None:
+    """Если не удалась только отправка, повтор отправляет уже сгенерированную картинку"""
+    bot = _bot()
+    bot.send_photo.side_effect = [RuntimeError("telegram is down"), MagicMock(photo=[])]
+    generator = MagicMock()
+    generator.generate_image = AsyncMock(return_value=FileOutput("https://replicate.delivery/out.png", None))
+    queue = ImageJobQueue(workers=1, attempts=3, backoff=0.01)
+    await queue.start(bot, generator)
+
+    job = await queue.enqueue(JobKind.text, _message(), "a cat")
+    await _wait_status(job.id, JobStatus.done)
+
+    generator.generate_image.assert_awaited_once()
+    assert bot.send_photo.await_count == 2
+    assert bot.send_photo.await_args.kwargs["photo"] == "https://replicate.delivery/out.png"
+    assert ImageJob.get_by_id(job.id).output_url == "https://replicate.delivery/out.png"
+    await queue.stop()
+
+@pytest.mark.asyncio
+async def test_failed_translation_retried() -> None:
+    """Ошибка перевода не становится промптом картинки, задача повторяется"""
+    bot = _bot()
+    generator = MagicMock()
+    generator.generate_image = AsyncMock(return_value=FileOutput("https://replicate.delivery/out.png", None))
+    translate = AsyncMock(side_effect=[chat_gpt.ERROR_MESSAGE, "a cat"])
+    queue = ImageJobQueue(workers=1, attempts=3, backoff=0.01)
+    await queue.start(bot, generator)
+
+    with patch('src.open_ai.chat_gpt.aget_answer', translate):
+        job = await queue.enqueue(JobKind.text, _message(), "кот", translate=True)
+        await _wait_status(job.id, JobStatus.done)
+
+    generator.generate_image.assert_awaited_once_with("a cat")
+    stored = ImageJob.get_by_id(job.id)
+    assert (stored.prompt, stored.translate, stored.attempts) == ("a cat", False, 2)
+    await queue.stop()
+
+@pytest.mark.asyncio
+async def test_cancel_queued_job_and_restore() -> None:
+    bot = _bot()
+    generator = MagicMock()
+    started = asyncio.Event()
+
+    async def generate(prompt):
+        started.set()
+        await asyncio.sleep(10)
+
+    generator.generate_image = generate
+    queue = ImageJobQueue(workers=1, attempts=1, backoff=0.01)
+    await queue.start(bot, generator)
+
+    running = await queue.enqueue(JobKind.text, _message(10), "first")
+    queued = await queue.enqueue(JobKind.text, _message(20), "second")
+    await started.wait()
+
+    assert not await queue.cancel(queued.id, user_id=999)
+    assert await queue.cancel(queued.id, user_id=100)
+    assert ImageJob.get_by_id(queued.id).status == JobStatus.cancelled.value
+
+    # прерванная остановкой задача выполнится после перезапуска
+    await queue.stop()
+    assert ImageJob.get_by_id(running.id).status == JobStatus.running.value
+    generator.generate_image = AsyncMock(return_value=FileOutput("https://replicate.delivery/out.png", None))
+    await queue.start(bot, generator)
+    await _wait_status(running.id, JobStatus.done)
+    assert ImageJob.get_by_id(queued.id).status == JobStatus.cancelled.value
+    await queue.stop()
@@ -0,0 +1,68 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.database.models import ChatHistory, ImportCheckpoint, TGUser
+from src.tg.scripts.load_history import HistoryImporter
+
+CHAT_ID = -100
+
+
+def _message(id: int, user_id: int, reply_to: int | None = None, with_sender: bool = True) -> SimpleNamespace:
+    sender = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Name", last_name=None, bot=False)
+    return SimpleNamespace(
+        id=id,
+        chat_id=CHAT_ID,
+        date=datetime(2024, 1, 1),
+        text=f"message {id}",
+        sender_id=user_id,
+        sender=sender if with_sender else None,
+        reply_to_msg_id=reply_to,
+    )
+
+
+def _client(messages: list[SimpleNamespace]) -> MagicMock:
+    client = MagicMock()
+
+    async def iter_messages(chat_id, min_id=0, **kwargs):
+        for message in messages:
+            if message.id > min_id:
+                yield message
+
+    client.iter_messages = MagicMock(side_effect=iter_messages)
+    client.get_entity = AsyncMock(return_value=[SimpleNamespace(id=2, username=None, first_name="Two", last_name=None)])
+    return client
+
+
+@pytest.mark.asyncio
+async def test_import_pages_and_resume() -> None:
+    messages = [_message(1, 1), _message(2, 2, reply_to=1, with_sender=False), _message(3, 1), _message(4, 1)]
+    client = _client(messages[:3])
+
+    assert await HistoryImporter(client, page_size=2).run(CHAT_ID) == 3
+    client.get_entity.assert_awaited_once_with([2])
+    assert TGUser.get_by_id(2).name == "Two"
+    reply = ChatHistory.get(ChatHistory.message_id == 2)
+    assert reply.reply_to.message_id == 1
+    assert ImportCheckpoint.get_by_id(CHAT_ID).last_message_id == 3
+
+    # продолжение после прерывания: новые сообщения после чекпоинта
+    client = _client(messages)
+    assert await HistoryImporter(client, page_size=2).run(CHAT_ID) == 4
+    assert client.iter_messages.call_args.kwargs["min_id"] == 3
+    assert ChatHistory.select().count() == 4
+
+
+@pytest.mark.asyncio
+async def test_unresolved_user_keeps_stored_row() -> None:
+    """Заглушка неразрешенного пользователя не затирает сохраненные имя и username"""
+    TGUser.create(id=3, name="@known", username="known", is_bot=False)
+    client = _client([_message(1, 3, with_sender=False)])
+    client.get_entity = AsyncMock(return_value=[])
+
+    assert await HistoryImporter(client).run(CHAT_ID) == 1
+    user = TGUser.get_by_id(3)
+    assert (user.name, user.username) == ("@known", "known")
+    assert ChatHistory.get(ChatHistory.message_id == 1).from_user_id == 3
@@ -0,0 +1,82 @@
+import aiohttp
+import pytest
+
+from src import metrics
+from src.database.executor import db_executor
+from src.database.models import Chat
+
+
+def test_render_counter_histogram_and_gauge() -> None:
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "Requests", ["kind"])
+    histogram = registry.histogram("latency_seconds", "Latency", ["call"], buckets=(0.1, 1))
+    registry.gauge("queue", "Queue depth", lambda: {"llm": 3}, ["scheduler"])
+    counter.inc(kind='a "b"')
+    counter.inc(2, kind='a "b"')
+    histogram.observe(0.05, call="x")
+    histogram.observe(0.5, call="x")
+    histogram.observe(5, call="x")
+
+    text = registry.render()
+
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{kind="a \\"b\\""} 3' in text
+    assert 'latency_seconds_bucket{call="x",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{call="x",le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{call="x",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{call="x"} 3' in text
+    assert 'queue{scheduler="llm"} 3' in text
+
+
+@pytest.mark.asyncio
+async def test_timed_records_duration_and_errors() -> None:
+    histogram = metrics.Histogram("t_seconds", "", ["call"])
+    errors = metrics.Counter("t_errors_total", "", ["call"])
+
+    @metrics.timed(histogram, errors, empty_is_error=True, call="coro")
+    async def coro(value):
+        return value
+
+    @metrics.timed(histogram, errors, call="gen")
+    async def gen():
+        yield 1
+        yield 2
+
+    @metrics.timed(histogram, errors, call="sync")
+    def sync():
+        raise ValueError
+
+    assert await coro(1) == 1
+    assert await coro(None) is None
+    assert [item async for item in gen()] == [1, 2]
+    with pytest.raises(ValueError):
+        sync()
+
+    assert histogram.count(call="coro") == 2
+    assert errors.value(call="coro") == 1
+    assert histogram.count(call="gen") == 1
+    assert errors.value(call="gen") == 0
+    assert errors.value(call="sync") == 1
+    assert coro.__name__ == "coro"
+
+
+@pytest.mark.asyncio
+async def test_db_queries_timed_by_name() -> None:
+    before = metrics.db_seconds.count(query="Chat.get_or_none")
+    await db_executor.run(Chat.get_or_none, Chat.id == 1)
+    assert metrics.db_seconds.count(query="Chat.get_or_none") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_server() -> None:
+    registry = metrics.Registry()
+    registry.counter("hits_total", "Hits").inc()
+    server = metrics.MetricsServer(registry)
+    await server.start(port=0)
+    port = server._runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session, session.get(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.status == 200
+            assert "hits_total 1" in await response.text()
+    finally:
+        await server.stop()
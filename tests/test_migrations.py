@@ -0,0 +1,29 @@
+from src.database import connect_db
+from src.database.migrations import MIGRATIONS, apply_migrations
+from src.database.models import ChatHistory, SchemaVersion, TGUser
+
+
+def test_apply_migrations() -> None:
+    """Миграции применяются один раз и записывают версии"""
+    assert apply_migrations() == sorted(MIGRATIONS)
+    assert apply_migrations() == []
+    assert set(SchemaVersion.select(SchemaVersion.version).scalars()) == set(MIGRATIONS)
+
+
+def test_chathistory_indexes_dedupe(test_db) -> None:
+    """Дубликаты (chat, message_id) в старой таблице удаляются до создания уникального индекса"""
+    # таблица как до миграций: без индексов
+    ChatHistory.drop_table()
+    ChatHistory._schema.create_table()
+    TGUser.create(id=1, name="@user", username="user", is_bot=False)
+    original = ChatHistory.create(chat=1, message_id=10, text="question", from_user=1)
+    copy = ChatHistory.create(chat=1, message_id=10, text="question", from_user=1)
+    reply = ChatHistory.create(chat=1, message_id=11, text="answer", from_user=1, reply_to=copy)
+
+    connect_db()
+
+    assert [row.id for row in ChatHistory.select().order_by(ChatHistory.id)] == [original.id, reply.id]
+    assert ChatHistory.get_by_id(reply.id).reply_to_id == original.id
+    indexes = {index.name: index.unique for index in test_db.get_indexes("chathistory")}
+    assert indexes["chathistory_chat_id_message_id"] is True
+    assert "chathistory_chat_id_created_at" in indexes
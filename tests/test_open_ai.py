@@ -1,28 +1,24 @@
-from collections import defaultdict, deque
-from functools import partial
 from unittest import mock
 
 import pytest
 
+from src.database.executor import db_executor
 from src.open_ai import chat_gpt
+from src.open_ai.conversation import MemoryConversationStore, SqliteConversationStore
 
 
-@pytest.fixture
+@pytest.fixture(autouse=True)
 def chat_conversation():
-
-    new = defaultdict(
-        partial(deque, iterable=[], maxlen=2)
-    )
+    new = MemoryConversationStore(maxlen=3)
     with mock.patch('src.open_ai.chat_gpt.CHAT_CONVERSATION', new):
         yield new
 
 
-
-async def test_conversation__append():
+async def test_conversation__append(chat_conversation):
     chat_gpt.append_to_conversation(0, [{"role": "system", "content": "system"}])
 
-    assert len(chat_gpt.CHAT_CONVERSATION) == 1
-    assert len(chat_gpt.CHAT_CONVERSATION[0]) == 1
+    assert len(chat_conversation) == 1
+    assert len(chat_gpt.get_conversation_by_id(0)) == 1
 
     chat_gpt.append_to_conversation(
         0,
@@ -31,9 +27,48 @@ async def test_conversation__append():
             {"role": "assistant", "content": 'result'},
         ],
     )
-    assert len(chat_gpt.CHAT_CONVERSATION[0]) == 3
-    assert list(chat_gpt.CHAT_CONVERSATION[0]) == [
+    assert list(chat_gpt.get_conversation_by_id(0)) == [
         {'role': 'system', 'content': 'system'},
         {'role': 'user', 'content': 'message'},
         {'role': 'assistant', 'content': 'result'}
     ]
+
+    chat_gpt.append_to_conversation(0, [{"role": "user", "content": 'next'}])
+    assert len(chat_gpt.get_conversation_by_id(0)) == 3
+
+
+def test_memory_store__evict_lru():
+    store = MemoryConversationStore(maxlen=3, max_chats=2)
+    for id in range(3):
+        store.append(id, [{"role": "user", "content": str(id)}])
+
+    assert store.get(0) == []
+    assert store.get(2) == [{"role": "user", "content": "2"}]
+
+
+def test_sqlite_store__persist():
+    store = SqliteConversationStore(maxlen=2)
+    store.append(1, [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+    store.append(1, [{"role": "user", "content": "c"}])
+    db_executor.shutdown()
+
+    # Новый экземпляр (как после перезапуска) читает диалог из БД
+    restored = SqliteConversationStore(maxlen=2)
+    assert restored.get(1) == [{"role": "assistant", "content": "b"}, {"role": "user", "content": "c"}]
+
+    restored.clear(1)
+    db_executor.shutdown()
+    assert SqliteConversationStore(maxlen=2).get(1) == []
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store__aget_loads_in_db_thread():
+    SqliteConversationStore(maxlen=2).append(1, [{"role": "user", "content": "a"}])
+    db_executor.shutdown()
+
+    store = SqliteConversationStore(maxlen=2)
+    with mock.patch.object(db_executor, 'run', wraps=db_executor.run) as run:
+        assert await store.aget(1) == [{"role": "user", "content": "a"}]
+        assert await store.aget(1) == [{"role": "user", "content": "a"}]
+
+    run.assert_called_once_with(store._load, 1)
@@ -1,8 +1,10 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from src.open_ai.chat_gpt import get_answer
+from src.open_ai.chat_gpt import ERROR_MESSAGE, aget_answer, astream_answer, close_session, get_answer
+from src.scheduler import llm_scheduler
 
 
 @pytest.mark.asyncio
@@ -37,3 +39,79 @@ async def test_get_answer_with_conversation():
         response = get_answer(test_prompt, test_message, conversation_id)
 
         assert response == test_response
+
+@pytest.mark.asyncio
+async def test_aget_answer():
+    """Тест асинхронного получения ответа от OpenAI"""
+    test_response = "I'm doing well, thank you for asking!"
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = test_response
+
+    with patch('openai.ChatCompletion.acreate', AsyncMock(return_value=mock_response)) as acreate:
+        response = await aget_answer("You are a helpful assistant", "Hello", None)
+
+    assert response == test_response
+    assert acreate.await_args.kwargs['request_timeout']
+    await close_session()
+
+@pytest.mark.asyncio
+async def test_aget_answer_error():
+    """Ошибка OpenAI не пробрасывается в хендлер"""
+    with patch('openai.ChatCompletion.acreate', AsyncMock(side_effect=TimeoutError)):
+        response = await aget_answer("You are a helpful assistant", "Hello", None)
+
+    assert response == ERROR_MESSAGE
+    await close_session()
+
+def _stream(texts: list[str]):
+    async def stream():
+        for text in texts:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta={"content": text})]
+            yield chunk
+
+    return stream()
+
+@pytest.mark.asyncio
+async def test_astream_answer():
+    """Потоковый ответ отдается частями и сохраняется в историю"""
+    with (
+        patch('openai.ChatCompletion.acreate', AsyncMock(return_value=_stream(["Hello", " my friend", ", ", "world"]))),
+        patch('src.open_ai.chat_gpt.append_to_conversation') as append,
+    ):
+        deltas = [delta async for delta in astream_answer("prompt", "Hi", 1)]
+
+    # начало ответа придерживается до MIN_LEN_RESPONSE символов
+    assert deltas == ["Hello my friend", ", ", "world"]
+    append.assert_called_once_with(
+        1,
+        [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello my friend, world"}],
+    )
+    await close_session()
+
+@pytest.mark.asyncio
+async def test_astream_answer_drops_no_content():
+    """Короткий "No content" не отправляется, как и в aget_answer"""
+    with (
+        patch('openai.ChatCompletion.acreate', AsyncMock(return_value=_stream(["No ", "content"]))),
+        patch('src.open_ai.chat_gpt.append_to_conversation') as append,
+    ):
+        deltas = [delta async for delta in astream_answer("prompt", "Hi", 1)]
+
+    assert deltas == []
+    append.assert_not_called()
+    await close_session()
+
+@pytest.mark.asyncio
+async def test_astream_answer_releases_slot_before_consumer_finishes():
+    """Слот планировщика свободен, как только API закончил ответ"""
+    with patch('openai.ChatCompletion.acreate', AsyncMock(return_value=_stream(["A long enough answer", " end"]))):
+        deltas = astream_answer("prompt", "Hi", None, chat_id=1)
+        assert await deltas.__anext__() == "A long enough answer"
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert llm_scheduler.stats()["active"] == 0
+        assert [delta async for delta in deltas] == [" end"]
+    await close_session()
@@ -0,0 +1,37 @@
+import pytest
+
+from src.database.models import RateBucket
+from src.ratelimit import Limit, RateLimiter
+
+
+def test_bucket_consume_and_refill() -> None:
+    buckets = [("chat:1", 2, 1.0)]
+    assert RateBucket.consume(buckets, now=100)
+    assert RateBucket.consume(buckets, now=100)
+    assert not RateBucket.consume(buckets, now=100)
+    assert RateBucket.available("chat:1", 2, now=100.5) == pytest.approx(0.5)
+
+    assert RateBucket.consume(buckets, now=101)
+    assert RateBucket.available("chat:1", 2, now=200) == 2
+
+    assert RateBucket.expire(now=101) == 0
+    assert RateBucket.expire(now=200) == 1
+
+
+def test_bucket_consume_all_or_nothing() -> None:
+    assert RateBucket.consume([("total", 1, 0.0)], now=100)
+    assert not RateBucket.consume([("chat:1", 5, 0.0), ("total", 1, 0.0)], now=100)
+    assert RateBucket.available("chat:1", 5, now=100) == 5
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter() -> None:
+    limiter = RateLimiter("image", chat=Limit(2, 3600), user=Limit(1, 3600))
+    assert await limiter.acquire(chat_id=1, user_id=10)
+    assert not await limiter.acquire(chat_id=1, user_id=10)
+    assert await limiter.acquire(chat_id=1, user_id=11)
+    assert not await limiter.acquire(chat_id=1, user_id=12)
+
+    await limiter.refund(chat_id=1, user_id=11)
+    assert await limiter.available(chat_id=1, user_id=11)
+    assert not await limiter.available(chat_id=1, user_id=10)
@@ -0,0 +1,53 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from src.open_ai.chat_gpt import aget_answer, close_session
+from src.open_ai.response_cache import ResponseCache, normalize, response_cache
+
+
+def test_normalize() -> None:
+    assert normalize("  Как   сбросить ПАРОЛЬ?! ") == "как сбросить пароль"
+
+
+def test_exact_and_near_hits() -> None:
+    cache = ResponseCache(maxsize=10, ttl=60, threshold=0.6)
+    cache.set("prompt", "Как сбросить пароль от личного кабинета?", "model", "answer")
+
+    assert cache.get("prompt", "как сбросить пароль от личного кабинета", "model") == "answer"
+    assert cache.get("prompt", "Как сбросить пароль от личного кабинета, подскажите?", "model") == "answer"
+    assert cache.get("prompt", "Какая сегодня погода в Москве?", "model") is None
+    # другой промпт или модель - другой ответ
+    assert cache.get("other prompt", "Как сбросить пароль от личного кабинета?", "model") is None
+    assert cache.get("prompt", "Как сбросить пароль от личного кабинета?", "other") is None
+
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["near_hits"], stats["misses"]) == (1, 1, 3)
+
+
+def test_eviction_reindex() -> None:
+    cache = ResponseCache(maxsize=2, ttl=60)
+    for i in range(10):
+        cache.set("prompt", f"question number {i}", "model", str(i))
+
+    assert len(cache) == 2
+    assert cache.get("prompt", "question number 0", "model") is None
+    assert cache.get("prompt", "question number 9", "model") == "9"
+
+
+@pytest.mark.asyncio
+async def test_aget_answer_cache() -> None:
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = "Cached answer for you"
+    response_cache.clear()
+
+    with patch('openai.ChatCompletion.acreate', AsyncMock(return_value=mock_response)) as acreate:
+        first = await aget_answer("prompt", "What is the FAQ?", None, cache=True)
+        second = await aget_answer("prompt", "what is the faq", None, cache=True)
+        await aget_answer("prompt", "What is the FAQ?", None)
+
+    assert first == second == "Cached answer for you"
+    assert acreate.await_count == 2
+    response_cache.clear()
+    await close_session()
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from src.scheduler import FairScheduler, Priority
+
+
+async def _run(scheduler: FairScheduler, order: list, chat_id: int, priority: Priority = Priority.HIGH) -> None:
+    async with scheduler.slot(chat_id, priority):
+        order.append(chat_id)
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_fair_between_chats() -> None:
+    """Запросы шумного чата не вытесняют тихий"""
+    scheduler = FairScheduler("test", limit=1, per_chat=1)
+    order: list[int] = []
+    tasks = [asyncio.create_task(_run(scheduler, order, 1)) for _ in range(5)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(_run(scheduler, order, 2)))
+    await asyncio.gather(*tasks)
+
+    assert order[:3] == [1, 1, 2]
+    assert scheduler.stats()["waited"] == 6
+    assert scheduler.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_priority_and_per_chat_cap() -> None:
+    scheduler = FairScheduler("test", limit=2, per_chat=1)
+    order: list[int] = []
+    tasks = [
+        asyncio.create_task(_run(scheduler, order, 1, Priority.LOW)),
+        asyncio.create_task(_run(scheduler, order, 1, Priority.LOW)),
+        asyncio.create_task(_run(scheduler, order, 2, Priority.LOW)),
+        asyncio.create_task(_run(scheduler, order, 3, Priority.HIGH)),
+    ]
+    await asyncio.sleep(0)
+    assert order == [1, 2]
+    assert scheduler.queue_depth() == {Priority.HIGH: 1, Priority.LOW: 1}
+
+    await asyncio.gather(*tasks)
+    assert order == [1, 2, 3, 1]
+
+
+@pytest.mark.asyncio
+async def test_cancel_waiting() -> None:
+    scheduler = FairScheduler("test", limit=1, per_chat=1)
+    order: list[int] = []
+    first = asyncio.create_task(_run(scheduler, order, 1))
+    waiting = asyncio.create_task(_run(scheduler, order, 2))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await first
+    assert order == [1]
+    assert scheduler.stats()["queued"] == 0
+    assert scheduler.stats()["active"] == 0
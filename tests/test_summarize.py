@@ -0,0 +1,114 @@
+from unittest import mock
+
+import pytest
+
+from src.open_ai import summarize
+
+MODEL = "test-model"
+
+
+@pytest.fixture(autouse=True)
+def clear_chunk_cache():
+    summarize.chunk_cache.clear()
+
+
+def _rows(first: int, last: int) -> list[summarize.Row]:
+    return [(message_id, f"{message_id} | user | " + "x" * 30) for message_id in range(first, last)]
+
+
+def test_chunk_rows__aligned_by_message_id() -> None:
+    """Внутренние фрагменты не зависят от начала окна"""
+    first = summarize.chunk_rows(_rows(5, 40), max_tokens=1000, model=MODEL, bucket_size=10)
+    shifted = summarize.chunk_rows(_rows(8, 45), max_tokens=1000, model=MODEL, bucket_size=10)
+
+    assert [[row[0] for row in chunk][:1] for chunk in first] == [[5], [10], [20], [30]]
+    assert first[1:] == shifted[1:-1]
+
+
+def test_chunk_rows__split_by_tokens() -> None:
+    chunks = summarize.chunk_rows(_rows(0, 10), max_tokens=30, model=MODEL, bucket_size=100)
+
+    assert len(chunks) == 5
+    assert sum(len(chunk) for chunk in chunks) == 10
+
+
+@pytest.mark.asyncio
+async def test_summarize_history__map_reduce_cached() -> None:
+    """Длинная история суммаризируется по частям, повтор берет фрагменты из кэша"""
+    answer = mock.AsyncMock(return_value="summary")
+    budget = {MODEL: 2000}
+
+    with (
+        mock.patch('src.open_ai.chat_gpt.aget_answer', answer),
+        mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', budget),
+        mock.patch('src.config.TLDR_CHUNK_MESSAGES', 50),
+    ):
+        result = await summarize.summarize_history(1, "header", _rows(0, 200), model=MODEL)
+        calls = answer.await_count
+
+        # Сдвигаем окно на 50 новых сообщений
+        await summarize.summarize_history(1, "header", _rows(50, 250), model=MODEL)
+
+    assert result == "summary"
+    assert calls > 2
+    prompts = [call.kwargs['prompt'] for call in answer.await_args_list[calls:]]
+    assert prompts.count(summarize.config.SUMARIZE_CHUNK_PROMPT) == 1
+
+
+@pytest.mark.asyncio
+async def test_summarize_history__cache_key_includes_header() -> None:
+    """Фрагменты с другой легендой псевдонимов не берутся из кэша"""
+    answer = mock.AsyncMock(return_value="summary")
+
+    with (
+        mock.patch('src.open_ai.chat_gpt.aget_answer', answer),
+        mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {MODEL: 2000}),
+        mock.patch('src.config.TLDR_CHUNK_MESSAGES', 50),
+    ):
+        await summarize.summarize_history(1, "users: u1=alice", _rows(0, 200), model=MODEL)
+        calls = answer.await_count
+        await summarize.summarize_history(1, "users: u1=bob", _rows(0, 200), model=MODEL)
+
+    assert answer.await_count == 2 * calls
+
+
+@pytest.mark.asyncio
+async def test_reduce__answers_over_budget_converge() -> None:
+    """Пересказы больше бюджета объединяются попарно, /tldr не зацикливается"""
+    answer = mock.AsyncMock(return_value="y" * 4000)
+
+    with (
+        mock.patch('src.open_ai.chat_gpt.aget_answer', answer),
+        mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {MODEL: 2000}),
+        mock.patch('src.config.TLDR_CHUNK_MESSAGES', 25),
+    ):
+        assert await summarize.summarize_history(1, "header", _rows(0, 200), model=MODEL) == "y" * 4000
+
+    # 8 фрагментов, затем 4, 2 и 1 запрос объединения
+    assert answer.await_count == 8 + 4 + 2 + 1
+    budget = summarize._input_budget(summarize.config.SUMARIZE_REDUCE_PROMPT, MODEL)
+    assert all(
+        summarize.count_tokens(call.kwargs['message'], MODEL) <= budget + 20
+        for call in answer.await_args_list[8:]
+    )
+
+
+@pytest.mark.asyncio
+async def test_summarize_history__failed_chunks_dropped() -> None:
+    """Ошибки фрагментов не попадают в объединение, если все упали - /tldr возвращает ошибку"""
+    error = summarize.chat_gpt.ERROR_MESSAGE
+    answer = mock.AsyncMock(side_effect=["first", error, "", "fourth", "summary"])
+
+    with (
+        mock.patch('src.open_ai.chat_gpt.aget_answer', answer),
+        mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {MODEL: 2000}),
+        mock.patch('src.config.TLDR_CHUNK_MESSAGES', 50),
+        mock.patch('src.config.TLDR_CONCURRENCY', 1),
+    ):
+        assert await summarize.summarize_history(1, "header", _rows(0, 200), model=MODEL) == "summary"
+        assert answer.await_args.kwargs['message'] == "first\n-------------------------\nfourth"
+
+        summarize.chunk_cache.clear()
+        answer.side_effect = None
+        answer.return_value = error
+        assert await summarize.summarize_history(1, "header", _rows(0, 200), model=MODEL) == error
@@ -0,0 +1,80 @@
+from unittest import mock
+
+import pytest
+import tiktoken
+
+from src.open_ai import tokens
+
+MODEL = "test-model"
+# Настоящая функция: conftest подменяет get_encoding на время теста
+get_encoding = tokens.get_encoding
+
+
+@pytest.fixture
+def byte_tokenizer():
+    """Токенизатор tiktoken без словаря из сети: один байт - один токен"""
+    encoding = tiktoken.Encoding(
+        name="bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={}
+    )
+    get_encoding.cache_clear()
+    tokens.count_tokens.cache_clear()
+    with (
+        mock.patch('src.open_ai.tokens.get_encoding', get_encoding),
+        mock.patch('tiktoken.encoding_for_model', return_value=encoding) as encoding_for_model,
+    ):
+        yield encoding_for_model
+    get_encoding.cache_clear()
+    tokens.count_tokens.cache_clear()
+
+
+def _turn(role: str, size: int) -> dict[str, str]:
+    return {"role": role, "content": "x" * size}
+
+
+def test_build_messages__newest_turns_in_budget() -> None:
+    """В запрос попадают самые новые реплики, которые влезают в бюджет"""
+    history = [_turn("user", 300), _turn("assistant", 30), _turn("user", 30)]
+
+    with mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {MODEL: 60}):
+        messages = tokens.build_messages("prompt", "question", history, MODEL)
+
+    assert messages[0] == {"role": "system", "content": "prompt"}
+    assert messages[1:-1] == history[1:]
+    assert messages[-1] == {"role": "user", "content": "question"}
+
+
+def test_build_messages__truncate_long_message() -> None:
+    """Слишком длинное сообщение обрезается до бюджета"""
+    with mock.patch.dict('src.config.MODEL_TOKEN_BUDGET', {MODEL: 100}):
+        messages = tokens.build_messages("prompt", "y" * 10000, [_turn("user", 3)], MODEL)
+
+    assert len(messages) == 2
+    assert sum(tokens.message_tokens(message, MODEL) for message in messages) <= 100
+
+
+def test_count_tokens__cached() -> None:
+    tokens.count_tokens.cache_clear()
+    tokens.count_tokens("some text", MODEL)
+    tokens.count_tokens("some text", MODEL)
+
+    assert tokens.count_tokens.cache_info().hits == 1
+
+
+def test_truncate_to_tokens__keep_tail() -> None:
+    assert tokens.truncate_to_tokens("abcdefghij", 2, MODEL) == "abc"
+    assert tokens.truncate_to_tokens("abcdefghij", 2, MODEL, tail=True) == "hij"
+
+
+def test_tokenizer(byte_tokenizer) -> None:
+    """Подсчет и обрезка идут через токенизатор tiktoken"""
+    assert tokens.count_tokens("привет", MODEL) == len("привет".encode())
+    assert tokens.truncate_to_tokens("old lines\nnew lines", 9, MODEL, tail=True) == "new lines"
+    byte_tokenizer.assert_called_once_with(MODEL)
+
+
+@pytest.mark.asyncio
+async def test_preload(byte_tokenizer) -> None:
+    await tokens.preload(MODEL, MODEL)
+
+    tokens.count_tokens("text", MODEL)
+    byte_tokenizer.assert_called_once_with(MODEL)
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+from unittest import mock
+
+import pytest
+
+from src import config, log_tools, tracing
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Записанные трассы вместо файла"""
+    monkeypatch.setattr(config, "TRACING_ENABLED", True)
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 1.0)
+    lines = []
+    with mock.patch.object(tracing.trace_log, "info", side_effect=lines.append):
+        yield lines
+
+
+def _traces(lines: list[str]) -> list[dict]:
+    return [json.loads(line) for line in lines]
+
+
+@pytest.mark.asyncio
+async def test_nested_spans_written_with_parents(written) -> None:
+    @tracing.traced("db:query")
+    async def query():
+        await asyncio.sleep(0)
+
+    @tracing.traced("stream")
+    async def stream():
+        with tracing.span("chunk"):
+            yield 1
+
+    with tracing.trace("update", chat_id=1):
+        with tracing.span("handler:on_message"):
+            await query()
+            assert [item async for item in stream()] == [1]
+        await query()
+
+    [trace] = _traces(written)
+    assert trace["name"] == "update"
+    assert trace["attrs"] == {"chat_id": 1}
+    spans = [(span_id, parent, name) for span_id, parent, name, *_ in trace["spans"]]
+    assert spans == [
+        (1, 0, "handler:on_message"),
+        (2, 1, "db:query"),
+        (3, 1, "stream"),
+        (4, 3, "chunk"),
+        (5, 0, "db:query"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stream_consumer_spans_not_in_generator_span(written) -> None:
+    """Span-ы потребителя между элементами генератора не попадают под его span"""
+
+    @tracing.traced("stream")
+    async def stream():
+        for item in (1, 2):
+            with tracing.span("chunk"):
+                await asyncio.sleep(0)
+            yield item
+
+    with tracing.trace("update"):
+        async for _ in stream():
+            with tracing.span("send"):
+                pass
+        items = stream()
+        assert await items.__anext__() == 1
+    # финализатор генератора может закрыть его из другого контекста
+    await asyncio.create_task(items.aclose())
+
+    [trace] = _traces(written)
+    spans = [(span_id, parent, name) for span_id, parent, name, *_ in trace["spans"]]
+    assert spans == [
+        (1, 0, "stream"),
+        (2, 1, "chunk"),
+        (3, 0, "send"),
+        (4, 1, "chunk"),
+        (5, 0, "send"),
+        (6, 0, "stream"),
+        (7, 6, "chunk"),
+    ]
+
+def test_span_outside_trace_and_sampling(written, monkeypatch) -> None:
+    with tracing.span("db:query") as span:
+        assert span is None
+
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 0.0)
+    with tracing.trace("fast"):
+        pass
+    monkeypatch.setattr(config, "TRACE_SLOW_SECONDS", 0.0)
+    with pytest.raises(ValueError), tracing.trace("slow"):
+        raise ValueError
+
+    [trace] = _traces(written)
+    assert trace["name"] == "slow"
+    assert trace["attrs"] == {"error": "ValueError"}
+
+
+@pytest.mark.asyncio
+async def test_task_after_trace_end_follows_it(written) -> None:
+    release = asyncio.Event()
+
+    async def later():
+        await release.wait()
+        with tracing.span("handler:answer_messages"):
+            pass
+
+    with tracing.trace("update"):
+        task = asyncio.create_task(later())
+    release.set()
+    await task
+
+    first, second = _traces(written)
+    assert second["name"] == "handler:answer_messages"
+    assert second["follows"] == first["trace"]
+
+
+def test_breakdown_and_report() -> None:
+    lines = [
+        json.dumps({"trace": "a", "name": "update", "ts": 0, "ms": 100, "attrs": {},
+                    "spans": [[1, 0, "handler:tldr", 1, 90], [2, 1, "openai:aget_answer", 5, 80],
+                              [3, 1, "db:ChatHistory.select", 2, 5]]}),
+        "not json",
+        json.dumps({"trace": "b", "name": "update", "ts": 0, "ms": 50, "attrs": {},
+                    "spans": [[1, 0, "handler:tldr", 1, 40], [2, 1, "openai:aget_answer", 5, 30, {"error": "X"}]]}),
+    ]
+    stacks = tracing.breakdown(tracing.load_traces(lines))
+
+    assert stacks[("update",)] == [2, 150, 20]
+    assert stacks[("update", "handler:tldr", "openai:aget_answer")] == [2, 110, 110]
+    assert stacks[("update", "handler:tldr")] == [2, 130, 15]
+
+    tree = tracing.format_tree(stacks).splitlines()
+    assert tree[1].endswith("  update")
+    assert tree[2].endswith("    handler:tldr")
+    assert tree[3].endswith("      openai:aget_answer")
+    assert "update;handler:tldr;openai:aget_answer 110000" in tracing.format_folded(stacks)
+
+
+def test_trace_file_per_process(tmp_path, monkeypatch) -> None:
+    """Воркер пишет трассы в свой файл, отчет находит файлы всех процессов"""
+    monkeypatch.setattr(log_tools, "TRACE_FILE", str(tmp_path / "traces.jsonl"))
+    [handler] = logging.getLogger("traces").handlers
+    monkeypatch.setattr(handler, "baseFilename", handler.baseFilename)
+
+    log_tools.use_trace_file("worker1")
+    tracing.trace_log.info("{}")
+    handler.close()
+
+    assert log_tools.trace_files() == [str(tmp_path / "traces.worker1.jsonl")]
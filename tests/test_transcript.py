@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from src.database import models, transcript
+from src.database.models import ChatHistory, TGUser
+
+CHAT_ID = 1
+START = datetime(2024, 1, 1, 10, 0)
+
+
+def _history(count: int):
+    TGUser.create(id=1, name="@ivan", username="ivan", is_bot=False)
+    TGUser.create(id=2, name="@petr", username="petr", is_bot=False)
+    previous = None
+    for message_id in range(count):
+        previous = ChatHistory.create(
+            chat=CHAT_ID,
+            message_id=message_id,
+            created_at=START + timedelta(minutes=message_id),
+            text=f"message {message_id}",
+            from_user=1 + message_id % 2,
+            reply_to=previous,
+        )
+    ChatHistory.create(chat=2, message_id=0, text="other chat", from_user=1)
+
+
+def _legacy(limit: int) -> list[str]:
+    """Прежний способ: модели, разворот списка и get_attr"""
+    history = list(
+        ChatHistory.select(ChatHistory, TGUser)
+        .join(TGUser)
+        .where(ChatHistory.chat_id == CHAT_ID)
+        .order_by(ChatHistory.created_at.desc())
+        .limit(limit)
+    )
+    history.reverse()
+    columns = ['id', 'reply_to_id', 'from_user.username', 'created_at', 'text']
+    return [' | '.join(str(models.get_attr(row, col)) for col in columns) for row in history]
+
+
+def test_full_format_matches_legacy() -> None:
+    _history(10)
+
+    result = transcript.build_transcript(CHAT_ID, limit=4)
+
+    assert result.header == 'id | reply_to_id | from_user.username | created_at | text'
+    assert [line for _, line in result.rows] == _legacy(4)
+    assert [message_id for message_id, _ in result.rows] == [6, 7, 8, 9]
+    assert result.last_id == ChatHistory.get(ChatHistory.chat == CHAT_ID, ChatHistory.message_id == 9).id
+
+
+def test_limit_larger_than_history() -> None:
+    _history(3)
+
+    assert len(transcript.build_transcript(CHAT_ID, limit=100)) == 3
+
+
+def test_after_id_oldest_first() -> None:
+    _history(10)
+    after = ChatHistory.get(ChatHistory.chat == CHAT_ID, ChatHistory.message_id == 4).id
+
+    result = transcript.build_transcript(CHAT_ID, limit=2, after_id=after, newest=False)
+
+    assert [message_id for message_id, _ in result.rows] == [5, 6]
+
+
+def test_compact_format() -> None:
+    _history(3)
+
+    result = transcript.build_transcript(CHAT_ID, compact=True)
+
+    assert result.header == 'users: u1=ivan, u2=petr\nn | reply | user | dt | text'
+    assert [line for _, line in result.rows] == [
+        '1 |  | u1 | 2024-01-01 10:00 | message 0',
+        '2 | 1 | u2 | +1m | message 1',
+        '3 | 2 | u1 | +1m | message 2',
+    ]